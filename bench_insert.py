@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import duckdb
+
+import crud
+import database
+from database import connection_manager, create_serial_sequence, init_zwischen_db
+from dimensions import DimensionInterner
+from models import LogRecord
+
+# Sustained ingestion target, in stored rows per second, for the writer's default 500-record batches.
+TARGET_ROWS_PER_SECOND = 5000
+
+def make_records(count: int, batch: int = 0):
+    return [
+        LogRecord(
+            f"10.{batch % 250}.{i // 250 % 250}.{i % 250}", "GET", f"/items/{i % 40}", 200,
+            f"2026-10-18 10:{(batch + i) % 60:02d}:{i % 60:02d}", "Chrome", "Linux", "desktop",
+            f"https://referrer{i % 30}.example"
+        )
+        for i in range(count)
+    ]
+
+async def run_layout(layout: str, batches: int, batch_size: int, directory: str) -> dict:
+    database.LOG_SCHEMA = layout
+    connection_manager.database = os.path.join(directory, f"{layout}.duckdb")
+    # Dimension keys interned for another database don't exist in this one.
+    crud.dimension_interner = DimensionInterner()
+    connection_manager.open()
+    create_serial_sequence(connection_manager.writer)
+    init_zwischen_db()
+    db = connection_manager.writer
+
+    # The first batch creates the dimension rows and rollup buckets; measure steady state.
+    await crud.insert_logs(make_records(batch_size), db)
+    start = time.perf_counter()
+    inserted = 0
+    for batch in range(1, batches + 1):
+        inserted += (await crud.insert_logs(make_records(batch_size, batch), db))["inserted"]
+    elapsed = time.perf_counter() - start
+    connection_manager.close()
+
+    return {
+        "rows": inserted,
+        "seconds": elapsed,
+        "rows_per_second": inserted / elapsed,
+        "meets_target": inserted / elapsed >= TARGET_ROWS_PER_SECOND
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description="insert_logs throughput per log layout, rollups included.")
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--layouts", nargs="+", default=["wide", "compact"])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = {"target_rows_per_second": TARGET_ROWS_PER_SECOND, "duckdb": duckdb.__version__, "layouts": {}}
+    for layout in args.layouts:
+        results["layouts"][layout] = await run_layout(layout, args.batches, args.batch_size, directory)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
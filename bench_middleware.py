@@ -0,0 +1,73 @@
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import httpx
+from fastapi import FastAPI
+
+from database import connection_manager
+from middleware import ZwischenMiddleware, ZwischenASGIMiddleware, startup, shutdown
+
+NUM_REQUESTS = 5000
+CONCURRENCY = 50
+
+def build_app(middleware_class=None) -> FastAPI:
+    app = FastAPI()
+    if middleware_class is not None:
+        app.add_middleware(middleware_class)
+
+    @app.get("/ping")
+    async def ping():
+        return {"message": "pong"}
+
+    return app
+
+async def run(app: FastAPI, num_requests: int, concurrency: int) -> dict:
+    transport = httpx.ASGITransport(app=app, client=("81.2.69.160", 5000))
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send_request():
+            async with semaphore:
+                start = time.perf_counter_ns()
+                await client.get("/ping", headers={"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) Firefox/89.0"})
+                latencies.append(time.perf_counter_ns() - start)
+
+        # Warm up routing, UA cache and the ingestion writer before measuring.
+        await asyncio.gather(*(send_request() for _ in range(200)))
+        latencies.clear()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send_request() for _ in range(num_requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests_per_second": num_requests / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] / 1e6,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] / 1e6,
+        "mean_ms": statistics.fmean(latencies) / 1e6
+    }
+
+async def main():
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_REQUESTS
+    connection_manager.database = os.path.join(tempfile.mkdtemp(), "bench.duckdb")
+    await startup()
+
+    results = {}
+    for name, middleware_class in [
+        ("no_middleware", None),
+        ("base_http_middleware", ZwischenMiddleware),
+        ("asgi_middleware", ZwischenASGIMiddleware)
+    ]:
+        results[name] = await run(build_app(middleware_class), num_requests, CONCURRENCY)
+
+    await shutdown()
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
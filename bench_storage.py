@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import duckdb
+
+import database
+from database import create_serial_sequence, create_wide_log, log_disorder, sort_log_table
+from storage import truncate, window_filter
+
+CHUNK_ROWS = 1_000_000
+SPAN_DAYS = 365
+# The data ends on a Thursday afternoon in mid-June, so every window starts at a different point.
+SPAN_START = "2024-06-19 14:30:00"
+
+WINDOWS = ["hour", "day", "week", "month", "year"]
+
+def populate(db: duckdb.DuckDBPyConnection, rows: int, shuffled: bool) -> float:
+    """
+    Inserts `rows` synthetic requests spread over SPAN_DAYS, in chunks like the batch writer does.
+    Arrival order follows the timestamps (with a minute of jitter) unless `shuffled`, which
+    mimics an out-of-order backfill.
+    """
+    step_us = SPAN_DAYS * 86400 * 1_000_000 // rows
+    position = "CAST(hash(i) % $rows AS BIGINT)" if shuffled else "i"
+    start = time.perf_counter()
+    for offset in range(0, rows, CHUNK_ROWS):
+        db.execute(f"""
+            INSERT INTO log (id, timestamp, method, ip, endpoint, status_code, duration_ns, sample_weight)
+            SELECT nextval('serial'),
+                   TIMESTAMP '{SPAN_START}' + to_microseconds({position} * {step_us} + CAST(hash(i + 1) % 60000000 AS BIGINT)),
+                   'GET',
+                   '10.' || (i % 250) || '.' || (i // 250 % 250) || '.1',
+                   '/endpoint/' || (hash(i + 2) % 20),
+                   CASE WHEN hash(i + 3) % 50 = 0 THEN 500 ELSE 200 END,
+                   hash(i + 4) % 100000000,
+                   1.0
+            FROM range($offset, LEAST($offset + {CHUNK_ROWS}, $rows)) r(i)
+        """, {"offset": offset, "rows": rows})
+    db.execute("CHECKPOINT")
+    return time.perf_counter() - start
+
+def scan(db: duckdb.DuckDBPyConnection, window: str, repeats: int, profile_path: str) -> dict:
+    # The dashboards' window predicate, with "now" at the end of the synthetic data.
+    params = [truncate(db.execute("SELECT MAX(timestamp) FROM log").fetchone()[0], window)]
+    query = f"""
+        SELECT endpoint, SUM(sample_weight)
+        FROM log
+        WHERE TRUE {window_filter(window, "timestamp")}
+        GROUP BY endpoint
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        db.execute(query, params).fetchall()
+        timings.append(time.perf_counter() - start)
+
+    # One profiled run to count the rows the scan actually read after zone-map pruning.
+    db.execute("PRAGMA enable_profiling = 'json'")
+    db.execute(f"PRAGMA profiling_output = '{profile_path}'")
+    db.execute("""SET custom_profiling_settings = '{"OPERATOR_ROWS_SCANNED": "true"}'""")
+    db.execute(query, params).fetchall()
+    db.execute("PRAGMA disable_profiling")
+    with open(profile_path) as f:
+        profile = json.load(f)
+
+    def rows_scanned(node: dict) -> int:
+        return node.get("operator_rows_scanned", 0) + sum(rows_scanned(child) for child in node.get("children", []))
+
+    return {"median_ms": statistics.median(timings) * 1000, "rows_scanned": rows_scanned(profile)}
+
+def run_layout(layout: str, rows: int, repeats: int, directory: str) -> dict:
+    # "indexed": id PRIMARY KEY, rows arrive in timestamp order.
+    # "append": no index, rows arrive in timestamp order.
+    # "shuffled": no index, rows arrive in random order.
+    # "sorted": the shuffled table after compaction.
+    database.log_layout = "wide"
+    database.LOG_STORAGE = database.log_storage = "indexed" if layout == "indexed" else "sorted"
+
+    db = duckdb.connect(os.path.join(directory, f"{layout}.duckdb"))
+    create_serial_sequence(db)
+    create_wide_log(db)
+
+    result = {"insert_seconds": populate(db, rows, shuffled=layout in ("shuffled", "sorted"))}
+    result["insert_rows_per_second"] = rows / result["insert_seconds"]
+    if layout == "sorted":
+        start = time.perf_counter()
+        sort_log_table(db)
+        result["compaction_seconds"] = time.perf_counter() - start
+    result["row_group_disorder"] = log_disorder(db)
+
+    profile_path = os.path.join(directory, f"{layout}.profile.json")
+    result["windows"] = {window: scan(db, window, repeats, profile_path) for window in WINDOWS}
+    db.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Insert throughput and scan time versus window size for indexed and sorted log storage.")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="rows per layout, e.g. 100000000")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--layouts", nargs="+", default=["indexed", "append", "shuffled", "sorted"])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = {"rows": args.rows, "duckdb": duckdb.__version__, "layouts": {}}
+    for layout in args.layouts:
+        results["layouts"][layout] = run_layout(layout, args.rows, args.repeats, directory)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
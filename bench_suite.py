@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+import duckdb
+import httpx
+from fastapi import FastAPI
+from user_agents import parse
+
+import crud
+from cache import query_cache
+from database import connection_manager, create_serial_sequence, init_zwischen_db, rebuild_rollups
+from faker_script import ENDPOINTS, METHODS, TrafficGenerator, run_load
+from middleware import ZwischenMiddleware, ZwischenASGIMiddleware, startup, shutdown
+from models import LogRecord
+from utils import UserAgentClassifier, geoip_resolver, retrieve_geoloc
+
+MODES = ["day", "month", "alltime"]
+QUERIES = [name for name in dir(crud) if name.startswith("requests_by_")]
+
+def build_app(middleware_class=None) -> FastAPI:
+    app = FastAPI()
+    if middleware_class is not None:
+        app.add_middleware(middleware_class)
+
+    for endpoint in ENDPOINTS:
+        @app.api_route(endpoint, methods=METHODS)
+        async def handler():
+            return {"message": "ok"}
+
+    return app
+
+def forwarded_client(app):
+    """
+    Uses X-Forwarded-For as the client address, so the generator's IP mix reaches the middleware.
+    """
+    async def wrapper(scope, receive, send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    scope = {**scope, "client": (value.decode("latin-1"), 5000)}
+                    break
+        await app(scope, receive, send)
+    return wrapper
+
+async def bench_http(args) -> Dict:
+    results = {}
+    for name, middleware_class in [
+        ("no_middleware", None),
+        ("base_http_middleware", ZwischenMiddleware),
+        ("asgi_middleware", ZwischenASGIMiddleware)
+    ]:
+        generator = TrafficGenerator(args.ips, args.zipf, args.seed)
+        transport = httpx.ASGITransport(app=forwarded_client(build_app(middleware_class)))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def send(method: str, endpoint: str, headers: Dict[str, str]) -> int:
+                return (await client.request(method, endpoint, headers=headers)).status_code
+
+            # Warm up routing, caches and the ingestion writer before measuring.
+            await run_load(send, generator, 0, args.concurrency, 1.0)
+            results[name] = await run_load(send, generator, args.rate, args.concurrency, args.duration)
+    return results
+
+async def timed(fn: Callable[[], Awaitable], repeats: int, setup: Optional[Callable[[], None]] = None) -> Dict:
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - start)
+    return {"median_ms": statistics.median(timings) * 1000, "min_ms": min(timings) * 1000}
+
+async def cold_and_warm(fn: Callable[[], Awaitable], repeats: int) -> Dict:
+    """
+    Times a dashboard query with an empty result cache (the database work) and then served from it.
+    """
+    return {"cold": await timed(fn, repeats, query_cache.clear), "warm": await timed(fn, repeats)}
+
+def throughput(count: int, elapsed: float) -> Dict:
+    return {"operations": count, "per_second": count / elapsed, "mean_us": elapsed / count * 1e6}
+
+def records(generator: TrafficGenerator, count: int) -> List[LogRecord]:
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    batch = []
+    for _ in range(count):
+        method, endpoint, headers = generator.request()
+        batch.append(LogRecord(
+            headers["X-Forwarded-For"], method, endpoint, 200, now, None, None, None, headers["Referer"],
+            headers["User-Agent"], 1_000_000, 512
+        ))
+    return batch
+
+async def bench_ingest(generator: TrafficGenerator, db: duckdb.DuckDBPyConnection, count: int) -> Dict:
+    batch = records(generator, count)
+
+    start = time.perf_counter()
+    for record in batch:
+        await crud.insert_log(record.ip, record.method, record.endpoint, record.status_code, record.timestamp,
+                              "Chrome", "Windows", "desktop", record.referrer, db)
+    insert_log = throughput(count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for offset in range(0, count, 500):
+        await crud.insert_logs(batch[offset:offset + 500], db)
+    insert_logs = throughput(count, time.perf_counter() - start)
+
+    return {"insert_log": insert_log, "insert_logs_batch_500": insert_logs}
+
+async def bench_geoip(generator: TrafficGenerator, count: int) -> Dict:
+    if not os.path.exists(geoip_resolver.db_path):
+        return {"error": f"{geoip_resolver.db_path} not found"}
+
+    ips = [generator.ip() for _ in range(count)]
+    geoip_resolver.close()
+    start = time.perf_counter()
+    for ip in ips:
+        await retrieve_geoloc(ip)
+    cold = throughput(count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for ip in ips:
+        await retrieve_geoloc(ip)
+    warm = throughput(count, time.perf_counter() - start)
+    return {"first_pass": cold, "second_pass": warm, "cache": geoip_resolver.stats()}
+
+def bench_user_agents(generator: TrafficGenerator, count: int) -> Dict:
+    user_agents = [generator.user_agent() for _ in range(count)]
+
+    start = time.perf_counter()
+    for user_agent in user_agents:
+        parse(user_agent)
+    uncached = throughput(count, time.perf_counter() - start)
+
+    classifier = UserAgentClassifier()
+    start = time.perf_counter()
+    for user_agent in user_agents:
+        classifier.classify(user_agent)
+    cached = throughput(count, time.perf_counter() - start)
+    return {"user_agents_parse": uncached, "classifier": cached}
+
+def populate(db: duckdb.DuckDBPyConnection, rows: int) -> float:
+    """
+    Fills log with `rows` synthetic requests over the past year (Zipf-like IPs and referrers,
+    skewed UA/location mix) and rebuilds the rollups from it.
+    """
+    start = time.perf_counter()
+    db.execute("""
+        INSERT INTO log
+        SELECT nextval('serial'),
+               current_timestamp::TIMESTAMP - to_seconds(CAST(hash(i) % 31536000 AS BIGINT)),
+               ['GET', 'GET', 'GET', 'POST', 'PUT'][1 + CAST(hash(i + 1) % 5 AS INTEGER)],
+               '10.' || CAST(pow(hash(i + 2) % 1000000 / 1e6, 4) * 250 AS INTEGER) || '.'
+                     || CAST(hash(i + 3) % 250 AS INTEGER) || '.1',
+               ['London', 'Paris', 'Berlin', 'Mumbai', 'Tokyo'][1 + CAST(hash(i + 4) % 5 AS INTEGER)],
+               ['United Kingdom', 'France', 'Germany', 'India', 'Japan'][1 + CAST(hash(i + 4) % 5 AS INTEGER)],
+               51.5 + CAST(hash(i + 4) % 5 AS INTEGER), -0.1 + CAST(hash(i + 4) % 5 AS INTEGER),
+               '/endpoint/' || CAST(pow(hash(i + 5) % 1000000 / 1e6, 3) * 50 AS INTEGER),
+               CASE WHEN hash(i + 6) % 50 = 0 THEN 500 WHEN hash(i + 6) % 10 = 0 THEN 404 ELSE 200 END,
+               ['Chrome', 'Chrome', 'Safari', 'Firefox', 'Edge'][1 + CAST(hash(i + 7) % 5 AS INTEGER)],
+               ['Windows', 'iOS', 'Android', 'Mac OS X', 'Linux'][1 + CAST(hash(i + 8) % 5 AS INTEGER)],
+               ['desktop', 'desktop', 'mobile', 'mobile', 'tablet'][1 + CAST(hash(i + 9) % 5 AS INTEGER)],
+               CASE WHEN hash(i + 10) % 2 = 0 THEN 'unknown'
+                    ELSE 'https://ref' || CAST(pow(hash(i + 11) % 1000000 / 1e6, 4) * 1000 AS INTEGER) || '.example/' END,
+               CAST(hash(i + 12) % 200000000 AS BIGINT),
+               CAST(hash(i + 13) % 100000 AS BIGINT),
+               1.0
+        FROM range($rows) r(i)
+    """, {"rows": rows})
+    rebuild_rollups(db)
+    db.execute("CHECKPOINT")
+    return time.perf_counter() - start
+
+async def bench_queries(db: duckdb.DuckDBPyConnection, repeats: int) -> Dict:
+    results = {}
+    for name in QUERIES:
+        query = getattr(crud, name)
+        results[name] = {mode: await cold_and_warm(lambda: query(10, mode, db), repeats) for mode in MODES}
+    results["number_of_requests"] = {mode: await cold_and_warm(lambda: crud.number_of_requests(mode, db), repeats) for mode in MODES}
+    # Filtered queries can't use the rollups and scan the raw log.
+    results["top_n_filtered"] = {
+        mode: await cold_and_warm(lambda: crud.top_n(["endpoint", "browser"], 10, mode, db, filters={"country": "India"}), repeats)
+        for mode in MODES
+    }
+    return results
+
+async def bench_micro(args, directory: str) -> Dict:
+    generator = TrafficGenerator(args.ips, args.zipf, args.seed)
+    results = {
+        "geoip": await bench_geoip(generator, args.operations),
+        "user_agents": bench_user_agents(generator, args.operations),
+        "tables": {}
+    }
+
+    for rows in args.sizes:
+        connection_manager.close()
+        connection_manager.database = os.path.join(directory, f"micro_{rows}.duckdb")
+        db = connection_manager.writer
+        create_serial_sequence(db)
+        init_zwischen_db()
+
+        table = {"populate_seconds": populate(db, rows)}
+        table["queries"] = await bench_queries(connection_manager.cursor(), args.repeats)
+        table["ingest"] = await bench_ingest(generator, db, args.operations)
+        results["tables"][str(rows)] = table
+    connection_manager.close()
+    return results
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def main():
+    parser = argparse.ArgumentParser(description="Zwischen benchmark suite: HTTP overhead of the middleware and micro-benchmarks, as JSON.")
+    parser.add_argument("--suite", nargs="+", choices=["http", "micro"], default=["http", "micro"])
+    parser.add_argument("--rate", type=float, default=0, help="offered requests per second; 0 for closed loop")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per HTTP variant")
+    parser.add_argument("--ips", type=int, default=10000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000_000], help="synthetic log sizes, e.g. 1000000 10000000 100000000")
+    parser.add_argument("--operations", type=int, default=2000, help="operations per ingest/GeoIP/UA micro-benchmark")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per query micro-benchmark")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "duckdb": duckdb.__version__,
+        "cpu_count": os.cpu_count(),
+        "arguments": vars(args)
+    }
+
+    if "http" in args.suite:
+        connection_manager.database = os.path.join(directory, "http.duckdb")
+        await startup()
+        report["http"] = await bench_http(args)
+        await shutdown()
+
+    if "micro" in args.suite:
+        report["micro"] = await bench_micro(args, directory)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    asyncio.run(main())
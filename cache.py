@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+from models import LogRecord
+from storage import window_start
+
+logger = logging.getLogger(__name__)
+
+# Seconds a result may be served for, per window. Long windows barely move between refreshes.
+DEFAULT_TTLS = {
+    "hour": 5.0,
+    "day": 30.0,
+    "week": 60.0,
+    "month": 300.0,
+    "year": 900.0,
+    "alltime": 900.0
+}
+
+class CacheEntry:
+    __slots__ = ("value", "mode", "window", "expires", "total", "drift", "patchable")
+
+    def __init__(self, value: Any, mode: str, ttl: float, total: float, patchable: bool):
+        self.value = value
+        self.mode = mode
+        self.window = window_start(mode)
+        self.expires = time.monotonic() + ttl
+        self.total = total
+        self.drift = 0.0
+        self.patchable = patchable
+
+class QueryCache:
+    """
+    Result cache for dashboard queries, keyed by (query, dimensions, mode, n, ...).
+
+    Entries expire after a per-window TTL and as soon as their window rolls over (e.g. a new
+    day starts for mode "day"). Writers bracket every batch with `begin_write` and `end_write`;
+    once a batch is committed, request counts are patched exactly, while top-n results, which
+    can't be patched without the full distribution, are dropped once the weight logged into
+    their window since they were computed exceeds `max_drift` of the weight they cover. A result computed while a batch
+    was being written may or may not contain it, so it is returned but not cached. Concurrent
+    misses for the same key share a single computation.
+
+    args: ttls (Dict[str, float]), max_drift (float), max_entries (int)
+    """
+    def __init__(self, ttls: Dict[str, float] = DEFAULT_TTLS, max_drift: float = 0.01, max_entries: int = 1024):
+        self.ttls = ttls
+        self.max_drift = max_drift
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[Hashable, CacheEntry] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._writes = 0
+
+    def _lookup(self, key: Hashable) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry.expires or window_start(entry.mode) != entry.window:
+                del self._entries[key]
+                return None
+            return entry
+
+    def _store(self, key: Hashable, entry: CacheEntry, generation: Optional[int]) -> None:
+        with self._lock:
+            if generation != self._generation:
+                # A write began or ended while the query ran.
+                return
+            if len(self._entries) >= self.max_entries:
+                # Evict whatever expires first.
+                del self._entries[min(self._entries, key=lambda k: self._entries[k].expires)]
+            self._entries[key] = entry
+
+    async def get(self, key: Hashable, mode: str, compute: Callable[[], Awaitable[Dict]],
+                  total: Optional[Callable[[Dict], float]] = None) -> Dict:
+        """
+        Returns the cached result for `key`, or awaits `compute()` once for all concurrent callers.
+        Results containing "error" are not cached.
+
+        args: key (Hashable), mode (str), compute (Callable[[], Awaitable[Dict]]),
+              total (Optional[Callable[[Dict], float]]): weight a result covers, used for drift;
+              None marks a {"count": ...} result that is patched in place instead
+        returns: Dict
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            if entry.patchable:
+                return {"count": round(entry.value["count"] + entry.drift)}
+            return entry.value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.hits += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        with self._lock:
+            generation = None if self._writes else self._generation
+        try:
+            result = await compute()
+            if "error" not in result and mode in self.ttls and generation is not None:
+                patchable = total is None
+                weight = result["count"] if patchable else total(result)
+                self._store(key, CacheEntry(result, mode, self.ttls[mode], weight, patchable), generation)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case no other caller was waiting on it.
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def begin_write(self) -> None:
+        """
+        Called before a batch is written. Until the matching `end_write`, results aren't cached.
+        """
+        with self._lock:
+            self._generation += 1
+            self._writes += 1
+
+    def end_write(self, records: Optional[List[LogRecord]] = None) -> None:
+        """
+        Called once the batch is committed, with its stored records, or rolled back, without.
+        Patches request counts and drops top-n entries that drifted too far.
+
+        args: records (Optional[List[LogRecord]])
+        returns: None
+        """
+        timestamps = [(str(record.timestamp), record.sample_weight) for record in records or []]
+        weights: Dict[str, float] = {}
+        with self._lock:
+            self._generation += 1
+            self._writes -= 1
+            if not timestamps:
+                return
+            for key, entry in list(self._entries.items()):
+                # Timestamps are "YYYY-MM-DD HH:MM:SS" strings, so the window check is a string comparison.
+                start = str(entry.window) if entry.window is not None else ""
+                if start not in weights:
+                    weights[start] = sum(weight for timestamp, weight in timestamps if timestamp >= start)
+                weight = weights[start]
+                if not weight:
+                    continue
+                entry.drift += weight
+                if not entry.patchable and entry.drift > self.max_drift * max(entry.total, 1.0):
+                    del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """
+        Returns entry count and hit/miss counters.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+query_cache = QueryCache()
@@ -0,0 +1,123 @@
+import log_config
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+import orjson
+from datetime import datetime
+from typing import Dict
+import crud
+from database import connection_manager
+from ingestion import FRAME_HEADER, OVERFLOW_POLICY, LogIngestionQueue, decode_batch, query_socket_path
+from middleware import startup, shutdown
+from sketches import SketchStore, sketch_store
+from spill import SPILL_DIR, SpillLog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/tmp/zwischen-collector.sock"
+
+class CollectorServer:
+    """
+    Single writer process for multi-worker deployments. DuckDB allows only one read-write
+    process per file, so workers started with ZWISCHEN_COLLECTOR_SOCKET ship their batches
+    here over a Unix socket, and this process batch-inserts them into zwischen.duckdb.
+    Only this process sees every worker's records and can open the database, so it also
+    keeps the sketches and answers the workers' analytics queries on a second socket
+    (see CollectorQueries).
+
+    args: socket_path (str), queue (LogIngestionQueue): local queue writing to DuckDB,
+          sketches (SketchStore): store updated with every stored batch
+    """
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, queue: LogIngestionQueue = None,
+                 sketches: SketchStore = sketch_store):
+        self.socket_path = socket_path
+        self.sketches = sketches
+        self.queue = queue or LogIngestionQueue(
+            max_size=100000, batch_size=5000, listeners=[sketches.record_batch],
+            policy=OVERFLOW_POLICY, spill=SpillLog(SPILL_DIR) if SPILL_DIR else None
+        )
+        self._server = None
+        self._query_server = None
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                # With policy "block", a full queue stops reading from the socket, which
+                # pushes back on the worker's sink.
+                for record in decode_batch(await reader.readexactly(length)):
+                    await self.queue.put(record)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            logger.error(f"Collector Error: {e}")
+        finally:
+            writer.close()
+
+    async def _answer(self, request: Dict):
+        if request["query"] == "uniques":
+            return self.sketches.uniques(request["dimension"], request["mode"])
+        if request["query"] == "top_k":
+            return self.sketches.top_k(request["dimension"], request["mode"], request["k"])
+        if request["query"] == "time_series":
+            return await crud.time_series(
+                datetime.fromisoformat(request["start"]), datetime.fromisoformat(request["end"]),
+                request["granularity"], connection_manager.cursor(), include_latency=request["include_latency"]
+            )
+        if request["query"] == "top_n":
+            result = await crud.top_n(request["dimensions"], request["n"], request["mode"], connection_manager.cursor(), result_format="numpy")
+            if "error" in result:
+                return result
+            return {"requests": crud.json_columns(result["requests"])}
+        raise ValueError(f"Unknown query {request['query']!r}")
+
+    async def _handle_query(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            response = {"result": await self._answer(orjson.loads(await reader.readline()))}
+        except Exception as e:
+            logger.error(f"Worker query failed: {e}")
+            response = {"error": str(e)}
+        try:
+            writer.write(orjson.dumps(response, option=orjson.OPT_SERIALIZE_NUMPY))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        await startup(self.queue)
+        for path in (self.socket_path, query_socket_path(self.socket_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, path=self.socket_path)
+        self._query_server = await asyncio.start_unix_server(self._handle_query, path=query_socket_path(self.socket_path))
+        logger.info(f"Zwischen collector listening on {self.socket_path}.")
+
+    async def stop(self) -> None:
+        for server in (self._server, self._query_server):
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+        self._server = self._query_server = None
+        await shutdown(self.queue)
+        for path in (self.socket_path, query_socket_path(self.socket_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+async def main(socket_path: str) -> None:
+    server = CollectorServer(socket_path)
+    await server.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await stop.wait()
+    await server.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else os.getenv("ZWISCHEN_COLLECTOR_SOCKET", DEFAULT_SOCKET)))
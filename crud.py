@@ -1,15 +1,24 @@
 import duckdb
 import logging
-from typing import Dict, Literal
-from utils import validate_ip, retrieve_geoloc
-from models import LocationData
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, List, Literal, Optional, Tuple
+import pyarrow as pa
+import database
+from cache import query_cache
+from database import ROLLUP_RETENTION_DAYS, ROLLUP_TABLES, ROLLUP_DIMENSIONS, insert_batch, query_executor, write_executor
+from dimensions import dimension_interner
+from enrichment import GEO_DIMENSIONS, geo_enricher
+from storage import log_archiver, truncate, window_filter, window_params, window_start
+from utils import validate_ip, retrieve_geoloc, user_agent_classifier
+from models import LocationData, LogRecord
 
 logger = logging.getLogger(__name__)
 
 async def insert_log(ip: str, method: str, endpoint: str, status_code: str, timestamp: str, browser: str, os: str, device: str, referrer: str, db: duckdb.DuckDBPyConnection) -> Dict:
     try:
         if validate_ip(ip):
-            locdata: LocationData = await retrieve_geoloc(ip)
+            locdata: LocationData = await retrieve_geoloc(ip) or LocationData()
             
             query = """
             INSERT INTO Log
@@ -48,30 +57,100 @@ async def insert_log(ip: str, method: str, endpoint: str, status_code: str, time
         logger.error(f"Unexpected Error: {e}")
         return {"error": str(e)}
 
-async def number_of_requests(mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict[str, int]:
+async def insert_logs(records: List[LogRecord], db: duckdb.DuckDBPyConnection) -> Dict:
+    """
+    Inserts a batch of log records as an Arrow table with one INSERT ... SELECT and folds
+    them into the rollup tables in the same transaction, run on the writer thread.
+    Records captured with deferred UA parsing are classified on the writer thread while
+    the Arrow table is built, and the batch's distinct IPs are geolocated by geo_enricher
+    unless enrichment is deferred.
+    With the compact schema, UA, location and referrer values are interned into their
+    dimension tables and only their keys are written to log_compact.
+
+    args: records (List[LogRecord]), db (duckdb.DuckDBPyConnection)
+    returns: Dict with the number of inserted and skipped records and the stored records
+    """
     try:
-        if mode == "month":
-            query = "SELECT COUNT(*) FROM log WHERE timestamp >= date_trunc('month', current_timestamp)"
-        elif mode == "day":
-            query = "SELECT COUNT(*) FROM log WHERE timestamp >= date_trunc('day', current_timestamp)"
-        elif mode == "hour":
-            query = "SELECT COUNT(*) FROM log WHERE timestamp >= date_trunc('hour', current_timestamp)"
-        elif mode == "week":
-            query = "SELECT COUNT(*) FROM log WHERE timestamp >= date_trunc('week', current_timestamp)"
-        elif mode == "year":
-            query = "SELECT COUNT(*) FROM log WHERE timestamp >= date_trunc('year', current_timestamp)"
-        elif mode == "alltime":
-            query = "SELECT COUNT(*) FROM Log"
-        else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
-
-        result = db.execute(query).fetchone()
-        
-        return {
-            "count": result[0]
-        }
-
+        compact = database.log_layout == "compact"
+
+        valid = [record for record in records if validate_ip(record.ip)]
+        skipped = len(records) - len(valid)
+        # One lookup per distinct IP in the batch; deferred rows are located later by the backfill.
+        deferred = geo_enricher.deferred
+        locations = {} if deferred else await geo_enricher.resolve(record.ip for record in valid)
+        unresolved = LocationData.model_construct(city=None, country=None, latitude=None, longitude=None)
+
+        if valid:
+            def build_batch() -> pa.Table:
+                user_agents = [
+                    user_agent_classifier.classify(record.user_agent) if record.user_agent is not None
+                    else (record.browser, record.os, record.device)
+                    for record in valid
+                ]
+                located = [locations.get(record.ip, unresolved) for record in valid]
+                columns = {
+                    "ip": pa.array([record.ip for record in valid], pa.string()),
+                    "timestamp": pa.array([record.timestamp for record in valid], pa.string()).cast(pa.timestamp("s")),
+                    "city": pa.array([l.city for l in located], pa.string()),
+                    "country": pa.array([l.country for l in located], pa.string()),
+                    "latitude": pa.array([l.latitude for l in located], pa.float64()),
+                    "longitude": pa.array([l.longitude for l in located], pa.float64()),
+                    "method": pa.array([record.method for record in valid], pa.string()),
+                    "endpoint": pa.array([record.endpoint for record in valid], pa.string()),
+                    "status_code": pa.array([record.status_code for record in valid], pa.int32()),
+                    "browser": pa.array([ua[0] for ua in user_agents], pa.string()),
+                    "os": pa.array([ua[1] for ua in user_agents], pa.string()),
+                    "device": pa.array([ua[2] for ua in user_agents], pa.string()),
+                    "referrer": pa.array([record.referrer for record in valid], pa.string()),
+                    "duration_ns": pa.array([record.duration_ns for record in valid], pa.int64()),
+                    "response_size": pa.array([record.response_size for record in valid], pa.int64()),
+                    "sample_weight": pa.array([record.sample_weight for record in valid], pa.float64())
+                }
+                if compact:
+                    columns["geo_id"] = pa.array([
+                        None if deferred else dimension_interner.intern("geo_dim", (l.city, l.country, l.latitude, l.longitude))
+                        for l in located
+                    ], pa.int64())
+                    columns["ua_id"] = pa.array([dimension_interner.intern("ua_dim", ua) for ua in user_agents], pa.int64())
+                    columns["referrer_id"] = pa.array([
+                        dimension_interner.intern("referrer_dim", (record.referrer,)) for record in valid
+                    ], pa.int64())
+                return pa.table(columns)
+
+            # Deferred rows are counted under their location once the backfill has found it.
+            rollup_dimensions = [d for d in ROLLUP_DIMENSIONS if not (deferred and d in GEO_DIMENSIONS)]
+
+            def write():
+                # Built on the writer thread: classifying deferred user agents can take a while.
+                db.register("log_batch", build_batch())
+                # Dashboard queries overlapping the write aren't cached; committed rows are patched in.
+                query_cache.begin_write()
+                stored = None
+                db.begin()
+                try:
+                    if compact:
+                        dimension_interner.flush(db)
+                    insert_batch(db, "log_batch", rollup_dimensions)
+                    db.commit()
+                    stored = valid
+                except duckdb.Error:
+                    db.rollback()
+                    if compact:
+                        dimension_interner.rollback()
+                    raise
+                finally:
+                    db.unregister("log_batch")
+                    query_cache.end_write(stored)
+                if compact:
+                    dimension_interner.commit()
+
+            await write_executor.run(write)
+
+        if skipped:
+            logger.warning(f"Skipped {skipped} records with invalid IPs")
+        logger.debug(f"Inserted batch of {len(valid)} records")
+
+        return {"inserted": len(valid), "skipped": skipped, "records": valid}
     except duckdb.Error as e:
         logger.error(f"Database Error: {e}")
         return {"error": str(e)}
@@ -79,68 +158,94 @@ async def number_of_requests(mode: Literal["month", "day", "hour", "week", "year
         logger.error(f"Unexpected Error: {e}")
         return {"error": str(e)}
 
-async def requests_by_ip(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+# Coarsest rollup whose buckets align with the start of each window.
+ROLLUP_FOR_MODE = {
+    "hour": ROLLUP_TABLES["hour"],
+    "day": ROLLUP_TABLES["day"],
+    "week": ROLLUP_TABLES["day"],
+    "month": ROLLUP_TABLES["day"],
+    "year": ROLLUP_TABLES["day"],
+    "alltime": ROLLUP_TABLES["day"]
+}
+
+@lru_cache(maxsize=256)
+def _top_n_query(dimensions: Tuple[str, ...], mode: str, filter_dimensions: Tuple[str, ...], source: str = "log") -> str:
+    """
+    Builds the SQL for a top-N query over one or more dimensions. Statements are
+    cached per shape so repeated widgets reuse the same text and only bind parameters.
+
+    Unfiltered queries are answered from the rollup table; filtered ones need the raw
+    log (hot table plus archive, given as `source`) and compute every dimension in one
+    scan with GROUPING SETS. Both return
+    (dimension, value, request_count) rows, ranked within each dimension.
+    """
+    if not filter_dimensions:
+        return f"""
+            SELECT dimension, value, CAST(ROUND(SUM(request_count)) AS BIGINT) AS request_count
+            FROM {ROLLUP_FOR_MODE[mode]}
+            WHERE dimension IN ({", ".join(["?"] * len(dimensions))}) {window_filter(mode)}
+            GROUP BY dimension, value
+            QUALIFY row_number() OVER (PARTITION BY dimension ORDER BY SUM(request_count) DESC) <= ?
+            ORDER BY dimension, SUM(request_count) DESC
+        """
+
+    columns = sorted(set(dimensions) | set(filter_dimensions))
+    projection = ", ".join(f"COALESCE({ROLLUP_DIMENSIONS[d]}, 'Unknown') AS {d}" for d in columns)
+    filters = " ".join(f"AND {d} = ?" for d in filter_dimensions)
+    dimension_name = " ".join(f"WHEN GROUPING({d}) = 0 THEN '{d}'" for d in dimensions)
+    return f"""
+        SELECT CASE {dimension_name} END AS dimension,
+               COALESCE({", ".join(dimensions)}) AS value,
+               CAST(ROUND(SUM(sample_weight)) AS BIGINT) AS request_count
+        FROM (SELECT {projection}, sample_weight FROM {source} WHERE TRUE {window_filter(mode, "timestamp")})
+        WHERE TRUE {filters}
+        GROUP BY GROUPING SETS ({", ".join(f"({d})" for d in dimensions)})
+        QUALIFY row_number() OVER (PARTITION BY dimension ORDER BY request_count DESC) <= ?
+        ORDER BY dimension, request_count DESC
+    """
+
+def _format_row(dimension: str, value: str, request_count: int) -> Dict:
+    if dimension == "coordinates":
+        latitude, longitude = value.split(",")
+        return {"latitude": float(latitude), "longitude": float(longitude), "request_count": request_count}
+    if dimension == "status_code":
+        return {"status_code": int(value), "request_count": request_count}
+    return {dimension: value, "request_count": request_count}
+
+async def top_n(dimensions: List[str], n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection, filters: Optional[Dict[str, str]] = None, result_format: Literal["dicts", "arrow", "numpy"] = "dicts") -> Dict:
+    """
+    Returns the n most frequent values of each requested dimension within a time window,
+    answered with a single query regardless of how many dimensions are requested.
+
+    args: dimensions (List[str]): any of ip, method, city, country, coordinates, status_code,
+              os, browser, device, referrer, endpoint
+          n (int), mode (str), db (duckdb.DuckDBPyConnection)
+          filters (Optional[Dict[str, str]]): dimension -> value equality filters, e.g. {"country": "India"}
+          result_format (str): "dicts" for per-dimension lists of row dicts; "arrow" or "numpy" return the
+              long (dimension, value, request_count) result as a pyarrow.Table or dict of NumPy arrays
+              straight from DuckDB, without building Python objects per row
+    returns: Dict with the result under "requests"
+    """
     try:
-        if mode == "month":
-            query = """
-                SELECT ip, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY ip 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT ip, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY ip 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT ip, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY ip 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT ip, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY ip 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT ip, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY ip 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT ip, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY ip 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
+        filters = filters or {}
+        unknown = [d for d in list(dimensions) + list(filters) if d not in ROLLUP_DIMENSIONS]
+        if unknown:
+            logger.warning(f"Invalid dimensions: {unknown}")
+            return {"error": f"Invalid dimensions specified: {', '.join(unknown)}"}
+        if mode not in ROLLUP_FOR_MODE:
             logger.warning(f"Invalid mode: {mode}")
             return {"error": "Invalid mode specified"}
-
-        result = db.execute(query, [n]).fetchall()        
-        requests = [{"ip": row[0], "request_count": row[1]} for row in result]        
-        return {"requests": requests}
+        if result_format not in ("dicts", "arrow", "numpy"):
+            logger.warning(f"Invalid result format: {result_format}")
+            return {"error": "Invalid result format specified"}
+
+        dimensions = tuple(dict.fromkeys(dimensions))
+        key = ("top_n", dimensions, n, mode, tuple(sorted(filters.items())), result_format)
+        return await query_cache.get(
+            key, mode,
+            lambda: _top_n(dimensions, n, mode, db, filters, result_format),
+            total=lambda result: _top_n_weight(result, result_format) / len(dimensions)
+        )
 
     except duckdb.Error as e:
         logger.error(f"Database Error: {e}")
@@ -149,139 +254,28 @@ async def requests_by_ip(n: int, mode: Literal["month", "day", "hour", "week", "
         logger.error(f"Unexpected Error: {e}")
         return {"error": str(e)}
 
-async def requests_by_method(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+async def _top_n(dimensions: Tuple[str, ...], n: int, mode: str, db: duckdb.DuckDBPyConnection, filters: Dict[str, str], result_format: str) -> Dict:
     try:
-        if mode == "month":
-            query = """
-                SELECT method, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY method 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT method, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY method 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT method, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY method 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT method, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY method 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT method, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY method 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT method, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY method 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
+        filter_dimensions = tuple(sorted(filters))
+        if filter_dimensions:
+            query = _top_n_query(dimensions, mode, filter_dimensions, log_archiver.log_source(window_start(mode)))
         else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
+            query = _top_n_query(dimensions, mode, filter_dimensions)
 
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"method": row[0], "request_count": row[1]} for row in result]
-        
-        return {"requests": requests}
-
-    except duckdb.Error as e:
-        logger.error(f"Database Error: {e}")
-        return {"error": str(e)}
-    except Exception as e:
-        logger.error(f"Unexpected Error: {e}")
-        return {"error": str(e)}
-
-async def requests_by_city(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
-    try:
-        if mode == "month":
-            query = """
-                SELECT city, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY city 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT city, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY city 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT city, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY city 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT city, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY city 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT city, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY city 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT city, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY city 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
+        if filter_dimensions:
+            params = window_params(mode) + [filters[d] for d in filter_dimensions] + [n]
         else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
+            params = list(dimensions) + window_params(mode) + [n]
+        if result_format == "arrow":
+            return {"requests": await query_executor.fetch(db, query, params, "fetch_arrow_table")}
+        if result_format == "numpy":
+            return {"requests": await query_executor.fetch(db, query, params, "fetchnumpy")}
+
+        result = await query_executor.fetch(db, query, params)
+        requests = {d: [] for d in dimensions}
+        for dimension, value, request_count in result:
+            requests[dimension].append(_format_row(dimension, value, request_count))
 
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"city": row[0], "request_count": row[1]} for row in result]
-        
         return {"requests": requests}
 
     except duckdb.Error as e:
@@ -291,69 +285,67 @@ async def requests_by_city(n: int, mode: Literal["month", "day", "hour", "week",
         logger.error(f"Unexpected Error: {e}")
         return {"error": str(e)}
 
-async def requests_by_country(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+def _top_n_weight(result: Dict, result_format: str) -> float:
+    # Requests covered by a top-n result, summed over its dimensions.
+    requests = result["requests"]
+    if result_format == "arrow":
+        return float(sum(requests.column("request_count").to_pylist()))
+    if result_format == "numpy":
+        return float(requests["request_count"].sum())
+    return float(sum(row["request_count"] for rows in requests.values() for row in rows))
+
+def json_columns(requests: Dict) -> Dict:
+    """
+    Column-oriented JSON form of a "numpy" top-n result, to be serialized by orjson with
+    OPT_SERIALIZE_NUMPY. Numeric columns serialize straight from the NumPy buffers; string
+    columns are object arrays whose existing str objects are handed over as-is.
+
+    args: requests (Dict): column name -> NumPy array
+    returns: Dict
+    """
+    return {name: array if array.dtype != object else array.tolist() for name, array in requests.items()}
+
+async def latency_percentiles(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection, endpoint: Optional[str] = None) -> Dict:
+    """
+    Returns approximate p50/p90/p99 and exact max latency in milliseconds per endpoint,
+    slowest (by p99) first. Uses DuckDB's t-digest based approx_quantile, so it stays
+    a single streaming pass over the window.
+
+    args: n (int), mode (str), db (duckdb.DuckDBPyConnection), endpoint (Optional[str]): restrict to one endpoint
+    returns: Dict
+    """
     try:
-        if mode == "month":
-            query = """
-                SELECT country, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY country 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT country, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY country 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT country, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY country 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT country, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY country 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT country, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY country 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT country, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY country 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
+        if mode not in ROLLUP_FOR_MODE:
             logger.warning(f"Invalid mode: {mode}")
             return {"error": "Invalid mode specified"}
 
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"country": row[0], "request_count": row[1]} for row in result]
-        
-        return {"requests": requests}
+        query = f"""
+            SELECT endpoint,
+                   CAST(ROUND(SUM(sample_weight)) AS BIGINT) AS request_count,
+                   approx_quantile(duration_ns, [0.5, 0.9, 0.99]) AS quantiles,
+                   MAX(duration_ns) AS max_ns
+            FROM {log_archiver.log_source(window_start(mode))}
+            WHERE duration_ns IS NOT NULL {window_filter(mode, "timestamp")}
+            {"AND endpoint = ?" if endpoint is not None else ""}
+            GROUP BY endpoint
+            ORDER BY quantiles[3] DESC
+            LIMIT ?
+        """
+        params = window_params(mode) + ([endpoint, n] if endpoint is not None else [n])
+        result = await query_executor.fetch(db, query, params)
+
+        latencies = [
+            {
+                "endpoint": row[0],
+                "request_count": row[1],
+                "p50_ms": row[2][0] / 1e6,
+                "p90_ms": row[2][1] / 1e6,
+                "p99_ms": row[2][2] / 1e6,
+                "max_ms": row[3] / 1e6
+            }
+            for row in result
+        ]
+        return {"latencies": latencies}
 
     except duckdb.Error as e:
         logger.error(f"Database Error: {e}")
@@ -362,69 +354,89 @@ async def requests_by_country(n: int, mode: Literal["month", "day", "hour", "wee
         logger.error(f"Unexpected Error: {e}")
         return {"error": str(e)}
 
-async def requests_by_coordinates(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+TIME_SERIES_INTERVALS = {
+    "minute": "INTERVAL 1 MINUTE",
+    "hour": "INTERVAL 1 HOUR",
+    "day": "INTERVAL 1 DAY",
+    "week": "INTERVAL 1 WEEK",
+    "month": "INTERVAL 1 MONTH"
+}
+
+def _rollup_covers(granularity: str, start: datetime) -> bool:
+    """
+    Whether the rollup of `granularity` still holds buckets from `start` on, given what prune_rollups deletes.
+    """
+    retention = ROLLUP_RETENTION_DAYS[granularity]
+    return retention is None or truncate(start, granularity) >= datetime.utcnow() - timedelta(days=retention)
+
+async def time_series(start: datetime, end: datetime, granularity: Literal["minute", "hour", "day", "week", "month"], db: duckdb.DuckDBPyConnection, include_latency: bool = True) -> Dict:
+    """
+    Returns request counts, server error (5xx) rates and, optionally, p50/p99 latency for every
+    bucket in [start, end), with empty buckets filled with zero counts.
+
+    Without latency, minute/hour/day series starting within that rollup's retention are served
+    from the rollup tables; otherwise the raw log and archive are aggregated in a single pass.
+
+    args: start (datetime), end (datetime), granularity (str), db (duckdb.DuckDBPyConnection), include_latency (bool)
+    returns: Dict
+    """
     try:
-        if mode == "month":
-            query = """
-                SELECT latitude, longitude, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY latitude, longitude 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT latitude, longitude, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY latitude, longitude 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT latitude, longitude, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY latitude, longitude 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT latitude, longitude, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY latitude, longitude 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT latitude, longitude, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY latitude, longitude 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT latitude, longitude, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY latitude, longitude 
-                ORDER BY request_count DESC 
-                LIMIT ?
+        if granularity not in TIME_SERIES_INTERVALS:
+            logger.warning(f"Invalid granularity: {granularity}")
+            return {"error": "Invalid granularity specified"}
+
+        if not include_latency and granularity in ROLLUP_TABLES and _rollup_covers(granularity, start):
+            stats = f"""
+                SELECT bucket,
+                       CAST(ROUND(SUM(request_count)) AS BIGINT) AS request_count,
+                       SUM(request_count) FILTER (WHERE CAST(value AS INTEGER) >= 500) AS error_count,
+                       NULL AS p50_ns,
+                       NULL AS p99_ns
+                FROM {ROLLUP_TABLES[granularity]}
+                WHERE dimension = 'status_code' AND bucket >= date_trunc('{granularity}', $start) AND bucket < $end
+                GROUP BY bucket
             """
         else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
+            stats = f"""
+                SELECT date_trunc('{granularity}', timestamp) AS bucket,
+                       CAST(ROUND(SUM(sample_weight)) AS BIGINT) AS request_count,
+                       SUM(sample_weight) FILTER (WHERE status_code >= 500) AS error_count,
+                       approx_quantile(duration_ns, 0.5) AS p50_ns,
+                       approx_quantile(duration_ns, 0.99) AS p99_ns
+                FROM {log_archiver.log_source(truncate(start, granularity))}
+                WHERE timestamp >= date_trunc('{granularity}', $start) AND timestamp < $end
+                GROUP BY bucket
+            """
+
+        query = f"""
+            WITH buckets AS (
+                SELECT unnest(range(date_trunc('{granularity}', $start), $end, {TIME_SERIES_INTERVALS[granularity]})) AS bucket
+            ),
+            stats AS ({stats})
+            SELECT buckets.bucket,
+                   COALESCE(stats.request_count, 0),
+                   COALESCE(stats.error_count, 0),
+                   stats.p50_ns,
+                   stats.p99_ns
+            FROM buckets
+            LEFT JOIN stats ON buckets.bucket = stats.bucket
+            ORDER BY buckets.bucket
+        """
+        result = await query_executor.fetch(db, query, {"start": start, "end": end})
+
+        series = []
+        for bucket, request_count, error_count, p50_ns, p99_ns in result:
+            point = {
+                "bucket": bucket.isoformat(),
+                "request_count": request_count,
+                "error_rate": error_count / request_count if request_count else 0.0
+            }
+            if include_latency:
+                point["p50_ms"] = p50_ns / 1e6 if p50_ns is not None else None
+                point["p99_ms"] = p99_ns / 1e6 if p99_ns is not None else None
+            series.append(point)
 
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"latitude": row[0], "longitude": row[1], "request_count": row[2]} for row in result]
-        
-        return {"requests": requests}
+        return {"series": series}
 
     except duckdb.Error as e:
         logger.error(f"Database Error: {e}")
@@ -433,140 +445,31 @@ async def requests_by_coordinates(n: int, mode: Literal["month", "day", "hour",
         logger.error(f"Unexpected Error: {e}")
         return {"error": str(e)}
 
-async def requests_by_status_code(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
-    try:
-        if mode == "month":
-            query = """
-                SELECT status_code, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY status_code 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT status_code, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY status_code 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT status_code, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY status_code 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT status_code, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY status_code 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT status_code, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY status_code 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT status_code, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY status_code 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
-
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"status_code": row[0], "request_count": row[1]} for row in result]
-        
-        return {"requests": requests}
+async def _requests_by(dimension: str, n: int, mode: str, db: duckdb.DuckDBPyConnection) -> Dict:
+    result = await top_n([dimension], n, mode, db)
+    if "error" in result:
+        return result
+    return {"requests": result["requests"][dimension]}
 
-    except duckdb.Error as e:
-        logger.error(f"Database Error: {e}")
-        return {"error": str(e)}
-    except Exception as e:
-        logger.error(f"Unexpected Error: {e}")
-        return {"error": str(e)}
+async def number_of_requests(mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict[str, int]:
+    if mode not in ROLLUP_FOR_MODE:
+        logger.warning(f"Invalid mode: {mode}")
+        return {"error": "Invalid mode specified"}
+    return await query_cache.get(("number_of_requests", mode), mode, lambda: _number_of_requests(mode, db))
 
-async def requests_by_os(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+async def _number_of_requests(mode: str, db: duckdb.DuckDBPyConnection) -> Dict[str, int]:
     try:
-        if mode == "month":
-            query = """
-                SELECT os, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY os 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT os, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY os 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT os, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY os 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT os, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY os 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT os, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY os 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT os, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY os 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
-
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"os": row[0], "request_count": row[1]} for row in result]
+        # Every request has exactly one method, so summing that dimension counts requests.
+        query = f"""
+            SELECT CAST(ROUND(COALESCE(SUM(request_count), 0)) AS BIGINT)
+            FROM {ROLLUP_FOR_MODE[mode]}
+            WHERE dimension = 'method' {window_filter(mode)}
+        """
+        result = await query_executor.fetch(db, query, window_params(mode), method="fetchone")
         
-        return {"requests": requests}
+        return {
+            "count": result[0]
+        }
 
     except duckdb.Error as e:
         logger.error(f"Database Error: {e}")
@@ -575,286 +478,35 @@ async def requests_by_os(n: int, mode: Literal["month", "day", "hour", "week", "
         logger.error(f"Unexpected Error: {e}")
         return {"error": str(e)}
 
-async def requests_by_browser(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
-    try:
-        if mode == "month":
-            query = """
-                SELECT browser, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY browser 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT browser, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY browser 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT browser, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY browser 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT browser, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY browser 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT browser, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY browser 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT browser, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY browser 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
-
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"browser": row[0], "request_count": row[1]} for row in result]
-        
-        return {"requests": requests}
+async def requests_by_ip(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("ip", n, mode, db)
 
-    except duckdb.Error as e:
-        logger.error(f"Database Error: {e}")
-        return {"error": str(e)}
-    except Exception as e:
-        logger.error(f"Unexpected Error: {e}")
-        return {"error": str(e)}
+async def requests_by_method(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("method", n, mode, db)
 
-async def requests_by_device(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
-    try:
-        if mode == "month":
-            query = """
-                SELECT device, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY device 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT device, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY device 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT device, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY device 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT device, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY device 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT device, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY device 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT device, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY device 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
+async def requests_by_city(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("city", n, mode, db)
 
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"device": row[0], "request_count": row[1]} for row in result]
-        
-        return {"requests": requests}
+async def requests_by_country(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("country", n, mode, db)
 
-    except duckdb.Error as e:
-        logger.error(f"Database Error: {e}")
-        return {"error": str(e)}
-    except Exception as e:
-        logger.error(f"Unexpected Error: {e}")
-        return {"error": str(e)}
+async def requests_by_coordinates(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("coordinates", n, mode, db)
 
-async def requests_by_referrer(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
-    try:
-        if mode == "month":
-            query = """
-                SELECT referrer, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY referrer 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT referrer, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY referrer 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT referrer, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY referrer 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT referrer, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY referrer 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT referrer, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY referrer 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT referrer, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY referrer 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
+async def requests_by_status_code(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("status_code", n, mode, db)
 
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"referrer": row[0], "request_count": row[1]} for row in result]
-        
-        return {"requests": requests}
+async def requests_by_os(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("os", n, mode, db)
 
-    except duckdb.Error as e:
-        logger.error(f"Database Error: {e}")
-        return {"error": str(e)}
-    except Exception as e:
-        logger.error(f"Unexpected Error: {e}")
-        return {"error": str(e)}
+async def requests_by_browser(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("browser", n, mode, db)
 
-async def requests_by_endpoint(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
-    try:
-        if mode == "month":
-            query = """
-                SELECT endpoint, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('month', current_timestamp) 
-                GROUP BY endpoint 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "day":
-            query = """
-                SELECT endpoint, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('day', current_timestamp) 
-                GROUP BY endpoint 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "hour":
-            query = """
-                SELECT endpoint, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('hour', current_timestamp) 
-                GROUP BY endpoint 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "week":
-            query = """
-                SELECT endpoint, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('week', current_timestamp) 
-                GROUP BY endpoint 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "year":
-            query = """
-                SELECT endpoint, COUNT(*) as request_count 
-                FROM log 
-                WHERE timestamp >= date_trunc('year', current_timestamp) 
-                GROUP BY endpoint 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        elif mode == "alltime":
-            query = """
-                SELECT endpoint, COUNT(*) as request_count 
-                FROM log 
-                GROUP BY endpoint 
-                ORDER BY request_count DESC 
-                LIMIT ?
-            """
-        else:
-            logger.warning(f"Invalid mode: {mode}")
-            return {"error": "Invalid mode specified"}
+async def requests_by_device(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("device", n, mode, db)
 
-        result = db.execute(query, [n]).fetchall()
-        requests = [{"endpoint": row[0], "request_count": row[1]} for row in result]
-        
-        return {"requests": requests}
+async def requests_by_referrer(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("referrer", n, mode, db)
 
-    except duckdb.Error as e:
-        logger.error(f"Database Error: {e}")
-        return {"error": str(e)}
-    except Exception as e:
-        logger.error(f"Unexpected Error: {e}")
-        return {"error": str(e)}
\ No newline at end of file
+async def requests_by_endpoint(n: int, mode: Literal["month", "day", "hour", "week", "year", "alltime"], db: duckdb.DuckDBPyConnection) -> Dict:
+    return await _requests_by("endpoint", n, mode, db)
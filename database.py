@@ -1,11 +1,215 @@
+import asyncio
 import duckdb
-from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timedelta
 import logging
+import os
+from typing import Any, Callable, List, Optional
+from dimensions import DEVICE_TYPES, DIMENSION_TABLES, HTTP_METHODS
 
 logger = logging.getLogger(__name__)
 
 DATABASE_FILE = "zwischen.duckdb"
 
+# "wide" stores every dimension inline in log; "compact" stores log_compact with ENUM columns
+# and keys into dimension tables, and exposes the wide columns through a log view.
+LOG_SCHEMA = os.getenv("ZWISCHEN_LOG_SCHEMA", "wide")
+
+# "indexed" keeps `id` as an INTEGER PRIMARY KEY; "sorted" drops the index (and its per-insert
+# ART maintenance) and relies on timestamp order, restored by compact_log, for zone-map pruning.
+LOG_STORAGE = os.getenv("ZWISCHEN_LOG_STORAGE", "indexed")
+
+# Layout and storage of the opened database, set by init_zwischen_db.
+log_layout = LOG_SCHEMA
+log_storage = LOG_STORAGE
+
+ROLLUP_TABLES = {
+    "minute": "log_rollup_minute",
+    "hour": "log_rollup_hour",
+    "day": "log_rollup_day"
+}
+
+# Days of buckets prune_rollups keeps per rollup granularity; None keeps them forever.
+ROLLUP_RETENTION_DAYS = {
+    "minute": 2,
+    "hour": 90,
+    "day": None
+}
+
+# SQL expression producing each rollup dimension's value from a log row.
+ROLLUP_DIMENSIONS = {
+    "ip": "ip",
+    "method": "method",
+    "city": "city",
+    "country": "country",
+    "coordinates": "CAST(latitude AS VARCHAR) || ',' || CAST(longitude AS VARCHAR)",
+    "status_code": "CAST(status_code AS VARCHAR)",
+    "os": "os",
+    "browser": "browser",
+    "device": "device",
+    "referrer": "referrer",
+    "endpoint": "endpoint"
+}
+
+def log_write_table() -> str:
+    """
+    Table that log rows are inserted into and deleted from; `log` itself is a view in compact mode.
+    """
+    return "log_compact" if log_layout == "compact" else "log"
+
+def _table_type(db: duckdb.DuckDBPyConnection, name: str) -> Optional[str]:
+    row = db.execute("SELECT table_type FROM information_schema.tables WHERE table_name = ?", [name]).fetchone()
+    return row[0] if row else None
+
+def _id_column() -> str:
+    return "id INTEGER" if LOG_STORAGE == "sorted" else "id INTEGER PRIMARY KEY"
+
+def has_primary_key(db: duckdb.DuckDBPyConnection, table: str) -> bool:
+    return db.execute(
+        "SELECT COUNT(*) > 0 FROM duckdb_constraints() WHERE table_name = ? AND constraint_type = 'PRIMARY KEY'", [table]
+    ).fetchone()[0]
+
+def create_wide_log(db: duckdb.DuckDBPyConnection) -> None:
+    """
+    Creates the wide log table, with every dimension stored inline, and adds columns
+    missing from older databases.
+
+    args: db (duckdb.DuckDBPyConnection)
+    returns: None
+    """
+    create_log = f"""
+    CREATE TABLE IF NOT EXISTS log (
+        {_id_column()},
+        timestamp TIMESTAMP,
+        method VARCHAR,
+        ip VARCHAR,
+        city VARCHAR,
+        country VARCHAR,
+        latitude DOUBLE,
+        longitude DOUBLE,
+        endpoint VARCHAR,
+        status_code INTEGER,
+        browser VARCHAR,
+        os VARCHAR, 
+        device VARCHAR,
+        referrer VARCHAR,
+        duration_ns BIGINT,
+        response_size BIGINT,
+        sample_weight DOUBLE DEFAULT 1.0
+    )
+    """
+    db.execute(create_log)
+    # Databases created before latency capture lack these columns.
+    db.execute("ALTER TABLE log ADD COLUMN IF NOT EXISTS duration_ns BIGINT")
+    db.execute("ALTER TABLE log ADD COLUMN IF NOT EXISTS response_size BIGINT")
+    db.execute("ALTER TABLE log ADD COLUMN IF NOT EXISTS sample_weight DOUBLE DEFAULT 1.0")
+
+def create_compact_log(db: duckdb.DuckDBPyConnection) -> None:
+    """
+    Creates the compact log schema: ENUM types, the ua/geo/referrer dimension tables,
+    log_compact, and a `log` view joining them back into the wide column layout.
+
+    args: db (duckdb.DuckDBPyConnection)
+    returns: None
+    """
+    for type_name, values in (("http_method", HTTP_METHODS), ("device_type", DEVICE_TYPES)):
+        if not db.execute("SELECT COUNT(*) FROM duckdb_types() WHERE type_name = ?", [type_name]).fetchone()[0]:
+            db.execute(f"CREATE TYPE {type_name} AS ENUM ({', '.join(repr(v) for v in values)})")
+
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS ua_dim (
+        ua_id BIGINT PRIMARY KEY,
+        browser VARCHAR,
+        os VARCHAR,
+        device device_type
+    )
+    """)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS geo_dim (
+        geo_id BIGINT PRIMARY KEY,
+        city VARCHAR,
+        country VARCHAR,
+        latitude DOUBLE,
+        longitude DOUBLE
+    )
+    """)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS referrer_dim (
+        referrer_id BIGINT PRIMARY KEY,
+        referrer VARCHAR
+    )
+    """)
+    db.execute(f"""
+    CREATE TABLE IF NOT EXISTS log_compact (
+        {_id_column()},
+        timestamp TIMESTAMP,
+        method http_method,
+        ip VARCHAR,
+        geo_id BIGINT,
+        endpoint VARCHAR,
+        status_code SMALLINT,
+        ua_id BIGINT,
+        referrer_id BIGINT,
+        duration_ns BIGINT,
+        response_size BIGINT,
+        sample_weight DOUBLE DEFAULT 1.0
+    )
+    """)
+    db.execute("""
+    CREATE OR REPLACE VIEW log AS
+    SELECT l.id, l.timestamp, CAST(l.method AS VARCHAR) AS method, l.ip,
+           g.city, g.country, g.latitude, g.longitude, l.endpoint,
+           CAST(l.status_code AS INTEGER) AS status_code,
+           u.browser, u.os, CAST(u.device AS VARCHAR) AS device, r.referrer,
+           l.duration_ns, l.response_size, l.sample_weight
+    FROM log_compact l
+    LEFT JOIN geo_dim g USING (geo_id)
+    LEFT JOIN ua_dim u USING (ua_id)
+    LEFT JOIN referrer_dim r USING (referrer_id)
+    """)
+
+def migrate_to_compact(db: duckdb.DuckDBPyConnection) -> None:
+    """
+    Converts a wide log table into the compact schema in one transaction.
+
+    args: db (duckdb.DuckDBPyConnection)
+    returns: None
+    """
+    db.begin()
+    try:
+        db.execute("ALTER TABLE log RENAME TO log_wide")
+        create_compact_log(db)
+        # Migrated rows are keyed by DuckDB's hash rather than dimensions.dimension_id; keys are
+        # opaque, so a value may end up with two dimension rows, each referenced by its own log rows.
+        for table, (key_column, columns) in DIMENSION_TABLES.items():
+            values = ", ".join("TRY_CAST(device AS device_type)" if c == "device" else c for c in columns)
+            db.execute(f"""
+                INSERT INTO {table}
+                SELECT DISTINCT CAST(hash({", ".join(columns)}) >> 1 AS BIGINT), {values}
+                FROM log_wide
+                ON CONFLICT DO NOTHING
+            """)
+        methods = ", ".join(repr(m) for m in HTTP_METHODS)
+        db.execute(f"""
+            INSERT INTO log_compact
+            SELECT id, timestamp,
+                   CASE WHEN method IN ({methods}) THEN method ELSE 'OTHER' END,
+                   ip,
+                   CAST(hash(city, country, latitude, longitude) >> 1 AS BIGINT),
+                   endpoint, status_code,
+                   CAST(hash(browser, os, device) >> 1 AS BIGINT),
+                   CAST(hash(referrer) >> 1 AS BIGINT),
+                   duration_ns, response_size, sample_weight
+            FROM log_wide
+        """)
+        db.execute("DROP TABLE log_wide")
+        db.commit()
+        logger.info("Migrated log table to the compact schema.")
+    except duckdb.Error:
+        db.rollback()
+        raise
+
 def init_zwischen_db() -> None:
     """
     Initializes the log table if it doesn't exist and the database file itself.
@@ -13,43 +217,403 @@ def init_zwischen_db() -> None:
     args: None
     returns: None
     """
+    global log_layout, log_storage
     with yield_conn() as db:
-        create_log = """
-        CREATE TABLE IF NOT EXISTS log (
-            id INTEGER PRIMARY KEY,
-            timestamp TIMESTAMP,
-            method VARCHAR,
-            ip VARCHAR,
-            city VARCHAR,
-            country VARCHAR,
-            latitude DOUBLE,
-            longitude DOUBLE,
-            endpoint VARCHAR,
-            status_code INTEGER,
-            browser VARCHAR,
-            os VARCHAR, 
-            device VARCHAR,
-            referrer VARCHAR
+        existing = _table_type(db, "log")
+        if existing == "VIEW":
+            if LOG_SCHEMA != "compact":
+                logger.warning("Database already uses the compact log schema; keeping it.")
+            log_layout = "compact"
+            create_compact_log(db)
+        elif LOG_SCHEMA == "compact":
+            if existing is not None:
+                create_wide_log(db)
+                migrate_to_compact(db)
+            log_layout = "compact"
+            create_compact_log(db)
+        else:
+            log_layout = "wide"
+            create_wide_log(db)
+
+        table = log_write_table()
+        if has_primary_key(db, table):
+            if LOG_STORAGE == "sorted":
+                # DuckDB can't drop a primary key in place; rebuilding the table sorted drops it.
+                sort_log_table(db)
+                log_storage = "sorted"
+            else:
+                log_storage = "indexed"
+        else:
+            if LOG_STORAGE != "sorted":
+                logger.warning(f"{table} has no primary key index; keeping sorted storage.")
+            log_storage = "sorted"
+
+        for table in ROLLUP_TABLES.values():
+            create_rollup = f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TIMESTAMP,
+                dimension VARCHAR,
+                value VARCHAR,
+                request_count DOUBLE,
+                PRIMARY KEY (bucket, dimension, value)
+            )
+            """
+            db.execute(create_rollup)
+            # Counts are sums of sample weights; older databases stored them as BIGINT.
+            count_type = db.execute(
+                "SELECT data_type FROM information_schema.columns WHERE table_name = ? AND column_name = 'request_count'", [table]
+            ).fetchone()[0]
+            if count_type != "DOUBLE":
+                db.execute(f"ALTER TABLE {table} ALTER request_count TYPE DOUBLE")
+
+        create_sketch = """
+        CREATE TABLE IF NOT EXISTS sketch (
+            granularity VARCHAR,
+            bucket VARCHAR,
+            name VARCHAR,
+            data BLOB,
+            PRIMARY KEY (granularity, bucket, name)
         )
         """
-        db.execute(create_log)
+        db.execute(create_sketch)
         db.commit()
         logger.info("DuckDB Tables Created.")
 
+        rollups_empty = db.execute(f"SELECT COUNT(*) = 0 FROM {ROLLUP_TABLES['day']}").fetchone()[0]
+        log_empty = db.execute("SELECT COUNT(*) = 0 FROM log").fetchone()[0]
+        if rollups_empty and not log_empty:
+            rebuild_rollups(db)
+
+def sort_log_table(db: duckdb.DuckDBPyConnection) -> None:
+    """
+    Rewrites the log table ordered by timestamp, without a primary key index, so that
+    every row group covers a narrow, non-overlapping time range and range filters on
+    timestamp skip whole row groups via their min/max zone maps.
+
+    args: db (duckdb.DuckDBPyConnection)
+    returns: None
+    """
+    table = log_write_table()
+    db.begin()
+    try:
+        db.execute(f"CREATE TABLE {table}_sorted AS SELECT * FROM {table} ORDER BY timestamp, id")
+        db.execute(f"ALTER TABLE {table}_sorted ALTER sample_weight SET DEFAULT 1.0")
+        db.execute(f"DROP TABLE {table}")
+        db.execute(f"ALTER TABLE {table}_sorted RENAME TO {table}")
+        db.commit()
+    except duckdb.Error:
+        db.rollback()
+        raise
+    db.execute("CHECKPOINT")
+    logger.info(f"Rewrote {table} in timestamp order.")
+
+def log_disorder(db: duckdb.DuckDBPyConnection, slack_seconds: float = 300.0) -> float:
+    """
+    Fraction of the log table's persisted row groups whose timestamp range starts more than
+    `slack_seconds` before the end of an earlier row group, read from storage metadata without
+    scanning any rows. Overlapping row groups can't be skipped by timestamp range filters;
+    the slack ignores the few seconds of jitter between concurrently flushed batches.
+
+    args: db (duckdb.DuckDBPyConnection), slack_seconds (float)
+    returns: float
+    """
+    result = db.execute(f"""
+        WITH row_groups AS (
+            SELECT row_group_id,
+                   CAST(regexp_extract(stats, 'Min: ([^,\\]]+)', 1) AS TIMESTAMP) AS min_timestamp,
+                   CAST(regexp_extract(stats, 'Max: ([^,\\]]+)', 1) AS TIMESTAMP) AS max_timestamp
+            FROM pragma_storage_info('{log_write_table()}')
+            WHERE column_name = 'timestamp' AND segment_type = 'TIMESTAMP' AND stats LIKE '%Min: %'
+        ),
+        ranges AS (
+            SELECT row_group_id, MIN(min_timestamp) AS min_timestamp, MAX(max_timestamp) AS max_timestamp
+            FROM row_groups
+            GROUP BY row_group_id
+        )
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE overlapping)
+        FROM (
+            SELECT min_timestamp + to_microseconds(CAST($slack * 1e6 AS BIGINT))
+                   < MAX(max_timestamp) OVER (ORDER BY row_group_id ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS overlapping
+            FROM ranges
+        )
+    """, {"slack": slack_seconds}).fetchone()
+    row_groups, overlapping = result
+    return overlapping / row_groups if row_groups else 0.0
+
+def compact_log(db: duckdb.DuckDBPyConnection, max_disorder: float = 0.05) -> bool:
+    """
+    Re-sorts the log table by timestamp when more than `max_disorder` of its row groups overlap,
+    e.g. after late batches from the collector or an out-of-order import. Only applies to sorted storage.
+
+    args: db (duckdb.DuckDBPyConnection), max_disorder (float)
+    returns: bool (whether the table was rewritten)
+    """
+    if log_storage != "sorted":
+        return False
+    disorder = log_disorder(db)
+    if disorder <= max_disorder:
+        return False
+    logger.info(f"{disorder:.0%} of log row groups overlap; compacting.")
+    sort_log_table(db)
+    return True
+
+def add_to_rollups(db: duckdb.DuckDBPyConnection, source: str, dimensions: Optional[List[str]] = None) -> None:
+    """
+    Aggregates the rows of `source` (a table, view, subquery or registered Arrow table with the
+    log columns) into every rollup table, in the caller's transaction. `source` is scanned once:
+    every dimension is unpivoted into one per-minute aggregate, from which the coarser
+    rollups are derived.
+
+    args: db (duckdb.DuckDBPyConnection), source (str),
+          dimensions (Optional[List[str]]): ROLLUP_DIMENSIONS to update, all of them by default
+    returns: None
+    """
+    finest = next(iter(ROLLUP_TABLES))
+    dimensions = dimensions or list(ROLLUP_DIMENSIONS)
+    values = ", ".join(f"COALESCE({ROLLUP_DIMENSIONS[dimension]}, 'Unknown')" for dimension in dimensions)
+    dimensions = ", ".join(f"'{dimension}'" for dimension in dimensions)
+    db.execute(f"""
+        CREATE OR REPLACE TEMP TABLE rollup_delta AS
+        SELECT bucket, dimension, value, SUM(sample_weight) AS request_count
+        FROM (
+            SELECT date_trunc('{finest}', timestamp) AS bucket, sample_weight,
+                   UNNEST([{dimensions}]) AS dimension, UNNEST([{values}]) AS value
+            FROM {source}
+        )
+        GROUP BY ALL
+    """)
+    for granularity, table in ROLLUP_TABLES.items():
+        query = f"""
+        INSERT INTO {table}
+        SELECT date_trunc('{granularity}', bucket), dimension, value, SUM(request_count)
+        FROM rollup_delta
+        GROUP BY ALL
+        ON CONFLICT (bucket, dimension, value) DO UPDATE SET request_count = request_count + excluded.request_count
+        """
+        db.execute(query)
+    db.execute("DROP TABLE rollup_delta")
+
+def insert_batch(db: duckdb.DuckDBPyConnection, relation: str, dimensions: Optional[List[str]] = None) -> None:
+    """
+    Inserts the rows of `relation` (e.g. a registered Arrow table) into the log table and adds
+    them to the rollups, in the caller's transaction. `relation` has the wide log columns, plus
+    the geo_id, ua_id and referrer_id keys for the compact layout, whose dimension rows the
+    caller has inserted. The compact layout stores methods outside HTTP_METHODS as OTHER,
+    and the rollups count them the same way.
+
+    args: db (duckdb.DuckDBPyConnection), relation (str),
+          dimensions (Optional[List[str]]): ROLLUP_DIMENSIONS to update, all of them by default
+    returns: None
+    """
+    if log_layout == "compact":
+        methods = ", ".join(f"'{method}'" for method in HTTP_METHODS)
+        source = f"(SELECT * REPLACE (CASE WHEN method IN ({methods}) THEN method ELSE 'OTHER' END AS method) FROM {relation})"
+        db.execute(f"""
+            INSERT INTO log_compact
+            (id, ip, timestamp, method, geo_id, endpoint, status_code, ua_id, referrer_id,
+            duration_ns, response_size, sample_weight)
+            SELECT nextval('serial'), ip, timestamp, method, geo_id, endpoint, status_code, ua_id, referrer_id,
+                   duration_ns, response_size, sample_weight
+            FROM {source}
+        """)
+    else:
+        source = relation
+        db.execute(f"""
+            INSERT INTO log
+            (id, ip, timestamp, country, city, latitude, longitude, method, endpoint,
+            status_code, browser, os, device, referrer, duration_ns, response_size, sample_weight)
+            SELECT nextval('serial'), ip, timestamp, country, city, latitude, longitude, method, endpoint,
+                   status_code, browser, os, device, referrer, duration_ns, response_size, sample_weight
+            FROM {source}
+        """)
+    add_to_rollups(db, source, dimensions)
+
+def rebuild_rollups(db: duckdb.DuckDBPyConnection) -> None:
+    """
+    Recomputes every rollup table from the raw log table.
+    Used to backfill rollups for history logged before they existed.
+
+    args: db (duckdb.DuckDBPyConnection)
+    returns: None
+    """
+    db.begin()
+    try:
+        for table in ROLLUP_TABLES.values():
+            db.execute(f"DELETE FROM {table}")
+        add_to_rollups(db, "log")
+        db.commit()
+        logger.info("Rollup tables rebuilt from log.")
+    except duckdb.Error:
+        db.rollback()
+        raise
+
+def prune_rollups(db: duckdb.DuckDBPyConnection, minute_retention_days: int = ROLLUP_RETENTION_DAYS["minute"],
+                  hour_retention_days: int = ROLLUP_RETENTION_DAYS["hour"]) -> None:
+    """
+    Deletes fine-grained rollup buckets that are too old to be queried at that granularity.
+    The day rollup is kept forever. Buckets are UTC, so the cutoffs are computed in UTC
+    rather than in the session's time zone.
+
+    args: db (duckdb.DuckDBPyConnection), minute_retention_days (int), hour_retention_days (int)
+    returns: None
+    """
+    now = datetime.utcnow()
+    db.execute(f"DELETE FROM {ROLLUP_TABLES['minute']} WHERE bucket < ?", [now - timedelta(days=minute_retention_days)])
+    db.execute(f"DELETE FROM {ROLLUP_TABLES['hour']} WHERE bucket < ?", [now - timedelta(days=hour_retention_days)])
+
+class ConnectionManager:
+    """
+    Owns the single DuckDB connection of this process.
+
+    The connection itself is the writer and is used by the ingestion writer;
+    readers get their own cursor on it, which shares the open database file
+    and catalog instead of reconnecting. `open` and `close` are meant to be
+    called from the application's startup and shutdown hooks.
+    """
+    def __init__(self, database: str = DATABASE_FILE, read_only: bool = False):
+        self.database = database
+        self.read_only = read_only
+        self._conn: Optional[duckdb.DuckDBPyConnection] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    def open(self) -> None:
+        """
+        Opens the connection if it isn't open yet.
+        """
+        if self._conn is None:
+            self._conn = duckdb.connect(database=self.database, read_only=self.read_only)
+            logger.info(f"Opened DuckDB connection to {self.database}.")
+
+    def close(self) -> None:
+        """
+        Closes the connection. Cursors handed out earlier become unusable.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            logger.info(f"Closed DuckDB connection to {self.database}.")
+
+    @property
+    def writer(self) -> duckdb.DuckDBPyConnection:
+        """
+        The writer connection, opened on first use if the startup hook hasn't run.
+        """
+        if self._conn is None:
+            self.open()
+        return self._conn
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """
+        Returns a new cursor on the shared connection for read queries.
+        """
+        return self.writer.cursor()
+
+connection_manager = ConnectionManager()
+
+class QueryTimeoutError(Exception):
+    pass
+
+class QueryExecutor:
+    """
+    Runs blocking DuckDB work on a bounded thread pool so that the event loop keeps serving
+    requests while a query runs.
+
+    At most `max_concurrent` calls run at once; further callers wait (within their timeout)
+    for a free slot. When a call exceeds its timeout, the connection it was given is
+    interrupted, which aborts the running query with duckdb.InterruptException, and the
+    caller gets a QueryTimeoutError. The slot is only released once the worker thread
+    has actually finished.
+
+    args: max_concurrent (int), timeout (Optional[float]): default seconds per call, None for no limit,
+          name (str): thread name prefix
+    """
+    def __init__(self, max_concurrent: int = 2, timeout: Optional[float] = 30.0, name: str = "zwischen-query"):
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.timeouts = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix=name)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _slots(self) -> asyncio.Semaphore:
+        # asyncio primitives are bound to a loop; recreate them if the app restarts on a new one.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    async def run(self, fn: Callable[..., Any], *args, db: Optional[duckdb.DuckDBPyConnection] = None, timeout: Optional[float] = ...) -> Any:
+        """
+        Calls fn(*args) on the pool.
+
+        args: fn (Callable), *args, db (Optional[duckdb.DuckDBPyConnection]): connection to interrupt on timeout,
+              timeout (Optional[float]): overrides the executor default
+        returns: fn's return value
+        raises: QueryTimeoutError
+        """
+        timeout = self.timeout if timeout is ... else timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        slots = self._slots()
+
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise QueryTimeoutError(f"No query slot free within {timeout}s")
+
+        try:
+            future = loop.run_in_executor(self._pool, fn, *args)
+            remaining = deadline - loop.time() if deadline is not None else None
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), remaining)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if db is not None:
+                    db.interrupt()
+                with suppress(Exception):
+                    await future
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.timeouts += 1
+                raise QueryTimeoutError(f"Query timed out after {timeout}s")
+        finally:
+            slots.release()
+
+    async def fetch(self, db: duckdb.DuckDBPyConnection, query: str, params: Any = None, method: str = "fetchall", timeout: Optional[float] = ...) -> Any:
+        """
+        Executes a query on the pool and returns the result of the given fetch method
+        (fetchall, fetchone, fetch_arrow_table, fetchnumpy).
+
+        args: db (duckdb.DuckDBPyConnection), query (str), params, method (str), timeout (Optional[float])
+        """
+        def execute():
+            return getattr(db.execute(query, params), method)()
+        return await self.run(execute, db=db, timeout=timeout)
+
+# Dashboard/analytics reads: few concurrent queries so they can't take every core from ingestion.
+query_executor = QueryExecutor(max_concurrent=int(os.getenv("ZWISCHEN_QUERY_CONCURRENCY", "2")),
+                               timeout=float(os.getenv("ZWISCHEN_QUERY_TIMEOUT", "30")))
+
+# Everything that uses the writer connection: a single thread serializes its transactions.
+write_executor = QueryExecutor(max_concurrent=1, timeout=None, name="zwischen-writer")
+
 def yield_conn() -> duckdb.DuckDBPyConnection:
     """ 
-    Yields a connection to the DuckDB Database.
+    Yields a cursor on the process-wide DuckDB connection.
 
     args: None
     returns: duckdb.DuckDBPyConnection
     """
-    conn = duckdb.connect(database=DATABASE_FILE, read_only=False)
-    return conn
+    return connection_manager.cursor()
 
 def create_serial_sequence(db: duckdb.DuckDBPyConnection):
     try:
         create_seq = """ 
-        CREATE SEQUENCE serial;
+        CREATE SEQUENCE IF NOT EXISTS serial;
         """
 
         db.execute(create_seq)
@@ -0,0 +1,92 @@
+import duckdb
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# HTTP_METHOD and DEVICE_TYPE ENUM values. Methods outside the list are stored as OTHER.
+HTTP_METHODS = ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "CONNECT", "TRACE", "OTHER"]
+DEVICE_TYPES = ["desktop", "mobile", "tablet"]
+
+# Dimension tables of the compact log schema: name -> (id column, value columns).
+DIMENSION_TABLES = {
+    "ua_dim": ("ua_id", ["browser", "os", "device"]),
+    "geo_dim": ("geo_id", ["city", "country", "latitude", "longitude"]),
+    "referrer_dim": ("referrer_id", ["referrer"])
+}
+
+def dimension_id(values: Tuple) -> int:
+    """
+    Stable signed 64-bit key of a dimension row, derived from its values, so writers
+    never need a round trip to learn the id of a value.
+
+    args: values (Tuple)
+    returns: int
+    """
+    digest = hashlib.blake2b(repr(values).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+class DimensionInterner:
+    """
+    In-process cache of the dimension rows already stored in the compact schema.
+
+    `intern` returns the key of a value tuple and remembers tuples not seen before;
+    `flush` inserts those into their dimension tables in the caller's transaction.
+    Only after `commit` are they treated as stored, so a rolled back batch doesn't
+    leave log rows pointing at missing dimension rows.
+
+    args: cache_size (int): known keys kept per table before the cache is reset
+    """
+    def __init__(self, cache_size: int = 65536):
+        self.cache_size = cache_size
+        self._known: Dict[str, set] = {table: set() for table in DIMENSION_TABLES}
+        self._pending: Dict[str, Dict[int, Tuple]] = {table: {} for table in DIMENSION_TABLES}
+        self._flushed: Dict[str, Dict[int, Tuple]] = {}
+        self._lock = threading.Lock()
+
+    def intern(self, table: str, values: Tuple) -> int:
+        """
+        args: table (str), values (Tuple): values in DIMENSION_TABLES column order
+        returns: int
+        """
+        key = dimension_id(values)
+        with self._lock:
+            if key not in self._known[table]:
+                self._pending[table][key] = values
+        return key
+
+    def flush(self, db: duckdb.DuckDBPyConnection) -> None:
+        """
+        Inserts the pending dimension rows; rows stored by another writer are skipped.
+
+        args: db (duckdb.DuckDBPyConnection)
+        returns: None
+        """
+        with self._lock:
+            self._flushed = {table: rows for table, rows in self._pending.items() if rows}
+            self._pending = {table: {} for table in DIMENSION_TABLES}
+
+        for table, rows in self._flushed.items():
+            rows = list(rows.items())
+            key_column, columns = DIMENSION_TABLES[table]
+            placeholders = ", ".join(["(" + ", ".join(["?"] * (len(columns) + 1)) + ")"] * len(rows))
+            values = [v for key, row in rows for v in (key, *row)]
+            db.execute(f"""
+                INSERT INTO {table} ({key_column}, {", ".join(columns)}) VALUES {placeholders}
+                ON CONFLICT DO NOTHING
+            """, values)
+
+    def commit(self) -> None:
+        with self._lock:
+            for table, rows in self._flushed.items():
+                known = self._known[table]
+                if len(known) + len(rows) > self.cache_size:
+                    known.clear()
+                known.update(rows)
+            self._flushed = {}
+
+    def rollback(self) -> None:
+        # Discarded keys aren't known, so they are interned (and flushed) again next time.
+        with self._lock:
+            self._flushed = {}
+
+dimension_interner = DimensionInterner()
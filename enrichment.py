@@ -0,0 +1,254 @@
+import asyncio
+import duckdb
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+import pyarrow as pa
+import database
+from database import add_to_rollups, connection_manager, prune_rollups, ROLLUP_TABLES, write_executor
+from dimensions import dimension_id
+from models import LocationData
+from utils import GeoIPResolver, geoip_resolver
+
+logger = logging.getLogger(__name__)
+
+# "inline": batches are geolocated by the ingestion writer before they are inserted.
+# "deferred": rows are stored without a location and filled in by the background backfill.
+GEO_ENRICHMENT = os.getenv("ZWISCHEN_GEO_ENRICHMENT", "inline")
+
+# Rollup dimensions derived from the location columns.
+GEO_DIMENSIONS = ["city", "country", "coordinates"]
+
+class GeoEnricher:
+    """
+    GeoIP enrichment stage. Batches are resolved with one lookup per distinct IP, off the
+    event loop, so geolocation never runs per record or on the request path.
+
+    With `mode` "deferred", rows are stored raw (NULL city/country/latitude/longitude, or no
+    geo_id in the compact schema) and the background task fills them in. The archiver keeps
+    such rows in log until then, so the backfill only has to look at log. The same task
+    re-enriches the history in log when a new GeoLite2 release is installed: rows whose
+    location changed are updated, and their rollup counts are moved from the old location to
+    the new one. Archived partitions keep the location they were archived with.
+
+    args: resolver (GeoIPResolver), mode (str): "inline" or "deferred",
+          batch_size (int): distinct IPs per backfill transaction,
+          interval (float): seconds between runs of the background task
+    """
+    def __init__(self, resolver: GeoIPResolver = geoip_resolver, mode: str = GEO_ENRICHMENT,
+                 batch_size: int = 10000, interval: float = 30.0):
+        if mode not in ("inline", "deferred"):
+            raise ValueError(f"Unknown GeoIP enrichment mode {mode!r}, expected 'inline' or 'deferred'")
+        self.resolver = resolver
+        self.mode = mode
+        self.batch_size = batch_size
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def deferred(self) -> bool:
+        return self.mode == "deferred"
+
+    def lookup_batch(self, ips: Iterable[str]) -> Dict[str, LocationData]:
+        """
+        Resolves each distinct IP once. Addresses missing from the database get the "Unknown" location.
+        Blocking; call it off the event loop.
+
+        args: ips (Iterable[str])
+        returns: Dict[str, LocationData]
+        raises: OSError if the database can't be opened
+        """
+        locations = {}
+        for ip in set(ips):
+            try:
+                locations[ip] = self.resolver.lookup(ip) or LocationData()
+            except ValueError:
+                locations[ip] = LocationData()
+        return locations
+
+    async def resolve(self, ips: Iterable[str]) -> Dict[str, LocationData]:
+        """
+        Resolves a batch's IPs on a worker thread. If the database can't be read, every IP
+        gets the "Unknown" location rather than holding up the batch.
+
+        args: ips (Iterable[str])
+        returns: Dict[str, LocationData]
+        """
+        ips = set(ips)
+        try:
+            return await asyncio.to_thread(self.lookup_batch, ips)
+        except Exception as e:
+            logger.error(f"Error retrieving geolocation: {e}")
+            return {ip: LocationData() for ip in ips}
+
+    def unresolved_ips(self, db: duckdb.DuckDBPyConnection) -> List[str]:
+        """
+        Returns up to `batch_size` distinct IPs with rows stored without a location.
+        """
+        rows = db.execute("SELECT DISTINCT ip FROM log WHERE city IS NULL LIMIT ?", [self.batch_size]).fetchall()
+        return [ip for ip, in rows]
+
+    def located_ips(self, db: duckdb.DuckDBPyConnection) -> List[str]:
+        """
+        Returns every distinct IP with located rows.
+        """
+        return [ip for ip, in db.execute("SELECT DISTINCT ip FROM log WHERE city IS NOT NULL").fetchall()]
+
+    def apply(self, db: duckdb.DuckDBPyConnection, locations: Dict[str, LocationData]) -> int:
+        """
+        Writes `locations` to the log rows of their IPs that are unresolved or located
+        elsewhere, and moves those rows' geo rollup counts to the new location, in one transaction.
+
+        args: db (duckdb.DuckDBPyConnection), locations (Dict[str, LocationData])
+        returns: int (number of updated rows)
+        """
+        if not locations:
+            return 0
+        ips = list(locations)
+        values = [(l.city, l.country, l.latitude, l.longitude) for l in locations.values()]
+        db.register("geo_batch", pa.table({
+            "ip": pa.array(ips, pa.string()),
+            "city": pa.array([v[0] for v in values], pa.string()),
+            "country": pa.array([v[1] for v in values], pa.string()),
+            "latitude": pa.array([v[2] for v in values], pa.float64()),
+            "longitude": pa.array([v[3] for v in values], pa.float64()),
+            "geo_id": pa.array([dimension_id(v) for v in values], pa.int64())
+        }))
+        changed = """
+            l.city IS NULL OR l.city IS DISTINCT FROM g.city OR l.country IS DISTINCT FROM g.country
+            OR l.latitude IS DISTINCT FROM g.latitude OR l.longitude IS DISTINCT FROM g.longitude
+        """
+        db.begin()
+        try:
+            db.execute(f"""
+                CREATE OR REPLACE TEMP TABLE geo_moved AS
+                SELECT l.timestamp, l.sample_weight, l.city IS NULL AS unresolved,
+                       l.city AS old_city, l.country AS old_country, l.latitude AS old_latitude, l.longitude AS old_longitude,
+                       g.city, g.country, g.latitude, g.longitude
+                FROM log l JOIN geo_batch g USING (ip)
+                WHERE {changed}
+            """)
+            count = db.execute("SELECT COUNT(*) FROM geo_moved").fetchone()[0]
+            if count:
+                # Unresolved rows were never counted under a location.
+                add_to_rollups(db, """(
+                    SELECT timestamp, -sample_weight AS sample_weight, old_city AS city, old_country AS country,
+                           old_latitude AS latitude, old_longitude AS longitude
+                    FROM geo_moved WHERE NOT unresolved
+                )""", GEO_DIMENSIONS)
+                add_to_rollups(db, "(SELECT timestamp, sample_weight, city, country, latitude, longitude FROM geo_moved)", GEO_DIMENSIONS)
+                for table in ROLLUP_TABLES.values():
+                    db.execute(f"""
+                        DELETE FROM {table}
+                        WHERE dimension IN ({", ".join(f"'{d}'" for d in GEO_DIMENSIONS)}) AND abs(request_count) < 1e-9
+                    """)
+                # Old buckets may have been pruned from the fine rollups already; don't bring them back.
+                prune_rollups(db)
+
+                if database.log_layout == "compact":
+                    db.execute("""
+                        INSERT INTO geo_dim SELECT DISTINCT geo_id, city, country, latitude, longitude FROM geo_batch
+                        ON CONFLICT DO NOTHING
+                    """)
+                    # Migrated rows use other keys for the same values; re-keying those is harmless.
+                    db.execute("""
+                        UPDATE log_compact SET geo_id = g.geo_id
+                        FROM geo_batch g
+                        WHERE log_compact.ip = g.ip AND log_compact.geo_id IS DISTINCT FROM g.geo_id
+                    """)
+                else:
+                    db.execute(f"""
+                        UPDATE log l SET city = g.city, country = g.country, latitude = g.latitude, longitude = g.longitude
+                        FROM geo_batch g
+                        WHERE l.ip = g.ip AND ({changed})
+                    """)
+            db.execute("DROP TABLE geo_moved")
+            db.commit()
+        except duckdb.Error:
+            db.rollback()
+            raise
+        finally:
+            db.unregister("geo_batch")
+        return count
+
+    def release_changed(self, db: duckdb.DuckDBPyConnection) -> bool:
+        """
+        Whether the installed GeoLite2 release differs from the one history was last enriched with.
+        The first check only records the current release.
+        """
+        db.execute("CREATE TABLE IF NOT EXISTS geo_enrichment (build_epoch BIGINT)")
+        build_epoch = self.resolver.build_epoch()
+        row = db.execute("SELECT build_epoch FROM geo_enrichment").fetchone()
+        if row is None:
+            db.execute("INSERT INTO geo_enrichment VALUES (?)", [build_epoch])
+            return False
+        return row[0] != build_epoch
+
+    def record_release(self, db: duckdb.DuckDBPyConnection) -> None:
+        db.execute("UPDATE geo_enrichment SET build_epoch = ?", [self.resolver.build_epoch()])
+
+    async def backfill(self) -> int:
+        """
+        Fills in the location of rows stored without one, `batch_size` distinct IPs per transaction.
+
+        returns: int (number of updated rows)
+        """
+        db = connection_manager.writer
+        updated = 0
+        while True:
+            ips = await write_executor.run(self.unresolved_ips, db)
+            if not ips:
+                break
+            locations = await asyncio.to_thread(self.lookup_batch, ips)
+            updated += await write_executor.run(self.apply, db, locations)
+        if updated:
+            logger.info(f"GeoIP backfill located {updated} log rows.")
+        return updated
+
+    async def reenrich(self) -> int:
+        """
+        Re-resolves every IP in log if a new GeoLite2 release was installed since the last run.
+        An interrupted run starts over next time; rows that already moved are left alone.
+
+        returns: int (number of updated rows)
+        """
+        db = connection_manager.writer
+        if not await write_executor.run(self.release_changed, db):
+            return 0
+
+        logger.info("New GeoLite2 release installed, re-enriching log history.")
+        ips = await write_executor.run(self.located_ips, db)
+        updated = 0
+        for offset in range(0, len(ips), self.batch_size):
+            locations = await asyncio.to_thread(self.lookup_batch, ips[offset:offset + self.batch_size])
+            updated += await write_executor.run(self.apply, db, locations)
+        await write_executor.run(self.record_release, db)
+        logger.info(f"GeoIP re-enrichment moved {updated} log rows.")
+        return updated
+
+    def start(self) -> None:
+        """
+        Starts the periodic backfill/re-enrichment task on the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.backfill()
+                await self.reenrich()
+            except Exception as e:
+                logger.error(f"GeoIP enrichment failed: {e}")
+            await asyncio.sleep(self.interval)
+
+geo_enricher = GeoEnricher()
@@ -1,6 +1,11 @@
+import argparse
 import asyncio
 import aiohttp
+import json
 import random
+import statistics
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from faker import Faker
 
 fake = Faker()
@@ -28,29 +33,151 @@ USER_AGENTS = [
     'Mozilla/5.0 (iPad; CPU OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.3 Mobile/15E148 Safari/604.1',
 ]
 
-async def send_request(session, url):
-    headers = {
-        'User-Agent': random.choice(USER_AGENTS),
-        'X-Forwarded-For': fake.ipv4(),
-        'Referer': fake.uri()
+# Rough real-world share of each entry in USER_AGENTS: Chrome on Windows and mobile Safari/Chrome dominate.
+USER_AGENT_WEIGHTS = [30, 6, 5, 6, 5, 2, 1, 12, 8, 9, 5, 2, 3, 1, 2, 3]
+
+class TrafficGenerator:
+    """
+    Synthetic request mix: IPs drawn from a fixed pool with Zipfian popularity (a few heavy
+    clients, a long tail of one-off visitors), user agents from a weighted realistic mix,
+    uniformly chosen endpoints and methods.
+
+    args: num_ips (int): size of the IP pool, zipf_exponent (float): 0 for uniform IPs,
+          seed (Optional[int]): makes the generated sequence reproducible
+    """
+    def __init__(self, num_ips: int = 10000, zipf_exponent: float = 1.1, seed: Optional[int] = None,
+                 endpoints: List[str] = ENDPOINTS, methods: List[str] = METHODS):
+        self.random = random.Random(seed)
+        fake.seed_instance(seed)
+        self.ips = [fake.ipv4_public() for _ in range(num_ips)]
+        self.endpoints = endpoints
+        self.methods = methods
+
+        ip_weights = [1.0 / (rank ** zipf_exponent) for rank in range(1, num_ips + 1)]
+        self._ip_cum_weights = self._cumulative(ip_weights)
+        self._ua_cum_weights = self._cumulative(USER_AGENT_WEIGHTS)
+        self.referrers = [fake.uri() for _ in range(200)] + ["unknown"] * 200
+
+    @staticmethod
+    def _cumulative(weights: List[float]) -> List[float]:
+        total = 0.0
+        cumulative = []
+        for weight in weights:
+            total += weight
+            cumulative.append(total)
+        return cumulative
+
+    def ip(self) -> str:
+        return self.random.choices(self.ips, cum_weights=self._ip_cum_weights)[0]
+
+    def user_agent(self) -> str:
+        return self.random.choices(USER_AGENTS, cum_weights=self._ua_cum_weights)[0]
+
+    def request(self) -> Tuple[str, str, Dict[str, str]]:
+        """
+        returns: Tuple[str, str, Dict[str, str]] (method, endpoint, headers)
+        """
+        headers = {
+            'User-Agent': self.user_agent(),
+            'X-Forwarded-For': self.ip(),
+            'Referer': self.random.choice(self.referrers)
+        }
+        return self.random.choice(self.methods), self.random.choice(self.endpoints), headers
+
+def summarize(latencies_ns: List[int], elapsed: float, errors: int) -> Dict:
+    """
+    Throughput and latency percentiles (ms) of a finished run.
+    """
+    latencies_ns = sorted(latencies_ns)
+    count = len(latencies_ns)
+
+    def percentile(q: float) -> Optional[float]:
+        return latencies_ns[min(count - 1, int(count * q))] / 1e6 if count else None
+
+    return {
+        "requests": count,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": count / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(latencies_ns) / 1e6 if count else None,
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+        "p999_ms": percentile(0.999),
+        "max_ms": latencies_ns[-1] / 1e6 if count else None
     }
-    method = random.choice(METHODS)
-    endpoint = random.choice(ENDPOINTS)
-    
-    try:
-        async with session.request(method, f"{url}{endpoint}", headers=headers) as response:
-            await response.text()
-            print(f"Sent {method} request to {endpoint} with status {response.status}")
-    except Exception as e:
-        print(f"Error sending request: {e}")
+
+async def run_load(send: Callable[[str, str, Dict[str, str]], Awaitable[int]], generator: TrafficGenerator,
+                   rate: float, concurrency: int, duration: float) -> Dict:
+    """
+    Drives `send(method, endpoint, headers)` -> status for `duration` seconds.
+
+    With a `rate` (requests/second) the load is open-loop: requests are scheduled at fixed
+    intervals and latency is measured from the scheduled start, so a stalled server shows up
+    as queueing delay instead of silently lowering the offered load. With rate 0, `concurrency`
+    workers send back to back (closed loop).
+
+    returns: Dict from summarize
+    """
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(scheduled_ns: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            method, endpoint, headers = generator.request()
+            try:
+                status = await send(method, endpoint, headers)
+                if status >= 500:
+                    errors += 1
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter_ns() - scheduled_ns)
+
+    start = time.perf_counter()
+    start_ns = time.perf_counter_ns()
+    deadline = start + duration
+
+    if rate > 0:
+        tasks = []
+        for i in range(int(rate * duration)):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(timed(start_ns + int(i / rate * 1e9))))
+        await asyncio.gather(*tasks)
+    else:
+        async def worker() -> None:
+            while time.perf_counter() < deadline:
+                await timed(time.perf_counter_ns())
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return summarize(latencies, time.perf_counter() - start, errors)
 
 async def main():
-    url = "http://localhost:8000"
-    num_requests = 10000
+    parser = argparse.ArgumentParser(description="Generates synthetic traffic against a running server and reports latency/throughput as JSON.")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second; 0 sends as fast as concurrency allows")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--ips", type=int, default=10000, help="size of the client IP pool")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of IP popularity, 0 for uniform")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    generator = TrafficGenerator(args.ips, args.zipf, args.seed)
 
     async with aiohttp.ClientSession() as session:
-        tasks = [send_request(session, url) for _ in range(num_requests)]
-        await asyncio.gather(*tasks)
+        async def send(method: str, endpoint: str, headers: Dict[str, str]) -> int:
+            async with session.request(method, f"{args.url}{endpoint}", headers=headers) as response:
+                await response.read()
+                return response.status
+
+        result = await run_load(send, generator, args.rate, args.concurrency, args.duration)
+
+    print(json.dumps({"url": args.url, "rate": args.rate, "concurrency": args.concurrency, **result}, indent=2))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
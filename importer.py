@@ -0,0 +1,238 @@
+import log_config
+
+import argparse
+import calendar
+import gzip
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+import duckdb
+import pyarrow as pa
+
+import database
+from database import ROLLUP_DIMENSIONS, compact_log, connection_manager, create_serial_sequence, init_zwischen_db, insert_batch
+from dimensions import DIMENSION_TABLES, dimension_id
+from enrichment import GEO_DIMENSIONS, geo_enricher
+from models import LocationData
+from utils import endpoint_normalizer, user_agent_classifier, validate_ip
+
+logger = logging.getLogger(__name__)
+
+# nginx/uvicorn "combined" format:
+# $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"
+# Anything after the user agent (e.g. $request_time) is ignored; lines that don't match are counted as malformed.
+COMBINED_LOG_PATTERN = re.compile(
+    r'^(\S+) \S+ \S+ \[([^\]]+)\] "(\S+) ([^ "]+)[^"]*" (\d{3}) (\d+|-) "([^"]*)" "([^"]*)"',
+    re.MULTILINE
+)
+
+MONTHS = {name: number for number, name in enumerate(calendar.month_abbr) if name}
+
+def parse_time_local(value: str) -> int:
+    """
+    Converts an nginx $time_local value, e.g. "10/Oct/2000:13:55:36 -0700", to UTC epoch seconds.
+
+    args: value (str)
+    returns: int
+    """
+    seconds = calendar.timegm((
+        int(value[7:11]), MONTHS[value[3:6]], int(value[0:2]),
+        int(value[12:14]), int(value[15:17]), int(value[18:20])
+    ))
+    offset = (int(value[22:24]) * 60 + int(value[24:26])) * 60
+    return seconds - offset if value[21] == "+" else seconds + offset
+
+def read_chunks(path: str, chunk_bytes: int) -> Iterator[bytes]:
+    """
+    Streams a log file, gzip compressed or not, as blocks of whole lines of roughly `chunk_bytes`.
+
+    args: path (str), chunk_bytes (int)
+    returns: Iterator[bytes]
+    """
+    with open(path, "rb") as raw:
+        gzipped = raw.read(2) == b"\x1f\x8b"
+    f: BinaryIO = gzip.open(path, "rb") if gzipped else open(path, "rb")
+    with f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                return
+            if not chunk.endswith(b"\n"):
+                chunk += f.readline()
+            yield chunk
+
+def parse_chunk(chunk: bytes) -> Tuple[pa.Table, Dict[str, int]]:
+    """
+    Parses and enriches a block of combined-format lines. Runs in a worker process.
+
+    User agents, IPs, paths and timestamps repeat heavily within a chunk, so each distinct
+    value is classified, geolocated, normalised or converted once and then mapped onto the
+    rows. The worker's GeoIP reader and LRU caches live across chunks. With deferred GeoIP
+    enrichment the location columns are left NULL.
+
+    args: chunk (bytes)
+    returns: Tuple[pa.Table, Dict[str, int]] (rows with the log columns plus dimension keys, line counts)
+    """
+    text = chunk.decode("utf-8", "replace")
+    lines = text.count("\n") + (0 if text.endswith("\n") else 1)
+    matches = COMBINED_LOG_PATTERN.findall(text)
+    columns = list(zip(*matches)) if matches else [()] * 8
+
+    invalid = {ip for ip in set(columns[0]) if not validate_ip(ip)}
+    if invalid:
+        keep = [row for row, ip in enumerate(columns[0]) if ip not in invalid]
+        columns = [[column[row] for row in keep] for column in columns]
+    ips, times, methods, paths, statuses, sizes, referrers, user_agents = columns
+
+    def mapped(values, lookup: Dict) -> List:
+        return list(map(lookup.__getitem__, values))
+
+    epochs = {value: parse_time_local(value) for value in set(times)}
+    endpoints = {path: endpoint_normalizer.normalize(path.split("?", 1)[0]) for path in set(paths)}
+    status_codes = {status: int(status) for status in set(statuses)}
+    response_sizes = {size: int(size) if size != "-" else None for size in set(sizes)}
+    referrer_values = {referrer: referrer if referrer != "-" else "unknown" for referrer in set(referrers)}
+
+    ua_classes = {ua: user_agent_classifier.classify(ua if ua != "-" else "unknown") for ua in set(user_agents)}
+    if geo_enricher.deferred:
+        # Stored raw; the app's GeoIP backfill fills the location in.
+        unresolved = LocationData.model_construct(city=None, country=None, latitude=None, longitude=None)
+        locations = {ip: unresolved for ip in set(ips)}
+    else:
+        try:
+            locations = geo_enricher.lookup_batch(ips)
+        except OSError as e:
+            logger.error(f"Error retrieving geolocation: {e}")
+            locations = {ip: LocationData() for ip in set(ips)}
+
+    # Dimension keys for the compact schema, computed once per distinct value.
+    geo_keys = {
+        ip: None if l.city is None else dimension_id((l.city, l.country, l.latitude, l.longitude))
+        for ip, l in locations.items()
+    }
+    ua_keys = {ua: dimension_id(values) for ua, values in ua_classes.items()}
+    referrer_keys = {referrer: dimension_id((value,)) for referrer, value in referrer_values.items()}
+
+    table = pa.table({
+        "ip": pa.array(ips, pa.string()),
+        "timestamp": pa.array(mapped(times, epochs), pa.int64()).cast(pa.timestamp("s")),
+        "city": pa.array(mapped(ips, {ip: l.city for ip, l in locations.items()}), pa.string()),
+        "country": pa.array(mapped(ips, {ip: l.country for ip, l in locations.items()}), pa.string()),
+        "latitude": pa.array(mapped(ips, {ip: l.latitude for ip, l in locations.items()}), pa.float64()),
+        "longitude": pa.array(mapped(ips, {ip: l.longitude for ip, l in locations.items()}), pa.float64()),
+        "geo_id": pa.array(mapped(ips, geo_keys), pa.int64()),
+        "method": pa.array(methods, pa.string()),
+        "endpoint": pa.array(mapped(paths, endpoints), pa.string()),
+        "status_code": pa.array(mapped(statuses, status_codes), pa.int32()),
+        "browser": pa.array(mapped(user_agents, {ua: c[0] for ua, c in ua_classes.items()}), pa.string()),
+        "os": pa.array(mapped(user_agents, {ua: c[1] for ua, c in ua_classes.items()}), pa.string()),
+        "device": pa.array(mapped(user_agents, {ua: c[2] for ua, c in ua_classes.items()}), pa.string()),
+        "ua_id": pa.array(mapped(user_agents, ua_keys), pa.int64()),
+        "referrer": pa.array(mapped(referrers, referrer_values), pa.string()),
+        "referrer_id": pa.array(mapped(referrers, referrer_keys), pa.int64()),
+        "duration_ns": pa.nulls(len(ips), pa.int64()),
+        "response_size": pa.array(mapped(sizes, response_sizes), pa.int64()),
+        "sample_weight": pa.array([1.0] * len(ips), pa.float64())
+    })
+    counts = {"lines": lines, "malformed": lines - len(matches), "skipped": len(matches) - len(ips)}
+    return table, counts
+
+def load_chunk(db: duckdb.DuckDBPyConnection, table: pa.Table) -> None:
+    """
+    Bulk-inserts a parsed chunk and folds it into the rollups in one transaction.
+    With the compact schema, the chunk's distinct dimension rows are inserted first.
+
+    args: db (duckdb.DuckDBPyConnection), table (pa.Table)
+    returns: None
+    """
+    db.register("import_chunk", table)
+    db.begin()
+    try:
+        if database.log_layout == "compact":
+            for dimension_table, (key_column, columns) in DIMENSION_TABLES.items():
+                if dimension_table == "geo_dim" and geo_enricher.deferred:
+                    continue
+                values = ", ".join("TRY_CAST(device AS device_type)" if c == "device" else c for c in columns)
+                db.execute(f"""
+                    INSERT INTO {dimension_table} ({key_column}, {", ".join(columns)})
+                    SELECT DISTINCT {key_column}, {values} FROM import_chunk
+                    ON CONFLICT DO NOTHING
+                """)
+        # Deferred rows are counted under their location once the backfill has found it.
+        insert_batch(db, "import_chunk", [d for d in ROLLUP_DIMENSIONS if not (geo_enricher.deferred and d in GEO_DIMENSIONS)])
+        db.commit()
+    except duckdb.Error:
+        db.rollback()
+        raise
+    finally:
+        db.unregister("import_chunk")
+
+def import_files(paths: List[str], db: duckdb.DuckDBPyConnection, workers: Optional[int] = None,
+                 chunk_bytes: int = 16 * 1024 * 1024) -> Dict:
+    """
+    Imports access log files. Chunks are parsed by a pool of worker processes while the
+    calling process loads finished chunks, in file order, each in its own transaction.
+
+    args: paths (List[str]), db (duckdb.DuckDBPyConnection), workers (Optional[int]): defaults to the CPU count,
+          chunk_bytes (int): uncompressed bytes per chunk
+    returns: Dict with line counts and throughput
+    """
+    workers = workers or os.cpu_count() or 1
+    totals = {"lines": 0, "imported": 0, "malformed": 0, "skipped": 0}
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path in paths:
+            pending = []
+            chunks = read_chunks(path, chunk_bytes)
+            for chunk in chunks:
+                pending.append(pool.submit(parse_chunk, chunk))
+                # Bound the chunks held in memory to a couple per worker.
+                if len(pending) < 2 * workers:
+                    continue
+                _load(db, pending.pop(0).result(), totals)
+            for future in pending:
+                _load(db, future.result(), totals)
+            logger.info(f"Imported {path}: {totals['imported']} rows so far.")
+
+    if database.log_storage == "sorted":
+        # Backfilled history lands after newer rows; restore timestamp order for zone-map pruning.
+        compact_log(db)
+    db.execute("CHECKPOINT")
+
+    elapsed = time.perf_counter() - start
+    return {**totals, "seconds": elapsed, "lines_per_second": totals["lines"] / elapsed if elapsed else 0.0}
+
+def _load(db: duckdb.DuckDBPyConnection, result: Tuple[pa.Table, Dict[str, int]], totals: Dict) -> None:
+    table, counts = result
+    if table.num_rows:
+        load_chunk(db, table)
+    totals["imported"] += table.num_rows
+    for key, count in counts.items():
+        totals[key] += count
+
+def main():
+    parser = argparse.ArgumentParser(description="Imports nginx/uvicorn combined-format access logs (plain or gzip) into zwischen.duckdb.")
+    parser.add_argument("paths", nargs="+", help="log files, oldest first")
+    parser.add_argument("--database", default=connection_manager.database, help="DuckDB file to import into")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes; defaults to the CPU count")
+    parser.add_argument("--chunk-mb", type=int, default=16, help="uncompressed megabytes per chunk")
+    args = parser.parse_args()
+
+    # The importer needs the write lock, so the app (or collector) must not hold the database open.
+    connection_manager.database = args.database
+    connection_manager.open()
+    create_serial_sequence(connection_manager.writer)
+    init_zwischen_db()
+    try:
+        result = import_files(args.paths, connection_manager.writer, args.workers, args.chunk_mb * 1024 * 1024)
+    finally:
+        connection_manager.close()
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+import orjson
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from crud import insert_logs
+from database import connection_manager, write_executor
+from models import LogRecord
+from sketches import sketch_store
+from spill import SPILL_DIR, SpillLog
+
+logger = logging.getLogger(__name__)
+
+COLLECTOR_SOCKET = os.getenv("ZWISCHEN_COLLECTOR_SOCKET")
+OVERFLOW_POLICY = os.getenv("ZWISCHEN_OVERFLOW_POLICY", "drop_newest")
+
+# Frames on the collector socket are a 4-byte big-endian length followed by a
+# JSON array of LogRecord field arrays.
+FRAME_HEADER = struct.Struct(">I")
+
+def encode_batch(batch: List[LogRecord]) -> bytes:
+    payload = orjson.dumps([tuple(record) for record in batch])
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def decode_batch(payload: bytes) -> List[LogRecord]:
+    return [LogRecord(*fields) for fields in orjson.loads(payload)]
+
+class CollectorSink:
+    """
+    Ships batches to the single writer process (see collector.py) over a local Unix socket
+    instead of writing to DuckDB, so any number of workers can share one database file.
+    """
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def __call__(self, batch: List[LogRecord]) -> Dict:
+        try:
+            if self._writer is None or self._writer.is_closing():
+                _, self._writer = await asyncio.open_unix_connection(self.socket_path)
+            self._writer.write(encode_batch(batch))
+            await self._writer.drain()
+            return {"inserted": len(batch), "skipped": 0}
+        except OSError as e:
+            logger.error(f"Collector Error: {e}")
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            return {"error": str(e)}
+
+def query_socket_path(socket_path: str) -> str:
+    """
+    Path of the collector's query socket, next to its ingestion socket.
+    """
+    return socket_path + ".queries"
+
+class CollectorQueries:
+    """
+    Answers a worker's analytics queries from the collector. A worker in collector mode
+    must not open the database, which the collector holds the write lock of, and never
+    updates its own sketch store, while the collector sees every worker's records.
+    Each query is one JSON request and response over the collector's query socket.
+    """
+    def __init__(self, socket_path: str):
+        self.socket_path = query_socket_path(socket_path)
+
+    async def _query(self, request: Dict):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(orjson.dumps(request) + b"\n")
+            await writer.drain()
+            response = orjson.loads(await reader.read())
+        finally:
+            writer.close()
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
+
+    async def uniques(self, dimension: str, mode: str) -> int:
+        """
+        args: dimension (str), mode (str)
+        returns: int
+        raises: OSError if the collector can't be reached, ValueError if it failed to answer
+        """
+        return await self._query({"query": "uniques", "dimension": dimension, "mode": mode})
+
+    async def top_k(self, dimension: str, mode: str, k: int = 10) -> List[Dict]:
+        """
+        args: dimension (str), mode (str), k (int)
+        returns: List[Dict]
+        raises: OSError if the collector can't be reached, ValueError if it failed to answer
+        """
+        return await self._query({"query": "top_k", "dimension": dimension, "mode": mode, "k": k})
+
+    async def time_series(self, start: datetime, end: datetime, granularity: str, include_latency: bool = True) -> Dict:
+        """
+        Result of crud.time_series on the collector.
+
+        args: start (datetime), end (datetime), granularity (str), include_latency (bool)
+        returns: Dict
+        raises: OSError if the collector can't be reached, ValueError if it failed to answer
+        """
+        return await self._query({
+            "query": "time_series", "start": start.isoformat(), "end": end.isoformat(),
+            "granularity": granularity, "include_latency": include_latency
+        })
+
+    async def top_n(self, dimensions: List[str], n: int, mode: str) -> Dict:
+        """
+        Result of crud.top_n on the collector, with the (dimension, value, request_count)
+        columns under "requests" as lists.
+
+        args: dimensions (List[str]), n (int), mode (str)
+        returns: Dict
+        raises: OSError if the collector can't be reached, ValueError if it failed to answer
+        """
+        return await self._query({"query": "top_n", "dimensions": dimensions, "n": n, "mode": mode})
+
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest", "block")
+
+class LogIngestionQueue:
+    """
+    Bounded in-memory queue of log records drained by a background writer task.
+
+    The request path only enqueues; the writer groups records into batches and
+    flushes them with a single bulk insert once `batch_size` records are pending
+    or `flush_interval` seconds have passed since the first record of the batch.
+
+    Batches go to `sink` when one is given (e.g. a CollectorSink), otherwise they are
+    inserted through this process's DuckDB writer connection, and the records that were
+    stored are passed to each of `listeners` (e.g. SketchStore.record_batch).
+
+    A batch that fails to flush (database locked, collector down) is retried with
+    exponential backoff instead of being dropped, so memory stays bounded by `max_size`
+    while the writer is stalled. After `max_attempts` failed attempts the batch is
+    quarantined so that one bad batch can't stall ingestion for good: with a spill log it
+    is moved to a quarantine file there, otherwise it is dropped. What happens to records
+    arriving at a full queue is set by `policy`: "drop_newest" rejects them, "drop_oldest"
+    evicts the oldest queued record to make room, and "block" makes `put` wait up to
+    `block_timeout` seconds for room before dropping.
+
+    With a `spill` log, every accepted record is first appended to it, and records not yet
+    stored when the process dies are replayed on the next start. Dropped records are marked
+    done in the spill log, in batches by the writer before each flush, so they aren't
+    replayed; records arriving while the spill log is full are dropped.
+
+    args: max_size (int), batch_size (int), flush_interval (float), sink, listeners,
+          policy (str), block_timeout (float), spill (Optional[SpillLog]),
+          max_retry_interval (float): cap of the retry backoff in seconds,
+          max_attempts (int): failed flushes of a batch before it is quarantined
+    """
+    def __init__(self, max_size: int = 10000, batch_size: int = 500, flush_interval: float = 1.0,
+                 sink: Optional[Callable[[List[LogRecord]], Awaitable[Dict]]] = None,
+                 listeners: Optional[List[Callable[[List[LogRecord]], None]]] = None,
+                 policy: str = "drop_newest", block_timeout: float = 1.0,
+                 spill: Optional[SpillLog] = None, max_retry_interval: float = 30.0, max_attempts: int = 10):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.sink = sink
+        self.listeners = listeners or []
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.spill = spill
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self.dropped = 0
+        self.failed_flushes = 0
+        self.quarantined = 0
+        # Spill sequence numbers of dropped records, marked done by the writer off the event loop.
+        self._dropped_sequences: List[int] = []
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Future] = None
+        # (spill sequence number or None, record) pairs taken off the queue but not yet stored.
+        self._batch: List[Tuple[Optional[int], LogRecord]] = []
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def fill_ratio(self) -> float:
+        return self._queue.qsize() / self.max_size
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def spilled(self) -> int:
+        """
+        Records in the spill log that are not stored yet.
+        """
+        return self.spill.pending() if self.spill is not None else 0
+
+    def _append(self, record: LogRecord) -> Optional[Tuple[Optional[int], LogRecord]]:
+        if self.spill is None:
+            return None, record
+        sequence = self.spill.append(record)
+        if sequence is None:
+            self._discard([(None, record)], "Spill log full")
+            return None
+        return sequence, record
+
+    def _discard(self, items: List[Tuple[Optional[int], LogRecord]], reason: str) -> None:
+        self.dropped += len(items)
+        self._dropped_sequences.extend(sequence for sequence, _ in items if sequence is not None)
+        logger.warning(f"{reason}, dropped {len(items)} record(s) ({self.dropped} dropped so far)")
+
+    def enqueue(self, record: LogRecord) -> bool:
+        """
+        Puts a record on the queue without waiting. When the queue is full, the record is
+        dropped, or with policy "drop_oldest" the oldest queued record is dropped instead.
+
+        args: record (LogRecord)
+        returns: bool (whether the record was accepted)
+        """
+        if self._queue.full() and self.policy != "drop_oldest":
+            # Rejected before it is spilled, so there's nothing to replay.
+            self._discard([(None, record)], "Ingestion queue full")
+            return False
+        item = self._append(record)
+        if item is None:
+            return False
+        if self._queue.full():
+            self._discard([self._queue.get_nowait()], "Ingestion queue full")
+        self._queue.put_nowait(item)
+        return True
+
+    async def put(self, record: LogRecord) -> bool:
+        """
+        Like enqueue, but with policy "block" waits up to `block_timeout` seconds for room.
+
+        args: record (LogRecord)
+        returns: bool (whether the record was accepted)
+        """
+        if self.policy != "block" or not self._queue.full():
+            return self.enqueue(record)
+        item = self._append(record)
+        if item is None:
+            return False
+        try:
+            await asyncio.wait_for(self._queue.put(item), self.block_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self._discard([item], "Ingestion queue full")
+            return False
+
+    def start(self) -> None:
+        """
+        Starts the background writer task on the running event loop.
+        """
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info("Log ingestion writer started.")
+
+    async def stop(self) -> None:
+        """
+        Stops the writer task and flushes whatever is still queued. Records that can't be
+        flushed stay in the spill log, if there is one.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight is not None:
+            # A flush cancelled halfway may still commit; wait for it rather than writing the batch twice.
+            if await self._inflight:
+                self._batch = []
+            self._inflight = None
+
+        remaining = self._batch + self._drain(self._queue.qsize())
+        self._batch = []
+        if self.spill is not None and self.spill.recovered:
+            # Replay didn't finish; storing newer records first would leave them above the
+            # checkpoint and replay them again next time.
+            logger.warning(f"Spill log replay unfinished, {self.spilled} log records left for the next start.")
+        elif remaining and not await self._flush(remaining):
+            if self.spill is not None:
+                logger.warning(f"{len(remaining)} log records left in the spill log for the next start.")
+            else:
+                logger.error(f"Lost {len(remaining)} log records on shutdown.")
+        if self.spill is not None:
+            await self._mark_dropped()
+            self.spill.close()
+        logger.info("Log ingestion writer stopped.")
+
+    def _drain(self, limit: int) -> List[Tuple[Optional[int], LogRecord]]:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _collect_batch(self) -> List[Tuple[Optional[int], LogRecord]]:
+        # Records are collected into self._batch, which is only cleared once flushed,
+        # so that stop() can still flush a batch when the writer is cancelled mid-wait.
+        batch = self._batch
+        batch.append(await self._queue.get())
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            batch.extend(self._drain(self.batch_size - len(batch)))
+            if len(batch) >= self.batch_size:
+                break
+
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _flush_until_stored(self, batch: List[Tuple[Optional[int], LogRecord]]) -> None:
+        retry_interval = self.flush_interval
+        for attempt in range(1, self.max_attempts + 1):
+            self._inflight = asyncio.ensure_future(self._flush(batch))
+            if await asyncio.shield(self._inflight):
+                break
+            if attempt == self.max_attempts:
+                await self._quarantine(batch)
+                break
+            # Keep the batch; the queue fills up meanwhile and the overflow policy applies.
+            await asyncio.sleep(retry_interval)
+            retry_interval = min(retry_interval * 2, self.max_retry_interval)
+        self._inflight = None
+
+    async def _quarantine(self, batch: List[Tuple[Optional[int], LogRecord]]) -> None:
+        self.quarantined += len(batch)
+        if self.spill is None:
+            logger.error(f"Dropped {len(batch)} log records after {self.max_attempts} failed flushes.")
+            return
+        path = await asyncio.to_thread(self.spill.quarantine, batch)
+        logger.error(f"Moved {len(batch)} log records to {path} after {self.max_attempts} failed flushes.")
+
+    async def _replay(self) -> None:
+        for path in self.spill.recovered:
+            items = await asyncio.to_thread(self.spill.read_segment, path)
+            if items:
+                logger.info(f"Replaying {len(items)} log records from {path}.")
+            for offset in range(0, len(items), self.batch_size):
+                self._batch = items[offset:offset + self.batch_size]
+                await self._flush_until_stored(self._batch)
+                self._batch = []
+        self.spill.recovered = []
+
+    async def _run(self) -> None:
+        if self.spill is not None:
+            await self._replay()
+        while True:
+            batch = await self._collect_batch()
+            await self._flush_until_stored(batch)
+            self._batch = []
+
+    async def _mark_dropped(self) -> None:
+        # Persisted, so a restart doesn't replay records that were dropped.
+        if self.spill is None or not self._dropped_sequences:
+            return
+        sequences, self._dropped_sequences = self._dropped_sequences, []
+        await asyncio.to_thread(self.spill.mark_done, sequences)
+
+    async def _flush(self, batch: List[Tuple[Optional[int], LogRecord]]) -> bool:
+        records = [record for _, record in batch]
+        if self.spill is not None:
+            await self._mark_dropped()
+            # The records must be on disk before the database can acknowledge them.
+            await asyncio.to_thread(self.spill.sync)
+
+        if self.sink is not None:
+            result = await self.sink(records)
+        else:
+            result = await insert_logs(records, connection_manager.writer)
+            if "error" not in result:
+                for listener in self.listeners:
+                    try:
+                        # Listeners may use the writer connection, so they share its thread.
+                        # Records skipped by insert_logs (invalid IPs) aren't passed on.
+                        await write_executor.run(listener, result["records"])
+                    except Exception as e:
+                        logger.error(f"Ingestion listener failed: {e}")
+        if "error" in result:
+            self.failed_flushes += 1
+            logger.error(f"Failed to flush {len(batch)} log records: {result['error']}")
+            return False
+
+        if self.spill is not None:
+            await asyncio.to_thread(self.spill.mark_done, [sequence for sequence, _ in batch])
+        return True
+
+# In collector mode, the analytics routes are answered by the collector.
+collector_queries = CollectorQueries(COLLECTOR_SOCKET) if COLLECTOR_SOCKET else None
+
+ingestion_queue = LogIngestionQueue(
+    sink=CollectorSink(COLLECTOR_SOCKET) if COLLECTOR_SOCKET else None,
+    listeners=[sketch_store.record_batch],
+    policy=OVERFLOW_POLICY,
+    # With a collector, workers would share one spill directory; the collector spills instead.
+    spill=SpillLog(SPILL_DIR) if SPILL_DIR and not COLLECTOR_SOCKET else None
+)
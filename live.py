@@ -0,0 +1,104 @@
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is unbounded.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+class LiveCounters:
+    """
+    In-process ring buffer of per-second request counters: totals, status classes,
+    per-endpoint counts and a latency histogram. Recording is O(1) and never touches
+    the database; windows of up to `window_seconds` are summed from the ring.
+
+    args: window_seconds (int): how many seconds of history the ring keeps
+    """
+    def __init__(self, window_seconds: int = 3600):
+        self.window_seconds = window_seconds
+        self._seconds = [-1] * window_seconds
+        self._requests = [0] * window_seconds
+        self._status = [[0] * 5 for _ in range(window_seconds)]
+        self._endpoints: List[Dict[str, int]] = [{} for _ in range(window_seconds)]
+        self._latency = [[0] * (len(LATENCY_BUCKETS_MS) + 1) for _ in range(window_seconds)]
+
+    def record(self, endpoint: str, status_code: int, duration_ns: int, now: Optional[float] = None) -> None:
+        """
+        Counts one request in the slot of the current second.
+
+        args: endpoint (str), status_code (int), duration_ns (int), now (Optional[float]): epoch seconds, for testing
+        returns: None
+        """
+        second = int(now if now is not None else time.time())
+        slot = second % self.window_seconds
+
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._requests[slot] = 0
+            self._status[slot] = [0] * 5
+            self._endpoints[slot] = {}
+            self._latency[slot] = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+        self._requests[slot] += 1
+        status_class = status_code // 100
+        if 1 <= status_class <= 5:
+            self._status[slot][status_class - 1] += 1
+        endpoints = self._endpoints[slot]
+        endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+        self._latency[slot][bisect_left(LATENCY_BUCKETS_MS, duration_ns / 1e6)] += 1
+
+    def snapshot(self, seconds: int = 60, top_endpoints: int = 10, now: Optional[float] = None) -> Dict:
+        """
+        Aggregates the last `seconds` seconds (the current, partial second included).
+
+        args: seconds (int), top_endpoints (int), now (Optional[float])
+        returns: Dict
+        """
+        seconds = max(1, min(seconds, self.window_seconds))
+        current = int(now if now is not None else time.time())
+
+        requests = 0
+        status = [0] * 5
+        endpoints: Dict[str, int] = {}
+        latency = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+        for second in range(current - seconds + 1, current + 1):
+            slot = second % self.window_seconds
+            if self._seconds[slot] != second:
+                continue
+            requests += self._requests[slot]
+            for i, count in enumerate(self._status[slot]):
+                status[i] += count
+            for endpoint, count in self._endpoints[slot].items():
+                endpoints[endpoint] = endpoints.get(endpoint, 0) + count
+            for i, count in enumerate(self._latency[slot]):
+                latency[i] += count
+
+        return {
+            "seconds": seconds,
+            "requests": requests,
+            "requests_per_second": requests / seconds,
+            "status": {f"{i + 1}xx": count for i, count in enumerate(status)},
+            "endpoints": dict(sorted(endpoints.items(), key=lambda item: item[1], reverse=True)[:top_endpoints]),
+            "latency_histogram_ms": {
+                **{f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS_MS, latency)},
+                "le_inf": latency[-1]
+            },
+            "p50_ms": self._quantile(latency, 0.5),
+            "p99_ms": self._quantile(latency, 0.99)
+        }
+
+    @staticmethod
+    def _quantile(histogram: List[int], q: float) -> Optional[float]:
+        # Upper bound of the bucket holding the quantile; None for an empty or +Inf bucket.
+        total = sum(histogram)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, histogram):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return None
+
+live_counters = LiveCounters()
@@ -3,16 +3,27 @@ import log_config
 import logging
 from pathlib import Path
 import asyncio
-from fastapi.responses import JSONResponse
-from fastapi import FastAPI
+import orjson
+import pyarrow as pa
+from fastapi.responses import JSONResponse, Response
+from fastapi import FastAPI, Query, Request
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 
-from middleware import ZwischenMiddleware
+from datetime import datetime
+from typing import List, Literal
 
-app = FastAPI()
+import crud
+from database import connection_manager
+from live import live_counters
+from ingestion import collector_queries, ingestion_queue
+from middleware import ZwischenASGIMiddleware, zwischen_lifespan
+from prometheus import OPENMETRICS_CONTENT_TYPE, PROMETHEUS_CONTENT_TYPE, prometheus_metrics
+from sketches import sketch_store
 
-app.add_middleware(ZwischenMiddleware)
+app = FastAPI(lifespan=zwischen_lifespan)
+
+app.add_middleware(ZwischenASGIMiddleware)
 
 @app.get("/")
 async def greet():
@@ -27,8 +38,95 @@ async def greet():
     }
 
 @app.get("/metrics")
-async def get_metrics():    
-    ...
+async def get_metrics(request: Request):
+    openmetrics = "application/openmetrics-text" in request.headers.get("accept", "")
+    gauges = {
+        "zwischen_ingestion_queue_depth": ("Log records waiting to be written.", ingestion_queue.depth),
+        "zwischen_ingestion_spilled_records": ("Log records in the spill log that are not stored yet.", ingestion_queue.spilled)
+    }
+    counters = {
+        "zwischen_ingestion_dropped_records": ("Log records dropped because the ingestion queue or the spill log was full.", ingestion_queue.dropped),
+        "zwischen_ingestion_failed_flushes": ("Batch flushes that failed.", ingestion_queue.failed_flushes),
+        "zwischen_ingestion_quarantined_records": ("Log records given up on after repeated failed flushes.", ingestion_queue.quarantined)
+    }
+    return Response(
+        content=prometheus_metrics.render(openmetrics, gauges, counters),
+        media_type=OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE
+    )
+
+@app.get("/metrics/timeseries")
+async def get_time_series(start: datetime, end: datetime, granularity: Literal["minute", "hour", "day", "week", "month"] = "hour", latency: bool = True):
+    if collector_queries is not None:
+        try:
+            result = await collector_queries.time_series(start, end, granularity, include_latency=latency)
+        except (OSError, ValueError) as e:
+            return JSONResponse(status_code=503, content={"error": str(e)})
+    else:
+        result = await crud.time_series(start, end, granularity, connection_manager.cursor(), include_latency=latency)
+    if "error" in result:
+        return JSONResponse(status_code=400, content=result)
+    return result
+
+def arrow_response(table: pa.Table) -> Response:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(content=sink.getvalue().to_pybytes(), media_type="application/vnd.apache.arrow.stream")
+
+@app.get("/metrics/top")
+async def get_top(dimension: List[str] = Query(...), n: int = 10, mode: Literal["month", "day", "hour", "week", "year", "alltime"] = "day", format: Literal["json", "arrow"] = "json"):
+    """
+    Top-n values per dimension as a columnar (dimension, value, request_count) result,
+    either as an Arrow IPC stream or as column-oriented JSON.
+    """
+    if collector_queries is not None:
+        try:
+            result = await collector_queries.top_n(dimension, n, mode)
+        except (OSError, ValueError) as e:
+            return JSONResponse(status_code=503, content={"error": str(e)})
+        if "error" in result:
+            return JSONResponse(status_code=400, content=result)
+        if format == "arrow":
+            return arrow_response(pa.table(result["requests"]))
+        return Response(content=orjson.dumps(result["requests"]), media_type="application/json")
+
+    result_format = "arrow" if format == "arrow" else "numpy"
+    result = await crud.top_n(dimension, n, mode, connection_manager.cursor(), result_format=result_format)
+    if "error" in result:
+        return JSONResponse(status_code=400, content=result)
+    if format == "arrow":
+        return arrow_response(result["requests"])
+    return Response(content=orjson.dumps(crud.json_columns(result["requests"]), option=orjson.OPT_SERIALIZE_NUMPY), media_type="application/json")
+
+@app.get("/metrics/uniques")
+async def get_uniques(dimension: Literal["ip", "endpoint", "referrer"] = "ip", mode: Literal["month", "day", "hour", "week", "year", "alltime"] = "day"):
+    if collector_queries is not None:
+        try:
+            uniques = await collector_queries.uniques(dimension, mode)
+        except (OSError, ValueError) as e:
+            return JSONResponse(status_code=503, content={"error": str(e)})
+    else:
+        uniques = sketch_store.uniques(dimension, mode)
+    return {"dimension": dimension, "mode": mode, "uniques": uniques}
+
+@app.get("/metrics/topk")
+async def get_top_k(dimension: Literal["ip", "referrer"] = "ip", mode: Literal["month", "day", "hour", "week", "year", "alltime"] = "day", k: int = 10):
+    if collector_queries is not None:
+        try:
+            top = await collector_queries.top_k(dimension, mode, k)
+        except (OSError, ValueError) as e:
+            return JSONResponse(status_code=503, content={"error": str(e)})
+    else:
+        top = sketch_store.top_k(dimension, mode, k)
+    return {"dimension": dimension, "mode": mode, "top": top}
+
+@app.get("/metrics/live")
+async def get_live_metrics(seconds: int = 0, minutes: int = 0):
+    """
+    Live stats for the last N seconds and/or minutes from in-memory counters; defaults to the last 60 seconds.
+    """
+    window = seconds + minutes * 60 or 60
+    return live_counters.snapshot(window)
 
 @app.get("/dashboard")
 async def supply_dashboard():
@@ -1,58 +1,236 @@
 import logging
+import time
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from datetime import datetime
-from user_agents import parse
-from crud import insert_log
-from database import yield_conn, init_zwischen_db, create_serial_sequence
-from utils import init_maxmind_geoipdb
+from contextlib import asynccontextmanager
+from typing import Optional
+from database import connection_manager, init_zwischen_db, create_serial_sequence, prune_rollups
+from enrichment import GeoEnricher, geo_enricher
+from ingestion import LogIngestionQueue, ingestion_queue
+from live import LiveCounters, live_counters
+from prometheus import PrometheusMetrics, prometheus_metrics
+from models import LogRecord
+from sampling import Sampler
+from sketches import sketch_store
+from storage import LogArchiver, log_archiver
+from utils import init_maxmind_geoipdb, geoip_resolver, UserAgentClassifier, user_agent_classifier, EndpointNormalizer, endpoint_normalizer
 
 logger = logging.getLogger(__name__)
 
-class ZwischenMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
-        # logger.info("Initiating MaxMind GeoIP City database update.")
-        # init_maxmind_geoipdb()
-        # logger.info("MaxMind GeoIP database initialized.")
-        create_serial_sequence(yield_conn())
-        logger.info("Serial Sequence Created.")
-        init_zwischen_db()
-        logger.info("DuckDB Database Initialized.")
+async def startup(queue: LogIngestionQueue = ingestion_queue, archiver: LogArchiver = log_archiver,
+                  enricher: GeoEnricher = geo_enricher) -> None:
+    """
+    Opens the shared DuckDB connection, initializes the schema and starts the ingestion writer,
+    the log archiver and the GeoIP backfill.
 
-    async def dispatch(self, request: Request, call_next):
-        path = request.url.path.rstrip("/")
+    args: queue (LogIngestionQueue), archiver (LogArchiver), enricher (GeoEnricher)
+    returns: None
+    """
+    if queue.running:
+        return
+    if queue.sink is not None:
+        # Collector mode: the collector process owns the database, workers only ship records.
+        queue.start()
+        return
+    # logger.info("Initiating MaxMind GeoIP City database update.")
+    # init_maxmind_geoipdb()
+    # logger.info("MaxMind GeoIP database initialized.")
+    connection_manager.open()
+    create_serial_sequence(connection_manager.writer)
+    logger.info("Serial Sequence Created.")
+    init_zwischen_db()
+    prune_rollups(connection_manager.writer)
+    sketch_store.load(connection_manager.writer)
+    logger.info("DuckDB Database Initialized.")
+    queue.start()
+    archiver.start()
+    enricher.start()
 
-        logger.info(f"Request path: {path}")
+async def shutdown(queue: LogIngestionQueue = ingestion_queue, archiver: LogArchiver = log_archiver,
+                   enricher: GeoEnricher = geo_enricher) -> None:
+    """
+    Flushes pending log records, stops the archiver and the GeoIP backfill and closes the shared DuckDB connection.
+
+    args: queue (LogIngestionQueue), archiver (LogArchiver), enricher (GeoEnricher)
+    returns: None
+    """
+    await enricher.stop()
+    await archiver.stop()
+    await queue.stop()
+    if connection_manager.is_open:
+        sketch_store.persist(connection_manager.writer)
+    connection_manager.close()
+    geoip_resolver.close()
+
+@asynccontextmanager
+async def zwischen_lifespan(app):
+    """
+    Lifespan handler tying Zwischen's startup and shutdown hooks to the app, e.g. FastAPI(lifespan=zwischen_lifespan).
+    """
+    await startup()
+    yield
+    await shutdown()
+
+EXEMPT_PATHS = ["/metrics", "/dashboard"]
+
+class RequestCapture:
+    """
+    Logging logic shared by ZwischenMiddleware and ZwischenASGIMiddleware: exemptions,
+    UA classification and handing the finished record to the ingestion queue.
+
+    args: ingestion_queue (LogIngestionQueue), ua_classifier (UserAgentClassifier),
+          defer_ua_parsing (bool): store the raw UA string and classify it in the batch writer
+          instead of on the request path
+          sampler (Optional[Sampler]): log only a weighted sample of requests; None logs all of them
+          live (Optional[LiveCounters]): in-memory per-second counters updated for every request,
+          sampled or not; None disables them
+          prometheus (Optional[PrometheusMetrics]): in-memory counters/histograms exposed on /metrics,
+          updated for every request; None disables them
+          normalizer (Optional[EndpointNormalizer]): maps paths to route templates such as
+          /users/{id}; None logs raw paths
+    """
+    def __init__(self, ingestion_queue: LogIngestionQueue = ingestion_queue,
+                 ua_classifier: UserAgentClassifier = user_agent_classifier, defer_ua_parsing: bool = False,
+                 sampler: Optional[Sampler] = None, live: Optional[LiveCounters] = live_counters,
+                 prometheus: Optional[PrometheusMetrics] = prometheus_metrics,
+                 normalizer: Optional[EndpointNormalizer] = endpoint_normalizer):
+        self.ingestion_queue = ingestion_queue
+        self.ua_classifier = ua_classifier
+        self.defer_ua_parsing = defer_ua_parsing
+        self.sampler = sampler
+        self.live = live
+        self.prometheus = prometheus
+        self.normalizer = normalizer
 
-        exempt_paths = ["/metrics", "/dashboard"]
+    def is_exempt(self, path: str) -> bool:
+        path = path.rstrip("/")
 
-        if any(path.startswith(exempt) for exempt in exempt_paths):
+        logger.info(f"Request path: {path}")
+
+        if any(path.startswith(exempt) for exempt in EXEMPT_PATHS):
             logger.info(f"Bypassing middleware for exempted path: {path}")
+            return True
+        return False
+
+    def endpoint(self, scope: dict) -> str:
+        """
+        Endpoint label for a finished request: the matched route's template, a regex-normalised
+        path when no route matched, or the raw path without a normalizer.
+        """
+        if self.normalizer is None:
+            return scope["path"]
+        template = getattr(scope.get("route"), "path_format", None)
+        if template is not None:
+            # A route's template is relative to the app it belongs to; mounts add their prefix to root_path.
+            template = scope.get("root_path", "") + template
+        return self.normalizer.normalize(scope["path"], template)
+
+    async def record(self, ip: str, method: str, endpoint: str, status_code: int, start_time: datetime,
+                     user_agent_string: str, referrer: str, duration_ns: int, response_size: Optional[int]) -> None:
+        if self.live is not None:
+            self.live.record(endpoint, status_code, duration_ns)
+        if self.prometheus is not None:
+            self.prometheus.record(endpoint, method, status_code, duration_ns)
+
+        sample_weight = 1.0
+        if self.sampler is not None:
+            sample_weight = self.sampler.sample(ip, endpoint, status_code, self.ingestion_queue.fill_ratio)
+            if sample_weight is None:
+                return
+
+        if self.defer_ua_parsing:
+            browser = os = device = None
+        else:
+            browser, os, device = self.ua_classifier.classify(user_agent_string)
+            user_agent_string = None
+
+        timestamp = start_time.strftime("%Y-%m-%d %H:%M:%S")
+
+        if not self.ingestion_queue.running:
+            await startup(self.ingestion_queue)
+
+        await self.ingestion_queue.put(LogRecord(
+            ip, method, endpoint, status_code, timestamp, browser, os, device, referrer, user_agent_string,
+            duration_ns, response_size, sample_weight
+        ))
+
+class ZwischenMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, **capture_options):
+        """
+        args: app, **capture_options: keyword arguments for RequestCapture
+        """
+        super().__init__(app)
+        self.capture = RequestCapture(**capture_options)
+
+    async def dispatch(self, request: Request, call_next):
+        if self.capture.is_exempt(request.url.path):
             return await call_next(request)
 
         start_time = datetime.utcnow()
+        start_ns = time.perf_counter_ns()
         ip = request.client.host
         response = await call_next(request)
-        method = request.method
-        endpoint = request.url.path
-        status_code = response.status_code
-        user_agent_string = request.headers.get('user-agent', 'unknown')
-        user_agent = parse(user_agent_string)
-        browser = user_agent.browser.family
-        os = user_agent.os.family
-
-        if user_agent.is_mobile:
-            device = 'mobile'
-        elif user_agent.is_tablet:
-            device = 'tablet'
-        else:
-            device = 'desktop'
+        # Time until the response starts; streamed bodies are still being sent at this point.
+        duration_ns = time.perf_counter_ns() - start_ns
+        content_length = response.headers.get('content-length')
+        response_size = int(content_length) if content_length is not None else None
 
-        referrer = request.headers.get('referer', 'unknown')
-        timestamp = start_time.strftime("%Y-%m-%d %H:%M:%S")
+        await self.capture.record(
+            ip, request.method, self.capture.endpoint(request.scope), response.status_code, start_time,
+            request.headers.get('user-agent', 'unknown'), request.headers.get('referer', 'unknown'),
+            duration_ns, response_size
+        )
+        return response
+
+class ZwischenASGIMiddleware:
+    """
+    Raw ASGI implementation of ZwischenMiddleware, taking the same RequestCapture options.
+    It reads the request from `scope` and
+    captures status, body size and timing from the `send` messages, so it neither wraps
+    the app in a task nor buffers streaming responses. Duration covers the whole response,
+    body included.
+    """
+    def __init__(self, app, **capture_options):
+        self.app = app
+        self.capture = RequestCapture(**capture_options)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.capture.is_exempt(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        start_time = datetime.utcnow()
+        start_ns = time.perf_counter_ns()
+        status_code = None
+        response_size = 0
+
+        async def send_wrapper(message):
+            nonlocal status_code, response_size
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                response_size += len(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        duration_ns = time.perf_counter_ns() - start_ns
+
+        if status_code is None:
+            return
+
+        user_agent_string = 'unknown'
+        referrer = 'unknown'
+        for name, value in scope["headers"]:
+            if name == b"user-agent":
+                user_agent_string = value.decode("latin-1")
+            elif name == b"referer":
+                referrer = value.decode("latin-1")
+
+        client = scope.get("client")
+        ip = client[0] if client else "unknown"
 
-        db = yield_conn()
-        
-        await insert_log(ip, method, endpoint, status_code, timestamp, browser, os, device, referrer, db)
-        return response
\ No newline at end of file
+        await self.capture.record(
+            ip, scope["method"], self.capture.endpoint(scope), status_code, start_time,
+            user_agent_string, referrer, duration_ns, response_size
+        )
@@ -1,7 +1,23 @@
 from pydantic import BaseModel
+from typing import NamedTuple, Optional
 
 class LocationData(BaseModel):
     city: str = "Unknown"
     country: str = "Unknown"
     latitude: float = 0.0
-    longitude: float = 0.0
\ No newline at end of file
+    longitude: float = 0.0
+
+class LogRecord(NamedTuple):
+    ip: str
+    method: str
+    endpoint: str
+    status_code: int
+    timestamp: str
+    browser: Optional[str]
+    os: Optional[str]
+    device: Optional[str]
+    referrer: str
+    user_agent: Optional[str] = None
+    duration_ns: Optional[int] = None
+    response_size: Optional[int] = None
+    sample_weight: float = 1.0
@@ -0,0 +1,121 @@
+from typing import Dict, List, Optional, Tuple
+from dimensions import HTTP_METHODS
+
+# Histogram bucket upper bounds in seconds, following Prometheus client defaults.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+OVERFLOW_LABEL = "__other__"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(**labels: str) -> str:
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+class PrometheusMetrics:
+    """
+    In-memory request counters and latency histograms labeled by endpoint, method and status,
+    rendered in Prometheus text or OpenMetrics format.
+
+    Updates happen on the event loop thread as plain dict/list increments, so there are no
+    locks and a scrape only walks the current series. Once `max_endpoints` distinct endpoint
+    labels have been seen, further endpoints are folded into the "__other__" label so that
+    high-cardinality paths can't grow memory without bound. Likewise, methods outside
+    HTTP_METHODS are counted as OTHER, as in the compact log schema.
+
+    args: max_endpoints (int)
+    """
+    def __init__(self, max_endpoints: int = 500):
+        self.max_endpoints = max_endpoints
+        self._endpoints = set()
+        self._requests: Dict[Tuple[str, str, str], int] = {}
+        self._latency: Dict[Tuple[str, str], List[float]] = {}
+
+    def _endpoint_label(self, endpoint: str) -> str:
+        if endpoint in self._endpoints:
+            return endpoint
+        if len(self._endpoints) >= self.max_endpoints:
+            return OVERFLOW_LABEL
+        self._endpoints.add(endpoint)
+        return endpoint
+
+    def record(self, endpoint: str, method: str, status_code: int, duration_ns: int) -> None:
+        """
+        Counts one request and observes its latency.
+
+        args: endpoint (str), method (str), status_code (int), duration_ns (int)
+        returns: None
+        """
+        endpoint = self._endpoint_label(endpoint)
+        if method not in HTTP_METHODS:
+            method = "OTHER"
+
+        key = (endpoint, method, str(status_code))
+        self._requests[key] = self._requests.get(key, 0) + 1
+
+        # Per-bucket (non-cumulative) counts followed by sum and count.
+        histogram = self._latency.get((endpoint, method))
+        if histogram is None:
+            histogram = self._latency[(endpoint, method)] = [0] * (len(LATENCY_BUCKETS) + 3)
+        seconds = duration_ns / 1e9
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(LATENCY_BUCKETS)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def render(self, openmetrics: bool = False, gauges: Optional[Dict[str, Tuple[str, float]]] = None,
+               counters: Optional[Dict[str, Tuple[str, float]]] = None) -> str:
+        """
+        Renders all series in Prometheus text format, or OpenMetrics when `openmetrics` is set.
+
+        args: openmetrics (bool), gauges (Optional[Dict[str, Tuple[str, float]]]): extra name -> (help, value) gauges,
+              counters (Optional[Dict[str, Tuple[str, float]]]): extra name -> (help, value) counters, named without
+              the "_total" suffix
+        returns: str
+        """
+        lines = []
+
+        family = "zwischen_requests" if openmetrics else "zwischen_requests_total"
+        lines.append(f"# HELP {family} Total HTTP requests seen by Zwischen.")
+        lines.append(f"# TYPE {family} counter")
+        for (endpoint, method, status), count in list(self._requests.items()):
+            lines.append(f"zwischen_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}")
+
+        lines.append("# HELP zwischen_request_duration_seconds HTTP request latency.")
+        lines.append("# TYPE zwischen_request_duration_seconds histogram")
+        for (endpoint, method), histogram in list(self._latency.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                cumulative += count
+                lines.append(f"zwischen_request_duration_seconds_bucket{_labels(endpoint=endpoint, method=method, le=_format_bound(bound))} {cumulative}")
+            cumulative += histogram[len(LATENCY_BUCKETS)]
+            lines.append(f"zwischen_request_duration_seconds_bucket{_labels(endpoint=endpoint, method=method, le='+Inf')} {cumulative}")
+            lines.append(f"zwischen_request_duration_seconds_sum{_labels(endpoint=endpoint, method=method)} {histogram[-2]}")
+            lines.append(f"zwischen_request_duration_seconds_count{_labels(endpoint=endpoint, method=method)} {histogram[-1]}")
+
+        for name, (help_text, value) in (counters or {}).items():
+            family = name if openmetrics else f"{name}_total"
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} counter")
+            lines.append(f"{name}_total {value}")
+
+        for name, (help_text, value) in (gauges or {}).items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+prometheus_metrics = PrometheusMetrics()
@@ -0,0 +1,78 @@
+import logging
+import random
+import zlib
+from typing import Dict, Literal, Optional
+
+logger = logging.getLogger(__name__)
+
+class Sampler:
+    """
+    Decides which requests get logged and with what weight.
+
+    Each kept row stores weight 1 / rate, so summing `sample_weight` instead of counting
+    rows gives an unbiased estimate of the real request count.
+
+    args: rate (float): global sampling rate in (0, 1]
+          endpoint_rates (Optional[Dict[str, float]]): per-endpoint overrides of `rate`
+          keep_errors (bool): always keep responses with status >= 500 (weight 1)
+          strategy (str): "head" samples each request independently at random; "ip_hash"
+              deterministically keeps or drops all requests of an IP for a given rate
+          adaptive (bool): scale the rate down when the ingestion queue backs up
+          high_watermark (float): queue fill ratio above which adaptive scaling kicks in
+          min_rate (float): lower bound for the adaptively scaled rate
+    """
+    def __init__(self, rate: float = 1.0, endpoint_rates: Optional[Dict[str, float]] = None, keep_errors: bool = True,
+                 strategy: Literal["head", "ip_hash"] = "head", adaptive: bool = False,
+                 high_watermark: float = 0.5, min_rate: float = 0.01):
+        if strategy not in ("head", "ip_hash"):
+            raise ValueError(f"Invalid sampling strategy: {strategy}")
+        self.rate = rate
+        self.endpoint_rates = endpoint_rates or {}
+        self.keep_errors = keep_errors
+        self.strategy = strategy
+        self.adaptive = adaptive
+        self.high_watermark = high_watermark
+        self.min_rate = min_rate
+        self.sampled = 0
+        self.dropped = 0
+
+    def effective_rate(self, endpoint: str, queue_fill: float = 0.0) -> float:
+        """
+        Sampling rate for an endpoint given how full the ingestion queue is (0 to 1).
+
+        args: endpoint (str), queue_fill (float)
+        returns: float
+        """
+        rate = self.endpoint_rates.get(endpoint, self.rate)
+        if self.adaptive and queue_fill > self.high_watermark:
+            # Falls linearly from the configured rate at the watermark to min_rate when full.
+            scale = (1.0 - queue_fill) / (1.0 - self.high_watermark)
+            rate = max(self.min_rate, rate * scale)
+        return rate
+
+    def sample(self, ip: str, endpoint: str, status_code: int, queue_fill: float = 0.0) -> Optional[float]:
+        """
+        Returns the weight to store with the request, or None if it should not be logged.
+
+        args: ip (str), endpoint (str), status_code (int), queue_fill (float)
+        returns: Optional[float]
+        """
+        if self.keep_errors and status_code >= 500:
+            self.sampled += 1
+            return 1.0
+
+        rate = self.effective_rate(endpoint, queue_fill)
+        if rate >= 1.0:
+            self.sampled += 1
+            return 1.0
+
+        if self.strategy == "ip_hash":
+            draw = zlib.crc32(ip.encode()) / 0xFFFFFFFF
+        else:
+            draw = random.random()
+
+        if draw < rate:
+            self.sampled += 1
+            return 1.0 / rate
+        self.dropped += 1
+        return None
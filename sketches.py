@@ -0,0 +1,334 @@
+import duckdb
+import hashlib
+import logging
+import math
+import orjson
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from database import connection_manager
+from models import LogRecord
+
+logger = logging.getLogger(__name__)
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct counter with 2^precision one-byte registers (~1.04 / sqrt(2^precision) relative error).
+    """
+    def __init__(self, precision: int = 12, registers: Optional[bytearray] = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+
+    def add(self, value: str) -> None:
+        h = _hash64(value)
+        index = h >> (64 - self.precision)
+        rest = (h << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.precision + 1 if rest == 0 else 65 - rest.bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # Linear counting is more accurate for small cardinalities.
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        return cls(data[0], bytearray(data[1:]))
+
+class CountMinSketch:
+    """
+    Count-Min sketch for point frequency estimates; never underestimates.
+    """
+    HEADER = struct.Struct(">II")
+
+    def __init__(self, width: int = 2048, depth: int = 4, table: Optional[array] = None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else array("d", [0.0]) * (width * depth)
+
+    def _cells(self, value: str) -> Iterable[int]:
+        digest = hashlib.blake2b(value.encode(), digest_size=4 * self.depth).digest()
+        for row in range(self.depth):
+            yield row * self.width + int.from_bytes(digest[4 * row:4 * row + 4], "big") % self.width
+
+    def add(self, value: str, count: float = 1.0) -> None:
+        for cell in self._cells(value):
+            self.table[cell] += count
+
+    def estimate(self, value: str) -> float:
+        return min(self.table[cell] for cell in self._cells(value))
+
+    def merge(self, other: "CountMinSketch") -> None:
+        for i, count in enumerate(other.table):
+            self.table[i] += count
+
+    def to_bytes(self) -> bytes:
+        return self.HEADER.pack(self.width, self.depth) + self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CountMinSketch":
+        width, depth = cls.HEADER.unpack_from(data)
+        table = array("d")
+        table.frombytes(data[cls.HEADER.size:])
+        return cls(width, depth, table)
+
+class SpaceSaving:
+    """
+    Space-Saving heavy-hitter summary tracking at most `capacity` items. Counts overestimate
+    by at most the count of the item they replaced.
+    """
+    def __init__(self, capacity: int = 64, counts: Optional[Dict[str, float]] = None):
+        self.capacity = capacity
+        self.counts: Dict[str, float] = counts or {}
+
+    def add(self, value: str, count: float = 1.0) -> None:
+        if value in self.counts or len(self.counts) < self.capacity:
+            self.counts[value] = self.counts.get(value, 0.0) + count
+            return
+        victim = min(self.counts, key=self.counts.get)
+        self.counts[value] = self.counts.pop(victim) + count
+
+    def merge(self, other: "SpaceSaving") -> None:
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0.0) + count
+        if len(self.counts) > self.capacity:
+            self.counts = dict(sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:self.capacity])
+
+    def top(self, k: int) -> List[Tuple[str, float]]:
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def to_bytes(self) -> bytes:
+        return orjson.dumps({"capacity": self.capacity, "counts": self.counts})
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SpaceSaving":
+        state = orjson.loads(data)
+        return cls(state["capacity"], state["counts"])
+
+UNIQUE_DIMENSIONS = ("ip", "endpoint", "referrer")
+TOP_K_DIMENSIONS = ("ip", "referrer")
+
+SKETCH_TYPES = {"hll": HyperLogLog, "cms": CountMinSketch, "topk": SpaceSaving}
+
+# In-memory retention per granularity; older buckets only live in the sketch table.
+BUCKET_RETENTION = {
+    "hour": timedelta(days=2),
+    "day": timedelta(days=32),
+    "month": None
+}
+
+def _bucket_key(timestamp: str, granularity: str) -> str:
+    if granularity == "hour":
+        return timestamp[:13]
+    if granularity == "day":
+        return timestamp[:10]
+    return timestamp[:7]
+
+class SketchStore:
+    """
+    Per-bucket (hour/day/month) sketches: HyperLogLog uniques for ip, endpoint and referrer,
+    Count-Min + Space-Saving heavy hitters for ip and referrer. Every sketch is mergeable, so
+    windows are answered by merging a bounded number of buckets (at most 12 months for a year),
+    and stores from several workers can be combined with `merge`.
+
+    The ingestion writer updates the store on its thread while queries run on the event
+    loop, so buckets are only touched under a lock, and queries merge serialized copies
+    of the buckets taken under it.
+
+    args: persist_interval (float): minimum seconds between writes of dirty buckets to the sketch table
+    """
+    def __init__(self, persist_interval: float = 60.0):
+        self.persist_interval = persist_interval
+        self.buckets: Dict[Tuple[str, str], Dict[str, object]] = {}
+        self._dirty = set()
+        self._last_persist = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _bucket(self, granularity: str, key: str) -> Dict[str, object]:
+        bucket = self.buckets.get((granularity, key))
+        if bucket is None:
+            bucket = {f"hll_{d}": HyperLogLog() for d in UNIQUE_DIMENSIONS}
+            for d in TOP_K_DIMENSIONS:
+                bucket[f"cms_{d}"] = CountMinSketch()
+                bucket[f"topk_{d}"] = SpaceSaving()
+            self.buckets[(granularity, key)] = bucket
+        return bucket
+
+    def update(self, records: List[LogRecord]) -> None:
+        """
+        Folds a flushed batch into the sketches of its hour, day and month buckets.
+
+        args: records (List[LogRecord])
+        returns: None
+        """
+        with self._lock:
+            for record in records:
+                timestamp = str(record.timestamp)
+                for granularity in BUCKET_RETENTION:
+                    key = _bucket_key(timestamp, granularity)
+                    bucket = self._bucket(granularity, key)
+                    self._dirty.add((granularity, key))
+                    for d in UNIQUE_DIMENSIONS:
+                        bucket[f"hll_{d}"].add(str(getattr(record, d)))
+                    for d in TOP_K_DIMENSIONS:
+                        value = str(getattr(record, d))
+                        bucket[f"cms_{d}"].add(value, record.sample_weight)
+                        bucket[f"topk_{d}"].add(value, record.sample_weight)
+
+    def record_batch(self, records: List[LogRecord]) -> None:
+        """
+        Ingestion listener: updates the sketches and periodically persists them through the writer connection.
+        """
+        self.update(records)
+        if time.monotonic() - self._last_persist >= self.persist_interval:
+            self.persist(connection_manager.writer)
+
+    def merge(self, other: "SketchStore") -> None:
+        """
+        Merges another store (e.g. from another worker) into this one.
+        """
+        with other._lock:
+            states = [
+                (key, [(name, sketch.to_bytes()) for name, sketch in other_bucket.items()])
+                for key, other_bucket in other.buckets.items()
+            ]
+        with self._lock:
+            for (granularity, key), sketches in states:
+                bucket = self._bucket(granularity, key)
+                for name, data in sketches:
+                    bucket[name].merge(SKETCH_TYPES[name.split("_")[0]].from_bytes(data))
+                self._dirty.add((granularity, key))
+
+    def _window_buckets(self, mode: str) -> List[Tuple[str, str]]:
+        now = datetime.utcnow()
+        if mode == "hour":
+            return [("hour", now.strftime("%Y-%m-%d %H"))]
+        if mode == "day":
+            return [("day", now.strftime("%Y-%m-%d"))]
+        if mode == "week":
+            return [("day", (now - timedelta(days=i)).strftime("%Y-%m-%d")) for i in range(now.weekday() + 1)]
+        if mode == "month":
+            return [("month", now.strftime("%Y-%m"))]
+        if mode == "year":
+            return [("month", f"{now.year}-{month:02d}") for month in range(1, now.month + 1)]
+        if mode == "alltime":
+            return [key for key in list(self.buckets) if key[0] == "month"]
+        raise ValueError(f"Invalid mode: {mode}")
+
+    def _merged(self, name: str, mode: str):
+        with self._lock:
+            states = [self.buckets[key][name].to_bytes() for key in self._window_buckets(mode) if key in self.buckets]
+        sketch_type = SKETCH_TYPES[name.split("_")[0]]
+        merged = None
+        for data in states:
+            if merged is None:
+                merged = sketch_type.from_bytes(data)
+            else:
+                merged.merge(sketch_type.from_bytes(data))
+        return merged
+
+    def uniques(self, dimension: str, mode: str) -> int:
+        """
+        Approximate number of distinct values of ip, endpoint or referrer within a window.
+
+        args: dimension (str), mode (str)
+        returns: int
+        """
+        if dimension not in UNIQUE_DIMENSIONS:
+            raise ValueError(f"Invalid dimension: {dimension}")
+        merged = self._merged(f"hll_{dimension}", mode)
+        return merged.count() if merged is not None else 0
+
+    def top_k(self, dimension: str, mode: str, k: int = 10) -> List[Dict]:
+        """
+        Approximate heaviest hitters of ip or referrer within a window, with Count-Min estimates.
+
+        args: dimension (str), mode (str), k (int)
+        returns: List[Dict]
+        """
+        if dimension not in TOP_K_DIMENSIONS:
+            raise ValueError(f"Invalid dimension: {dimension}")
+        heavy_hitters = self._merged(f"topk_{dimension}", mode)
+        if heavy_hitters is None:
+            return []
+        counts = self._merged(f"cms_{dimension}", mode)
+        return [
+            {dimension: value, "request_count": round(counts.estimate(value))}
+            for value, _ in heavy_hitters.top(k)
+        ]
+
+    def persist(self, db: duckdb.DuckDBPyConnection) -> None:
+        """
+        Writes dirty buckets to the sketch table and evicts expired ones from memory.
+
+        args: db (duckdb.DuckDBPyConnection)
+        returns: None
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = []
+            for granularity, key in dirty:
+                bucket = self.buckets.get((granularity, key))
+                if bucket is not None:
+                    rows.extend((granularity, key, name, sketch.to_bytes()) for name, sketch in bucket.items())
+
+        try:
+            if rows:
+                db.executemany("""
+                    INSERT OR REPLACE INTO sketch (granularity, bucket, name, data) VALUES (?, ?, ?, ?)
+                """, rows)
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        self._last_persist = time.monotonic()
+        with self._lock:
+            self._evict()
+
+    def load(self, db: duckdb.DuckDBPyConnection) -> None:
+        """
+        Loads the buckets still within their in-memory retention from the sketch table.
+
+        args: db (duckdb.DuckDBPyConnection)
+        returns: None
+        """
+        rows = db.execute("SELECT granularity, bucket, name, data FROM sketch").fetchall()
+        with self._lock:
+            for granularity, key, name, data in rows:
+                if self._expired(granularity, key):
+                    continue
+                bucket = self._bucket(granularity, key)
+                bucket[name] = SKETCH_TYPES[name.split("_")[0]].from_bytes(data)
+        logger.info(f"Loaded {len(self.buckets)} sketch buckets.")
+
+    def _expired(self, granularity: str, key: str) -> bool:
+        retention = BUCKET_RETENTION[granularity]
+        if retention is None:
+            return False
+        cutoff = _bucket_key((datetime.utcnow() - retention).strftime("%Y-%m-%d %H"), granularity)
+        return key < cutoff
+
+    def _evict(self) -> None:
+        for granularity, key in list(self.buckets):
+            if (granularity, key) not in self._dirty and self._expired(granularity, key):
+                del self.buckets[(granularity, key)]
+
+sketch_store = SketchStore()
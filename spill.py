@@ -0,0 +1,244 @@
+import orjson
+import os
+import struct
+import threading
+from typing import Iterator, List, Optional, Set, Tuple
+from models import LogRecord
+
+SPILL_DIR = os.getenv("ZWISCHEN_SPILL_DIR")
+SPILL_MAX_BYTES = int(os.getenv("ZWISCHEN_SPILL_MAX_MB", "1024")) * 1024 * 1024
+
+# Each frame is a 4-byte big-endian length followed by a JSON [sequence number, LogRecord fields] pair.
+FRAME_HEADER = struct.Struct(">I")
+CHECKPOINT_FILE = "checkpoint"
+# Sequence numbers that were done out of order, as 8-byte big-endian integers.
+DONE_FILE = "done"
+DONE_ENTRY = struct.Struct(">Q")
+
+class SpillLog:
+    """
+    Segmented append-only write-ahead log of accepted log records.
+
+    Every record is appended (one unbuffered write, so it survives a crash of the process)
+    with a sequence number before it enters the in-memory queue, and `sync` fsyncs the
+    segments written since the last sync before each batch is written to DuckDB. Once a batch
+    is committed or its records are dropped, `mark_done` advances the checkpoint: the sequence
+    number below which everything has been stored (or deliberately dropped). Sequence numbers
+    done out of order are kept in the done file, so they aren't replayed either. Segments
+    entirely below the checkpoint are deleted, and on startup the writer replays whatever is
+    left from `recovered`.
+
+    Segments never grow past `max_bytes` in total: `append` refuses records once they would.
+    Batches that can't be stored are moved to quarantine files with `quarantine`; those are
+    not replayed and don't count towards `max_bytes`.
+
+    The writer appends on the event loop while `sync` and `read_segment` run in worker
+    threads, so the log's state is guarded by a lock.
+
+    Delivery is at-least-once: a crash between a commit and the checkpoint write replays
+    that batch.
+
+    args: directory (str), segment_bytes (int): size after which a new segment is started,
+          max_bytes (int): total size of the segments after which records are refused
+    """
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, max_bytes: int = SPILL_MAX_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoint = self._read_checkpoint()
+        self.next_sequence = max([self.checkpoint] + [self._last_sequence(path) + 1 for path in self._segments()])
+        # Segments left by a previous run, replayed by the writer before it drains new records.
+        self.recovered = self._segments()
+        self._done: Set[int] = {sequence for sequence in self._read_done() if sequence >= self.checkpoint}
+        self._bytes = sum(os.path.getsize(path) for path in self.recovered)
+        self._file = None
+        self._file_size = 0
+        # Files rotated out since the last sync; they are closed once synced.
+        self._unsynced = []
+        self._lock = threading.Lock()
+
+    def _segments(self) -> List[str]:
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith("segment-"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    @staticmethod
+    def _first_sequence(path: str) -> int:
+        return int(os.path.basename(path)[len("segment-"):-len(".wal")])
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self) -> None:
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(self.checkpoint))
+        os.replace(path + ".tmp", path)
+
+    def _read_done(self) -> List[int]:
+        try:
+            with open(os.path.join(self.directory, DONE_FILE), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        return [sequence for (sequence,) in DONE_ENTRY.iter_unpack(data[:len(data) - len(data) % DONE_ENTRY.size])]
+
+    def _write_done(self, sequences: List[int], mode: str) -> None:
+        path = os.path.join(self.directory, DONE_FILE)
+        target = path if mode == "ab" else path + ".tmp"
+        with open(target, mode) as f:
+            f.write(b"".join(DONE_ENTRY.pack(sequence) for sequence in sequences))
+        if target != path:
+            os.replace(target, path)
+
+    @staticmethod
+    def _frames(path: str) -> Iterator[Tuple[int, LogRecord]]:
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + FRAME_HEADER.size <= len(data):
+            (length,) = FRAME_HEADER.unpack_from(data, offset)
+            payload = data[offset + FRAME_HEADER.size:offset + FRAME_HEADER.size + length]
+            if len(payload) < length:
+                # Torn write at the end of the last segment.
+                break
+            sequence, fields = orjson.loads(payload)
+            yield sequence, LogRecord(*fields)
+            offset += FRAME_HEADER.size + length
+
+    @staticmethod
+    def _frame(sequence: int, record: LogRecord) -> bytes:
+        payload = orjson.dumps([sequence, tuple(record)])
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+    def _last_sequence(self, path: str) -> int:
+        last = self._first_sequence(path) - 1
+        for sequence, _ in self._frames(path):
+            last = sequence
+        return last
+
+    def append(self, record: LogRecord) -> Optional[int]:
+        """
+        Appends a record and returns its sequence number, or None when the log is full.
+
+        args: record (LogRecord)
+        returns: Optional[int]
+        """
+        with self._lock:
+            frame = self._frame(self.next_sequence, record)
+            if self._bytes + len(frame) > self.max_bytes:
+                return None
+            if self._file is None or self._file_size >= self.segment_bytes:
+                self._rotate()
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            self._file.write(frame)
+            self._file_size += len(frame)
+            self._bytes += len(frame)
+            return sequence
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._unsynced.append(self._file)
+        path = os.path.join(self.directory, f"segment-{self.next_sequence:020d}.wal")
+        self._file = open(path, "ab", buffering=0)
+        self._file_size = 0
+
+    def sync(self) -> None:
+        """
+        Forces appended records to disk. Blocking; call it off the event loop.
+        """
+        with self._lock:
+            # Duplicated descriptors stay valid if the writer rotates or closes the files meanwhile.
+            files = self._unsynced + ([self._file] if self._file is not None else [])
+            descriptors = [os.dup(f.fileno()) for f in files]
+            for f in self._unsynced:
+                f.close()
+            self._unsynced = []
+        for descriptor in descriptors:
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+
+    def mark_done(self, sequences: List[int]) -> None:
+        """
+        Records that these sequence numbers were stored or dropped, advances the checkpoint
+        and deletes segments that lie entirely below it.
+
+        args: sequences (List[int])
+        returns: None
+        """
+        if not sequences:
+            return
+        with self._lock:
+            # Appended before the checkpoint moves; entries below the checkpoint are ignored on startup.
+            self._write_done(sequences, "ab")
+            self._done.update(sequences)
+            checkpoint = self.checkpoint
+            while checkpoint in self._done:
+                self._done.remove(checkpoint)
+                checkpoint += 1
+            if checkpoint == self.checkpoint:
+                return
+            self.checkpoint = checkpoint
+            self._write_checkpoint()
+            self._write_done(sorted(self._done), "wb")
+
+            segments = self._segments()
+            current = self._file.name if self._file is not None else None
+            for path, following in zip(segments, segments[1:]):
+                if path != current and self._first_sequence(following) <= self.checkpoint:
+                    self._bytes -= os.path.getsize(path)
+                    os.remove(path)
+
+    def quarantine(self, items: List[Tuple[int, LogRecord]]) -> str:
+        """
+        Writes a batch that could not be stored to its own quarantine file, in the segment
+        format, and marks it done. Blocking; call it off the event loop.
+
+        args: items (List[Tuple[int, LogRecord]]): (sequence, record) pairs
+        returns: str (path of the quarantine file)
+        """
+        path = os.path.join(self.directory, f"quarantine-{items[0][0]:020d}.wal")
+        with open(path, "ab") as f:
+            f.write(b"".join(self._frame(sequence, record) for sequence, record in items))
+            f.flush()
+            os.fsync(f.fileno())
+        self.mark_done([sequence for sequence, _ in items])
+        return path
+
+    def read_segment(self, path: str) -> List[Tuple[int, LogRecord]]:
+        """
+        Returns the (sequence, record) pairs of a recovered segment that are not done yet.
+        Blocking; call it off the event loop.
+
+        args: path (str)
+        returns: List[Tuple[int, LogRecord]]
+        """
+        with self._lock:
+            checkpoint, done = self.checkpoint, set(self._done)
+        return [(sequence, record) for sequence, record in self._frames(path)
+                if sequence >= checkpoint and sequence not in done]
+
+    def pending(self) -> int:
+        """
+        Number of appended records not yet stored or dropped.
+        """
+        with self._lock:
+            return self.next_sequence - self.checkpoint - len(self._done)
+
+    def close(self) -> None:
+        with self._lock:
+            for f in self._unsynced + ([self._file] if self._file is not None else []):
+                f.close()
+            self._unsynced = []
+            self._file = None
+            if self.next_sequence - self.checkpoint - len(self._done) == 0:
+                for path in self._segments():
+                    os.remove(path)
+                self._bytes = 0
@@ -0,0 +1,261 @@
+import asyncio
+import duckdb
+import logging
+import os
+import shutil
+import uuid
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+from database import compact_log, connection_manager, log_write_table, write_executor
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "zwischen_archive"
+# Each archive run writes its partitions to a staging directory inside the archive first.
+STAGING_PREFIX = ".staging-"
+
+def truncate(moment: datetime, unit: str) -> datetime:
+    """
+    Python counterpart of DuckDB's date_trunc for minute/hour/day/week/month/year.
+
+    args: moment (datetime), unit (str)
+    returns: datetime
+    """
+    if unit == "minute":
+        return moment.replace(second=0, microsecond=0)
+    if unit == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == "week":
+        return day - timedelta(days=day.weekday())
+    if unit == "month":
+        return day.replace(day=1)
+    if unit == "year":
+        return day.replace(month=1, day=1)
+    return day
+
+def window_start(mode: str) -> Optional[datetime]:
+    """
+    Start of the window a query mode covers, mirroring date_trunc(mode, now). None for "alltime".
+
+    args: mode (str)
+    returns: Optional[datetime]
+    """
+    if mode == "alltime":
+        return None
+    return truncate(datetime.utcnow(), mode)
+
+def window_filter(mode: str, column: str = "bucket") -> str:
+    """
+    SQL predicate restricting `column` to the window of a query mode. The window start is a
+    bound parameter (see `window_params`) rather than date_trunc(mode, current_timestamp):
+    that is a TIMESTAMPTZ, and comparing the TIMESTAMP column with it stops DuckDB from
+    pruning row groups by their zone maps. Empty for "alltime".
+
+    args: mode (str), column (str)
+    returns: str
+    """
+    if mode == "alltime":
+        return ""
+    return f"AND {column} >= ?"
+
+def window_params(mode: str) -> List[datetime]:
+    """
+    Parameters bound by `window_filter(mode)`.
+
+    args: mode (str)
+    returns: List[datetime]
+    """
+    since = window_start(mode)
+    return [] if since is None else [since]
+
+class LogArchiver:
+    """
+    Moves closed days of the hot log table into hive-partitioned (date=YYYY-MM-DD),
+    zstd-compressed Parquet files and expires archived days past their retention.
+    With sorted log storage, each run also re-sorts the hot table if it has drifted out of timestamp order.
+
+    COPY writes files outside the transaction that deletes the rows from log, so a run
+    exports to a staging directory and records it in the archive_staging table in that
+    transaction. Only staging directories recorded there are moved into the partitions;
+    others are left by runs that didn't commit and are deleted. A file is therefore
+    visible in the archive if and only if its rows are gone from log.
+
+    args: archive_dir (str), hot_retention_days (int): full days kept in the hot table,
+          archive_retention_days (Optional[int]): days kept in the archive, None to keep forever,
+          interval (float): seconds between archival runs of the background task
+    """
+    def __init__(self, archive_dir: str = ARCHIVE_DIR, hot_retention_days: int = 7, archive_retention_days: Optional[int] = None, interval: float = 3600.0):
+        self.archive_dir = archive_dir
+        self.hot_retention_days = hot_retention_days
+        self.archive_retention_days = archive_retention_days
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def archived_dates(self) -> List[date]:
+        """
+        Returns the dates that have an archive partition, oldest first.
+        """
+        if not os.path.isdir(self.archive_dir):
+            return []
+
+        dates = []
+        for name in os.listdir(self.archive_dir):
+            if name.startswith("date="):
+                try:
+                    dates.append(date.fromisoformat(name[len("date="):]))
+                except ValueError:
+                    continue
+        return sorted(dates)
+
+    def partition_files(self, since: Optional[datetime] = None) -> List[str]:
+        """
+        Returns the Parquet files of partitions that can hold rows at or after `since`.
+
+        args: since (Optional[datetime])
+        returns: List[str]
+        """
+        return [
+            os.path.join(self.archive_dir, f"date={d.isoformat()}", "*.parquet")
+            for d in self.archived_dates()
+            if since is None or d >= since.date()
+        ]
+
+    def log_source(self, since: Optional[datetime] = None) -> str:
+        """
+        SQL relation over the hot log table plus the archived partitions overlapping the window.
+        Partitions entirely before `since` are pruned by never being handed to read_parquet.
+
+        args: since (Optional[datetime])
+        returns: str
+        """
+        files = self.partition_files(since)
+        if not files:
+            return "log"
+
+        file_list = ", ".join(f"'{f}'" for f in files)
+        return f"""(
+            SELECT * FROM log
+            UNION ALL BY NAME
+            SELECT * EXCLUDE (date) FROM read_parquet([{file_list}], hive_partitioning = true, union_by_name = true)
+        )"""
+
+    def archive(self, db: duckdb.DuckDBPyConnection) -> int:
+        """
+        Exports every closed day older than the hot retention period to Parquet and deletes it
+        from log, except rows still waiting for their location.
+
+        args: db (duckdb.DuckDBPyConnection)
+        returns: int (number of archived rows)
+        """
+        cutoff = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=self.hot_retention_days)
+        # Finish (or discard) whatever an interrupted run left behind first.
+        self.publish_staged(db)
+
+        # Rows stored without a location (deferred GeoIP enrichment) stay in log until the
+        # backfill has located them; it never looks at the archive. The log view takes city from
+        # geo_dim through geo_id, so in the compact layout `located` selects exactly the rows of
+        # log_compact that have a city in log.
+        if log_write_table() == "log_compact":
+            located = "geo_id IN (SELECT geo_id FROM geo_dim WHERE city IS NOT NULL)"
+        else:
+            located = "city IS NOT NULL"
+        staging = f"{STAGING_PREFIX}{uuid.uuid4().hex}"
+        os.makedirs(self.archive_dir, exist_ok=True)
+        db.begin()
+        try:
+            count = db.execute("SELECT COUNT(*) FROM log WHERE timestamp < ? AND city IS NOT NULL", [cutoff]).fetchone()[0]
+            if count:
+                copied = db.execute(f"""
+                    COPY (SELECT *, CAST(timestamp AS DATE) AS date FROM log WHERE timestamp < ? AND city IS NOT NULL)
+                    TO '{os.path.join(self.archive_dir, staging)}' (FORMAT PARQUET, PARTITION_BY (date), COMPRESSION ZSTD, FILENAME_PATTERN 'log_{{uuid}}')
+                """, [cutoff]).fetchone()[0]
+                deleted = db.execute(f"DELETE FROM {log_write_table()} WHERE timestamp < ? AND {located}", [cutoff]).fetchone()[0]
+                if deleted != copied:
+                    # Never delete a row that isn't in the archive.
+                    raise duckdb.InvalidInputException(f"Archive run copied {copied} log rows but deleted {deleted}")
+                db.execute("INSERT INTO archive_staging VALUES (?)", [staging])
+            db.commit()
+        except duckdb.Error:
+            db.rollback()
+            shutil.rmtree(os.path.join(self.archive_dir, staging), ignore_errors=True)
+            raise
+
+        if count:
+            self.publish_staged(db)
+            logger.info(f"Archived {count} log rows older than {cutoff.date()} to {self.archive_dir}.")
+        return count
+
+    def publish_staged(self, db: duckdb.DuckDBPyConnection) -> None:
+        """
+        Moves the files of committed staging directories into their date partitions and
+        deletes staging directories whose run rolled back or never committed.
+
+        args: db (duckdb.DuckDBPyConnection)
+        returns: None
+        """
+        db.execute("CREATE TABLE IF NOT EXISTS archive_staging (directory VARCHAR)")
+        committed = {directory for directory, in db.execute("SELECT directory FROM archive_staging").fetchall()}
+        if not os.path.isdir(self.archive_dir):
+            return
+
+        for name in os.listdir(self.archive_dir):
+            if not name.startswith(STAGING_PREFIX):
+                continue
+            staging = os.path.join(self.archive_dir, name)
+            if name in committed:
+                for partition in os.listdir(staging):
+                    target = os.path.join(self.archive_dir, partition)
+                    os.makedirs(target, exist_ok=True)
+                    for file in os.listdir(os.path.join(staging, partition)):
+                        # File names are unique, so a rename never replaces an archived file.
+                        os.replace(os.path.join(staging, partition, file), os.path.join(target, file))
+            shutil.rmtree(staging)
+        if committed:
+            db.execute("DELETE FROM archive_staging")
+
+    def expire(self) -> int:
+        """
+        Deletes archived partitions older than the archive retention period.
+
+        returns: int (number of deleted partitions)
+        """
+        if self.archive_retention_days is None:
+            return 0
+
+        oldest_kept = datetime.utcnow().date() - timedelta(days=self.archive_retention_days)
+        expired = [d for d in self.archived_dates() if d < oldest_kept]
+        for d in expired:
+            shutil.rmtree(os.path.join(self.archive_dir, f"date={d.isoformat()}"))
+
+        if expired:
+            logger.info(f"Expired {len(expired)} archived log partitions.")
+        return len(expired)
+
+    def start(self) -> None:
+        """
+        Starts the periodic archival task on the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await write_executor.run(self.archive, connection_manager.writer)
+                self.expire()
+                await write_executor.run(compact_log, connection_manager.writer)
+            except Exception as e:
+                logger.error(f"Log archival failed: {e}")
+            await asyncio.sleep(self.interval)
+
+log_archiver = LogArchiver()
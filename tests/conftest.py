@@ -0,0 +1,31 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# utils resolves the GeoLite2 path at import time; without the file every IP gets the "Unknown" location.
+os.environ.setdefault("SERVER_PATH", ROOT)
+
+import pytest
+
+import crud
+import database
+from cache import query_cache
+from database import connection_manager
+from dimensions import DimensionInterner
+
+@pytest.fixture(params=["wide", "compact"])
+def db(request, tmp_path, monkeypatch):
+    """
+    Writer connection to a fresh database in the wide or compact log layout.
+    """
+    monkeypatch.setattr(database, "LOG_SCHEMA", request.param)
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "zwischen.duckdb"))
+    # Known dimension keys belong to the previous test's database.
+    monkeypatch.setattr(crud, "dimension_interner", DimensionInterner())
+    query_cache.clear()
+    connection_manager.open()
+    database.create_serial_sequence(connection_manager.writer)
+    database.init_zwischen_db()
+    yield connection_manager.writer
+    connection_manager.close()
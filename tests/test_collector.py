@@ -0,0 +1,80 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+
+from database import connection_manager
+from ingestion import CollectorSink, CollectorQueries, LogIngestionQueue
+from models import LogRecord
+from sketches import SketchStore
+
+def test_worker_queries_are_answered_by_the_collector(db, tmp_path, monkeypatch):
+    # The archiver started with the collector works relative to the current directory.
+    monkeypatch.chdir(tmp_path)
+    import main
+    from collector import CollectorServer
+
+    socket_path = str(tmp_path / "collector.sock")
+    store = SketchStore()
+    server = CollectorServer(
+        socket_path, LogIngestionQueue(batch_size=10, flush_interval=0.05, listeners=[store.record_batch]), store
+    )
+    worker = LogIngestionQueue(batch_size=10, flush_interval=0.05, sink=CollectorSink(socket_path))
+    start = datetime.utcnow().replace(second=0, microsecond=0)
+    now = start.strftime("%Y-%m-%d %H:%M:%S")
+    records = [
+        LogRecord(f"10.0.0.{i % 5}", "GET", "/", 200, now, "Chrome", "Linux", "desktop", "unknown")
+        for i in range(20)
+    ]
+    monkeypatch.setattr(main, "collector_queries", CollectorQueries(socket_path))
+
+    async def run():
+        await server.start()
+        try:
+            worker.start()
+            for record in records:
+                worker.enqueue(record)
+            await worker.stop()
+            # The writer thread owns the connection; read through a cursor of it.
+            cursor = connection_manager.cursor()
+            for _ in range(100):
+                if cursor.execute("SELECT COUNT(*) FROM log").fetchone()[0] == len(records):
+                    break
+                await asyncio.sleep(0.05)
+
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+                uniques = (await client.get("/metrics/uniques", params={"dimension": "ip"})).json()
+                top = (await client.get("/metrics/topk", params={"dimension": "ip", "k": 1})).json()
+                series = (await client.get("/metrics/timeseries", params={
+                    "start": start.isoformat(), "end": (start + timedelta(minutes=1)).isoformat(), "granularity": "minute"
+                })).json()
+                top_n = (await client.get("/metrics/top", params={"dimension": "ip", "n": 1})).json()
+            return uniques, top, series, top_n
+        finally:
+            await server.stop()
+
+    uniques, top, series, top_n = asyncio.run(run())
+    assert uniques["uniques"] == 5
+    assert top["top"][0]["request_count"] == 4
+    assert [point["request_count"] for point in series["series"]] == [20]
+    assert top_n["dimension"] == ["ip"]
+    assert top_n["request_count"] == [4]
+
+def test_worker_queries_fail_when_the_collector_is_down(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import main
+
+    monkeypatch.setattr(main, "collector_queries", CollectorQueries(str(tmp_path / "missing.sock")))
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            return [
+                (await client.get(path, params=params)).status_code
+                for path, params in (
+                    ("/metrics/uniques", {}),
+                    ("/metrics/top", {"dimension": "ip"}),
+                    ("/metrics/timeseries", {"start": "2026-01-01T00:00:00", "end": "2026-01-01T01:00:00"})
+                )
+            ]
+
+    assert asyncio.run(run()) == [503, 503, 503]
@@ -0,0 +1,34 @@
+import calendar
+
+import database
+from importer import COMBINED_LOG_PATTERN, load_chunk, parse_chunk, parse_time_local
+
+LINE = '1.2.3.4 - - [10/Oct/2000:13:55:36 -0700] "{method} /items/7?page=2 HTTP/1.1" 200 {size} "-" "Mozilla/5.0"\n'
+
+def test_time_local_offset_is_converted_to_utc():
+    assert parse_time_local("10/Oct/2000:13:55:36 -0700") == calendar.timegm((2000, 10, 10, 20, 55, 36))
+    assert parse_time_local("10/Oct/2000:13:55:36 +0130") == calendar.timegm((2000, 10, 10, 12, 25, 36))
+
+def test_malformed_lines_are_counted():
+    chunk = (LINE.format(method="GET", size=512) + "not an access log line\n").encode()
+    assert len(COMBINED_LOG_PATTERN.findall(chunk.decode())) == 1
+
+    table, counts = parse_chunk(chunk)
+
+    assert table.num_rows == 1
+    assert counts == {"lines": 2, "malformed": 1, "skipped": 0}
+
+def test_missing_size_is_stored_as_null():
+    table, _ = parse_chunk(LINE.format(method="GET", size="-").encode())
+    assert table.column("response_size").to_pylist() == [None]
+    assert table.column("referrer").to_pylist() == ["unknown"]
+
+def test_unknown_method_is_imported(db):
+    table, _ = parse_chunk((LINE.format(method="GET", size=512) + LINE.format(method="PROPFIND", size=512)).encode())
+    load_chunk(db, table)
+
+    stored = "OTHER" if database.log_layout == "compact" else "PROPFIND"
+    methods = sorted(method for method, in db.execute("SELECT method FROM log").fetchall())
+    assert methods == sorted(["GET", stored])
+    rollup = dict(db.execute("SELECT value, SUM(request_count) FROM log_rollup_day WHERE dimension = 'method' GROUP BY value").fetchall())
+    assert rollup == {"GET": 1, stored: 1}
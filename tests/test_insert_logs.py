@@ -0,0 +1,57 @@
+import asyncio
+import threading
+
+import crud
+from models import LogRecord
+
+def make_records(count: int, batch: int = 0, method: str = "GET"):
+    return [
+        LogRecord(
+            f"10.{batch % 250}.{i // 250 % 250}.{i % 250}", method, f"/items/{i % 40}", 200,
+            f"2026-10-18 10:{(batch + i) % 60:02d}:{i % 60:02d}", "Chrome", "Linux", "desktop",
+            f"https://referrer{i % 30}.example"
+        )
+        for i in range(count)
+    ]
+
+def test_unknown_methods_are_counted_as_stored(db):
+    result = asyncio.run(crud.insert_logs(make_records(10, method="PROPFIND"), db))
+    assert (result["inserted"], result["skipped"]) == (10, 0)
+
+    stored = {method for method, in db.execute("SELECT DISTINCT CAST(method AS VARCHAR) FROM log").fetchall()}
+    counted = {value for value, in db.execute("SELECT DISTINCT value FROM log_rollup_day WHERE dimension = 'method'").fetchall()}
+    assert counted == stored
+
+def test_deferred_user_agents_are_classified_off_the_event_loop(db, monkeypatch):
+    threads = set()
+
+    class RecordingClassifier:
+        def classify(self, user_agent_string):
+            threads.add(threading.current_thread())
+            return ("Firefox", "Linux", "desktop")
+
+    monkeypatch.setattr(crud, "user_agent_classifier", RecordingClassifier())
+    records = [record._replace(browser=None, os=None, device=None, user_agent="Mozilla/5.0 Firefox/130.0") for record in make_records(5)]
+    asyncio.run(crud.insert_logs(records, db))
+
+    assert threads and threading.main_thread() not in threads
+    assert db.execute("SELECT DISTINCT browser FROM log").fetchall() == [("Firefox",)]
+
+def test_consecutive_batches_are_stored_with_their_rollups(db):
+    # Throughput is measured by bench_insert.py.
+    async def run():
+        inserted = 0
+        for batch in range(20):
+            inserted += (await crud.insert_logs(make_records(500, batch), db))["inserted"]
+        return inserted
+
+    assert asyncio.run(run()) == 10000
+    assert db.execute("SELECT COUNT(*), COUNT(DISTINCT endpoint) FROM log").fetchone() == (10000, 40)
+    rollup = db.execute("SELECT SUM(request_count) FROM log_rollup_day WHERE dimension = 'endpoint'").fetchone()[0]
+    assert rollup == 10000
+
+def test_only_stored_records_are_returned(db):
+    records = make_records(3) + [LogRecord("not-an-ip", "GET", "/", 200, "2026-10-18 10:00:00", "Chrome", "Linux", "desktop", "unknown")]
+    result = asyncio.run(crud.insert_logs(records, db))
+    assert (result["inserted"], result["skipped"]) == (3, 1)
+    assert result["records"] == records[:3]
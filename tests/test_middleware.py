@@ -0,0 +1,40 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from ingestion import LogIngestionQueue
+from middleware import ZwischenASGIMiddleware, ZwischenMiddleware
+
+@pytest.mark.parametrize("middleware_class", [ZwischenMiddleware, ZwischenASGIMiddleware])
+def test_mounted_routes_are_logged_with_their_mount_prefix(middleware_class):
+    stored = []
+
+    async def sink(batch):
+        stored.extend(batch)
+        return {"inserted": len(batch), "skipped": 0}
+
+    queue = LogIngestionQueue(sink=sink)
+    app = FastAPI()
+    api = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def top_level_item(item_id: int):
+        return {}
+
+    @api.get("/items/{item_id}")
+    async def mounted_item(item_id: int):
+        return {}
+
+    app.mount("/api", api)
+    app.add_middleware(middleware_class, ingestion_queue=queue, live=None, prometheus=None)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=("1.2.3.4", 5000)), base_url="http://test") as client:
+            for path in ("/items/1", "/api/items/2", "/api/users/3"):
+                await client.get(path)
+        await queue.stop()
+
+    asyncio.run(run())
+    assert [record.endpoint for record in stored] == ["/items/{item_id}", "/api/items/{item_id}", "/api/users/{id}"]
@@ -0,0 +1,25 @@
+from prometheus import PrometheusMetrics
+
+def test_unknown_methods_share_one_label():
+    metrics = PrometheusMetrics()
+    for method in ("GET", "PROPFIND", "X-RANDOM-1", "X-RANDOM-2"):
+        metrics.record("/", method, 200, 1_000_000)
+
+    rendered = metrics.render()
+    assert 'zwischen_requests_total{endpoint="/",method="GET",status="200"} 1' in rendered
+    assert 'zwischen_requests_total{endpoint="/",method="OTHER",status="200"} 3' in rendered
+    assert "X-RANDOM" not in rendered
+
+def test_monotonic_values_are_rendered_as_counters():
+    metrics = PrometheusMetrics()
+    counters = {"zwischen_ingestion_dropped_records": ("Dropped records.", 7)}
+    gauges = {"zwischen_ingestion_queue_depth": ("Queued records.", 3)}
+
+    prometheus = metrics.render(gauges=gauges, counters=counters).splitlines()
+    assert "# TYPE zwischen_ingestion_dropped_records_total counter" in prometheus
+    assert "zwischen_ingestion_dropped_records_total 7" in prometheus
+    assert "# TYPE zwischen_ingestion_queue_depth gauge" in prometheus
+
+    openmetrics = metrics.render(openmetrics=True, gauges=gauges, counters=counters).splitlines()
+    assert "# TYPE zwischen_ingestion_dropped_records counter" in openmetrics
+    assert "zwischen_ingestion_dropped_records_total 7" in openmetrics
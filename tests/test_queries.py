@@ -0,0 +1,63 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import crud
+from database import connection_manager, prune_rollups
+from models import LogRecord
+
+def test_windows_exclude_older_requests(db):
+    now = datetime.utcnow()
+    timestamps = [now] * 3 + [now - timedelta(days=400)] * 2
+    records = [
+        LogRecord("1.2.3.4", "GET", "/", 200, t.strftime("%Y-%m-%d %H:%M:%S"), "Chrome", "Linux", "desktop", "unknown", duration_ns=1000)
+        for t in timestamps
+    ]
+
+    async def run():
+        await crud.insert_logs(records, db)
+        cursor = connection_manager.cursor()
+        return {
+            mode: (
+                (await crud.number_of_requests(mode, cursor))["count"],
+                (await crud.requests_by_ip(5, mode, cursor))["requests"][0]["request_count"],
+                (await crud.top_n(["ip"], 5, mode, cursor, filters={"method": "GET"}))["requests"]["ip"][0]["request_count"],
+                (await crud.latency_percentiles(5, mode, cursor))["latencies"][0]["request_count"]
+            )
+            for mode in ("day", "year", "alltime")
+        }
+
+    counts = asyncio.run(run())
+    assert counts["day"] == (3, 3, 3, 3)
+    assert counts["year"] == (3, 3, 3, 3)
+    assert counts["alltime"] == (5, 5, 5, 5)
+
+def test_time_series_past_rollup_retention_reads_the_log(db):
+    start = (datetime.utcnow() - timedelta(days=3)).replace(second=0, microsecond=0)
+    records = [
+        LogRecord("1.2.3.4", "GET", "/", 200, start.strftime("%Y-%m-%d %H:%M:%S"), "Chrome", "Linux", "desktop", "unknown", duration_ns=1000)
+        for _ in range(5)
+    ]
+
+    async def run():
+        await crud.insert_logs(records, db)
+        prune_rollups(db)
+        return await crud.time_series(start, start + timedelta(minutes=1), "minute", connection_manager.cursor(), include_latency=False)
+
+    series = asyncio.run(run())["series"]
+    assert [point["request_count"] for point in series] == [5]
+
+def test_prune_rollups_cutoff_is_utc(db):
+    # A session time zone ahead of UTC must not move the cutoff forward.
+    db.execute("SET TimeZone = 'Pacific/Kiritimati'")
+    recent = (datetime.utcnow() - timedelta(days=2) + timedelta(hours=1)).replace(second=0, microsecond=0)
+    expired = recent - timedelta(hours=2)
+    records = [
+        LogRecord("1.2.3.4", "GET", "/", 200, t.strftime("%Y-%m-%d %H:%M:%S"), "Chrome", "Linux", "desktop", "unknown", duration_ns=1000)
+        for t in (recent, expired)
+    ]
+    asyncio.run(crud.insert_logs(records, db))
+
+    prune_rollups(db)
+
+    buckets = db.execute("SELECT DISTINCT bucket FROM log_rollup_minute").fetchall()
+    assert buckets == [(recent,)]
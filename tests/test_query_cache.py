@@ -0,0 +1,61 @@
+import asyncio
+
+from cache import QueryCache
+from models import LogRecord
+
+def record(timestamp: str = "2999-01-01 00:00:00") -> LogRecord:
+    return LogRecord("1.2.3.4", "GET", "/", 200, timestamp, "Chrome", "Linux", "desktop", "unknown")
+
+def test_result_computed_across_a_write_is_not_cached():
+    cache = QueryCache()
+    count = {"count": 10}
+
+    async def run():
+        async def compute():
+            # The batch commits while the query runs; whether it saw the new row is unknown.
+            cache.begin_write()
+            count["count"] += 1
+            cache.end_write([record()])
+            return dict(count)
+
+        first = await cache.get("requests", "day", compute)
+        second = await cache.get("requests", "day", lambda: asyncio.sleep(0, dict(count)))
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == {"count": 11}
+    assert second == {"count": 11}
+    assert cache.stats()["size"] == 1
+
+def test_result_computed_during_a_write_is_not_cached():
+    cache = QueryCache()
+
+    async def run():
+        cache.begin_write()
+        await cache.get("requests", "day", lambda: asyncio.sleep(0, {"count": 10}))
+        cache.end_write([record()])
+
+    asyncio.run(run())
+    assert cache.stats()["size"] == 0
+
+def test_committed_batch_is_patched_once():
+    cache = QueryCache()
+
+    async def run():
+        await cache.get("requests", "day", lambda: asyncio.sleep(0, {"count": 10}))
+        cache.begin_write()
+        cache.end_write([record(), record()])
+        return await cache.get("requests", "day", lambda: asyncio.sleep(0, {"count": -1}))
+
+    assert asyncio.run(run()) == {"count": 12}
+
+def test_rolled_back_batch_is_not_patched():
+    cache = QueryCache()
+
+    async def run():
+        await cache.get("requests", "day", lambda: asyncio.sleep(0, {"count": 10}))
+        cache.begin_write()
+        cache.end_write()
+        return await cache.get("requests", "day", lambda: asyncio.sleep(0, {"count": -1}))
+
+    assert asyncio.run(run()) == {"count": 10}
@@ -0,0 +1,48 @@
+import sys
+import threading
+from datetime import datetime, timedelta
+
+from models import LogRecord
+from sketches import SketchStore
+
+def test_queries_run_while_the_writer_updates(monkeypatch):
+    store = SketchStore()
+    start = datetime(2026, 10, 18)
+    latest = [start.strftime("%Y-%m-%d %H")]
+    # Merges the bucket the writer is filling into a copy of the first one.
+    monkeypatch.setattr(store, "_window_buckets", lambda mode: [("hour", start.strftime("%Y-%m-%d %H")), ("hour", latest[0])])
+    stop = threading.Event()
+    errors = []
+
+    def write():
+        hour = 0
+        while not stop.is_set():
+            timestamp = start + timedelta(hours=hour)
+            latest[0] = timestamp.strftime("%Y-%m-%d %H")
+            # A new bucket grows by one Space-Saving entry per record until its capacity.
+            store.update([
+                LogRecord(f"10.0.0.{i}", "GET", "/", 200, timestamp.strftime("%Y-%m-%d %H:%M:%S"), "Chrome", "Linux", "desktop", f"https://r{i}.example")
+                for i in range(60)
+            ])
+            hour += 1
+
+    def query():
+        try:
+            for _ in range(5000):
+                store.top_k("referrer", "hour", 5)
+        except RuntimeError as e:
+            errors.append(e)
+
+    # Switch threads often, so that the query runs in the middle of an update.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        query()
+    finally:
+        stop.set()
+        writer.join()
+        sys.setswitchinterval(interval)
+
+    assert errors == []
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import threading
+
+from ingestion import LogIngestionQueue
+from models import LogRecord
+from spill import SpillLog
+
+def make_record(i: int) -> LogRecord:
+    return LogRecord(f"10.0.0.{i}", "GET", "/", 200, "2024-06-19 14:30:00", "Chrome", "Linux", "desktop", "unknown")
+
+def replayed(directory) -> list:
+    spill = SpillLog(str(directory))
+    return [sequence for path in spill.recovered for sequence, _ in spill.read_segment(path)]
+
+async def failing_sink(batch):
+    return {"error": "rejected"}
+
+def test_dropped_records_are_not_replayed(tmp_path, monkeypatch):
+    spill = SpillLog(str(tmp_path))
+    queue = LogIngestionQueue(max_size=2, policy="drop_oldest", sink=failing_sink, spill=spill)
+    marked_on = []
+    mark_done = spill.mark_done
+
+    def recording_mark_done(sequences):
+        marked_on.append(threading.current_thread())
+        mark_done(sequences)
+
+    monkeypatch.setattr(spill, "mark_done", recording_mark_done)
+
+    async def run():
+        for i in range(4):
+            queue.enqueue(make_record(i))
+        # The queued records can't be stored; stop() leaves them in the spill log.
+        await queue.stop()
+
+    asyncio.run(run())
+
+    assert queue.dropped == 2
+    assert marked_on and threading.main_thread() not in marked_on
+    assert replayed(tmp_path) == [2, 3]
+
+def test_done_offsets_survive_a_restart(tmp_path):
+    spill = SpillLog(str(tmp_path))
+    for i in range(3):
+        spill.append(make_record(i))
+    spill.mark_done([1])
+    spill.close()
+
+    assert replayed(tmp_path) == [0, 2]
+    assert SpillLog(str(tmp_path)).pending() == 2
+
+def test_failing_batch_is_quarantined(tmp_path):
+    spill = SpillLog(str(tmp_path))
+    queue = LogIngestionQueue(batch_size=2, flush_interval=0.01, sink=failing_sink, spill=spill, max_attempts=3)
+
+    async def run():
+        queue.start()
+        queue.enqueue(make_record(0))
+        queue.enqueue(make_record(1))
+        for _ in range(100):
+            if queue.quarantined:
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(run())
+
+    assert queue.failed_flushes == 3
+    assert queue.quarantined == 2
+    quarantined = [name for name in os.listdir(tmp_path) if name.startswith("quarantine-")]
+    assert len(quarantined) == 1
+    assert [sequence for sequence, _ in SpillLog._frames(str(tmp_path / quarantined[0]))] == [0, 1]
+    assert replayed(tmp_path) == []
+
+def test_spill_size_is_bounded(tmp_path):
+    spill = SpillLog(str(tmp_path), segment_bytes=1024, max_bytes=4096)
+    queue = LogIngestionQueue(max_size=1000, spill=spill)
+
+    async def run():
+        return [queue.enqueue(make_record(i)) for i in range(200)]
+
+    accepted = asyncio.run(run())
+
+    segments = [name for name in os.listdir(tmp_path) if name.startswith("segment-")]
+    assert sum(os.path.getsize(tmp_path / name) for name in segments) <= 4096
+    assert not all(accepted)
+    assert queue.dropped == accepted.count(False)
+    assert spill.pending() == accepted.count(True)
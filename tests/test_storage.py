@@ -0,0 +1,92 @@
+import asyncio
+import glob
+import os
+from datetime import datetime, timedelta
+
+import duckdb
+import pytest
+
+import crud
+import database
+import storage
+from enrichment import geo_enricher
+from models import LocationData, LogRecord
+from storage import LogArchiver
+
+def old_records(count: int):
+    timestamp = (datetime.utcnow() - timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S")
+    return [LogRecord("1.2.3.4", "GET", "/", 200, timestamp, "Chrome", "Linux", "desktop", "unknown") for _ in range(count)]
+
+def total(db, archiver: LogArchiver) -> int:
+    return db.execute(f"SELECT COUNT(*) FROM {archiver.log_source()}").fetchone()[0]
+
+def test_failed_archive_run_leaves_no_files(db, tmp_path, monkeypatch):
+    archiver = LogArchiver(str(tmp_path / "archive"))
+    asyncio.run(crud.insert_logs(old_records(5), db))
+    # The DELETE fails after the COPY has written its files.
+    monkeypatch.setattr(storage, "log_write_table", lambda: "missing_table")
+
+    with pytest.raises(duckdb.Error):
+        archiver.archive(db)
+
+    assert glob.glob(str(tmp_path / "archive" / "**" / "*.parquet"), recursive=True) == []
+    assert total(db, archiver) == 5
+
+def test_interrupted_publish_is_finished_by_the_next_run(db, tmp_path, monkeypatch):
+    archiver = LogArchiver(str(tmp_path / "archive"))
+    asyncio.run(crud.insert_logs(old_records(5), db))
+    publish = LogArchiver.publish_staged
+    calls = []
+
+    def crash_after_commit(self, db):
+        calls.append(None)
+        if len(calls) == 2:
+            raise OSError("crashed before publishing")
+        publish(self, db)
+
+    monkeypatch.setattr(LogArchiver, "publish_staged", crash_after_commit)
+    with pytest.raises(OSError):
+        archiver.archive(db)
+    monkeypatch.setattr(LogArchiver, "publish_staged", publish)
+    # Committed but not yet published: the rows are in neither place.
+    assert total(db, archiver) == 0
+
+    assert archiver.archive(db) == 0
+    assert total(db, archiver) == 5
+    assert [name for name in os.listdir(tmp_path / "archive") if not name.startswith("date=")] == []
+
+class FixedResolver:
+    def lookup(self, ip: str):
+        return LocationData(city="London", country="United Kingdom", latitude=51.5, longitude=-0.1)
+
+def test_unresolved_rows_are_archived_after_the_backfill(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(geo_enricher, "mode", "deferred")
+    monkeypatch.setattr(geo_enricher, "resolver", FixedResolver())
+    archiver = LogArchiver(str(tmp_path / "archive"))
+    asyncio.run(crud.insert_logs(old_records(5), db))
+
+    # Past the hot retention period, but not located yet.
+    assert archiver.archive(db) == 0
+    assert asyncio.run(geo_enricher.backfill()) == 5
+    assert archiver.archive(db) == 5
+
+    located = db.execute(f"SELECT city, COUNT(*) FROM {archiver.log_source()} GROUP BY city").fetchall()
+    assert located == [("London", 5)]
+    city_rollup = db.execute("SELECT value, SUM(request_count) FROM log_rollup_day WHERE dimension = 'city' GROUP BY value").fetchall()
+    assert city_rollup == [("London", 5.0)]
+
+def test_compact_archive_keeps_rows_without_a_location(db, tmp_path, monkeypatch):
+    if database.log_layout != "compact":
+        pytest.skip("geo_id only exists in the compact layout")
+    monkeypatch.setattr(geo_enricher, "resolver", FixedResolver())
+    archiver = LogArchiver(str(tmp_path / "archive"))
+    asyncio.run(crud.insert_logs(old_records(2), db))
+    monkeypatch.setattr(geo_enricher, "mode", "deferred")
+    deferred = [record._replace(ip="5.6.7.8") for record in old_records(3)]
+    asyncio.run(crud.insert_logs(deferred, db))
+    # A key without a geo_dim row reads as no location through the log view.
+    db.execute("UPDATE log_compact SET geo_id = 42 WHERE id = (SELECT MIN(id) FROM log_compact WHERE geo_id IS NULL)")
+
+    assert archiver.archive(db) == 2
+    assert db.execute("SELECT COUNT(*) FROM log WHERE city IS NULL").fetchone()[0] == 3
+    assert total(db, archiver) == 5
@@ -1,11 +1,18 @@
 import ipaddress
 import logging
 import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
 import geoip2.database
 from geoip2.errors import AddressNotFoundError
+from maxminddb import MODE_MMAP
+from user_agents import parse
 from dotenv import load_dotenv
 from models import LocationData
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 import subprocess
 
 logger = logging.getLogger(__name__)
@@ -55,27 +62,234 @@ def validate_ip(ip: str) -> bool:
     except ValueError:
         return False
 
-async def retrieve_geoloc(ip: str) -> Optional[LocationData]:
+class GeoIPResolver:
     """
-    Retrieves IP location details like longitude, latitude, city, and country from a given IP.
+    Long-lived, memory-mapped GeoLite2 reader with a bounded IP -> LocationData LRU cache.
 
-    args: ip (str)
-    returns: Optional[LocationData]
+    The mmdb file is stat'ed at most every `check_interval` seconds; when it has
+    been replaced (e.g. by geoipupdate) the reader is reopened and the cache is cleared.
     """
-    if validate_ip(ip):
-        try:
-            with geoip2.database.Reader(geoip_db_path) as reader:
-                response = reader.city(ip)
+    def __init__(self, db_path: str = geoip_db_path, cache_size: int = 65536, check_interval: float = 30.0):
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict = OrderedDict()
+        self._reader: Optional[geoip2.database.Reader] = None
+        self._file_id: Optional[Tuple[int, int]] = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
 
-                return LocationData(
+    def _file_changed(self) -> bool:
+        now = time.monotonic()
+        if self._reader is not None and now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+
+        stat = os.stat(self.db_path)
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if file_id == self._file_id:
+            return False
+        self._file_id = file_id
+        return True
+
+    def _get_reader(self) -> geoip2.database.Reader:
+        if self._file_changed():
+            if self._reader is not None:
+                self._reader.close()
+                logger.info("GeoIP database file changed, reopening reader.")
+            self._reader = geoip2.database.Reader(self.db_path, mode=MODE_MMAP)
+            self._cache.clear()
+        return self._reader
+
+    def lookup(self, ip: str) -> Optional[LocationData]:
+        """
+        Looks up an IP, serving repeat IPs from the cache. Addresses missing from the database are cached as None.
+
+        args: ip (str)
+        returns: Optional[LocationData]
+        raises: OSError, ValueError if the database can't be opened or the IP is malformed
+        """
+        with self._lock:
+            reader = self._get_reader()
+            if ip in self._cache:
+                self._cache.move_to_end(ip)
+                self.hits += 1
+                return self._cache[ip]
+            self.misses += 1
+
+            try:
+                response = reader.city(ip)
+                locdata = LocationData(
                     city=response.city.name if response.city.name else "Unknown",
                     country=response.country.name if response.country.name else "Unknown",
                     latitude=response.location.latitude if response.location.latitude else 0.0,
                     longitude=response.location.longitude if response.location.longitude else 0.0,
                 )
-        except AddressNotFoundError:
-            logger.error(f"IP address {ip} not found in the GeoLite2 database.")
-            return None
+            except AddressNotFoundError:
+                logger.debug(f"IP address {ip} not found in the GeoLite2 database.")
+                locdata = None
+
+            self._cache[ip] = locdata
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return locdata
+
+    def build_epoch(self) -> int:
+        """
+        Returns the build time (Unix epoch) of the open GeoLite2 database, which changes with every release.
+
+        returns: int
+        raises: OSError if the database can't be opened
+        """
+        with self._lock:
+            return self._get_reader().metadata().build_epoch
+
+    def stats(self) -> Dict:
+        """
+        Returns cache size and hit/miss counters.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            self._file_id = None
+            self._cache.clear()
+
+geoip_resolver = GeoIPResolver()
+
+class UserAgentClassifier:
+    """
+    Bounded UA string -> (browser, os, device) LRU cache in front of user_agents.parse.
+    """
+    def __init__(self, cache_size: int = 4096):
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def classify(self, user_agent_string: str) -> Tuple[str, str, str]:
+        """
+        Classifies a user agent string into browser family, OS family and device type.
+
+        args: user_agent_string (str)
+        returns: Tuple[str, str, str] (browser, os, device)
+        """
+        with self._lock:
+            classification = self._cache.get(user_agent_string)
+            if classification is not None:
+                self._cache.move_to_end(user_agent_string)
+                self.hits += 1
+                return classification
+            self.misses += 1
+
+        user_agent = parse(user_agent_string)
+
+        if user_agent.is_mobile:
+            device = 'mobile'
+        elif user_agent.is_tablet:
+            device = 'tablet'
+        else:
+            device = 'desktop'
+
+        classification = (user_agent.browser.family, user_agent.os.family, device)
+
+        with self._lock:
+            self._cache[user_agent_string] = classification
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return classification
+
+    def stats(self) -> Dict:
+        """
+        Returns cache size and hit/miss counters.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+user_agent_classifier = UserAgentClassifier()
+
+# Fallback (regex, replacement) normalisers for paths that didn't match a route.
+DEFAULT_ENDPOINT_PATTERNS = [
+    (r"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)", "/{uuid}"),
+    (r"/[0-9a-fA-F]{24,}(?=/|$)", "/{hash}"),
+    (r"/[0-9]+(?=/|$)", "/{id}")
+]
+
+class EndpointNormalizer:
+    """
+    Maps request paths to low-cardinality endpoint labels, so `/users/123` and `/users/456`
+    are both logged as `/users/{id}`.
+
+    The matched route's template (`scope["route"].path_format`) is used when there is one;
+    other paths (404s, mounted apps without templates) go through the regex normalisers.
+    Results are interned, so every row of an endpoint references the same str object, and
+    path -> label lookups are served from a bounded LRU cache.
+
+    args: patterns (List[Tuple[str, str]]): (regex, replacement) pairs applied in order
+          cache_size (int)
+    """
+    def __init__(self, patterns: List[Tuple[str, str]] = DEFAULT_ENDPOINT_PATTERNS, cache_size: int = 4096):
+        self.patterns = [(re.compile(pattern), replacement) for pattern, replacement in patterns]
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def normalize(self, path: str, route_template: Optional[str] = None) -> str:
+        """
+        Returns the endpoint label for a request path.
+
+        args: path (str), route_template (Optional[str]): path_format of the matched route, if any
+        returns: str
+        """
+        if route_template is not None:
+            return sys.intern(route_template)
+
+        with self._lock:
+            endpoint = self._cache.get(path)
+            if endpoint is not None:
+                self._cache.move_to_end(path)
+                return endpoint
+
+        endpoint = path
+        for pattern, replacement in self.patterns:
+            endpoint = pattern.sub(replacement, endpoint)
+        endpoint = sys.intern(endpoint)
+
+        with self._lock:
+            self._cache[path] = endpoint
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return endpoint
+
+endpoint_normalizer = EndpointNormalizer()
+
+async def retrieve_geoloc(ip: str) -> Optional[LocationData]:
+    """
+    Retrieves IP location details like longitude, latitude, city, and country from a given IP.
+
+    args: ip (str)
+    returns: Optional[LocationData]
+    """
+    if validate_ip(ip):
+        try:
+            return geoip_resolver.lookup(ip)
         except Exception as e:
             logger.error(f"Error retrieving geolocation: {e}")
             return None